@@ -237,13 +237,21 @@ def create_argument_parser(description):
     return parser
 
 
-def connect(hosts):
+def connect(hosts, maxsize=10):
+    """ Connect to an ES cluster.
+
+    Args:
+        hosts: list of (host, port) tuples
+        maxsize: maximum number of connections kept open per host, which
+            should be at least the number of threads sharing the client.
+    """
     hosts_dict = [{'host': host, 'port': port} for host, port in hosts]
     return elasticsearch.Elasticsearch(
         hosts_dict,
         timeout=60,
         retries=5,
-        retry_on_timeout=True
+        retry_on_timeout=True,
+        maxsize=maxsize,
     )
 
 
@@ -1,11 +1,16 @@
 import boto3
+import concurrent.futures
+import gzip
 import os
 import hashlib
+import io
 import logging
 import json
 import datetime
+import queue
 import subprocess
 import re
+import threading
 from urllib.parse import urlparse
 
 from botocore.exceptions import ClientError
@@ -86,6 +91,218 @@ def get_pdf_id(document):
     return None
 
 
+class ReadAheadStream(io.RawIOBase):
+    """
+    Read-only file object over a stream (such as the body of an S3
+    object), which a background thread keeps reading ahead of the
+    consumer, up to max_chunks chunks of chunk_size bytes.
+    """
+
+    def __init__(self, stream, chunk_size=1024 * 1024, max_chunks=16):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.chunks = queue.Queue(max_chunks)
+        self.chunk = memoryview(b'')
+        self.eof = False
+        self.error = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._read_ahead, daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.chunks.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _read_ahead(self):
+        try:
+            while True:
+                chunk = self.stream.read(self.chunk_size)
+                if not self._put(chunk) or not chunk:
+                    return
+        except Exception as e:
+            self._put(e)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.chunk and not self.eof:
+            if self.error is not None:
+                # The reader thread has stopped, keep failing
+                raise self.error
+            chunk = self.chunks.get()
+            if isinstance(chunk, Exception):
+                self.error = chunk
+                raise chunk
+            if not chunk:
+                self.eof = True
+            self.chunk = memoryview(chunk)
+
+        n = min(len(b), len(self.chunk))
+        b[:n] = self.chunk[:n]
+        self.chunk = self.chunk[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.stopped.set()
+            self.thread.join()
+            self.stream.close()
+        super().close()
+
+
+class MultipartUploadStream(io.RawIOBase):
+    """
+    Write-only file object uploading what is written to it to an S3
+    object, as a multipart upload of parts of part_size bytes, sent as
+    soon as they fill by up to max_concurrency background threads. The
+    upload is completed when the stream is closed, or cancelled with
+    abort(), which a with block does on errors, as does garbage
+    collecting the stream before it is closed.
+    """
+
+    def __init__(self, s3_object, part_size=8 * 1024 * 1024,
+                 max_concurrency=4):
+        upload = s3_object.initiate_multipart_upload()
+        # boto3 resources are not thread safe, so parts are sent with the
+        # (thread safe) client, and the upload identified by these.
+        self.client = upload.meta.client
+        self.upload_args = {
+            'Bucket': upload.bucket_name,
+            'Key': upload.object_key,
+            'UploadId': upload.id,
+        }
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.parts = []
+        self.aborted = False
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_concurrency)
+        # Bounds the parts held in memory while waiting to be sent
+        self.slots = threading.Semaphore(max_concurrency)
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.buffer += b
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(b)
+
+    def _send_part(self, number, data):
+        try:
+            response = self.client.upload_part(
+                PartNumber=number, Body=data, **self.upload_args)
+            return {'PartNumber': number, 'ETag': response['ETag']}
+        finally:
+            self.slots.release()
+
+    def _upload_part(self, data):
+        # Fail early rather than after the whole output is written
+        for part in self.parts:
+            if part.done() and part.exception() is not None:
+                raise part.exception()
+
+        self.slots.acquire()
+        self.parts.append(
+            self.executor.submit(self._send_part, len(self.parts) + 1, data)
+        )
+
+    def abort(self, wait=True):
+        """ Cancel the upload, by default once the parts being sent are. """
+        if not self.closed:
+            self.aborted = True
+            self.executor.shutdown(wait=wait)
+            self.client.abort_multipart_upload(**self.upload_args)
+        super().close()
+
+    def close(self):
+        if not self.closed and not self.aborted:
+            try:
+                # The last part may be smaller than part_size, and an
+                # empty object still needs one part.
+                if self.buffer or not self.parts:
+                    self._upload_part(bytes(self.buffer))
+                parts = [part.result() for part in self.parts]
+                self.client.complete_multipart_upload(
+                    MultipartUpload={'Parts': parts}, **self.upload_args)
+                self.executor.shutdown()
+            except Exception:
+                self.abort()
+                raise
+        super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+    def __del__(self):
+        # io.IOBase.__del__ would close() the stream, completing the upload
+        # with whatever was written so far. A stream dropped without being
+        # closed, e.g. on an error bypassing its with block, is incomplete.
+        # This may run on a thread of the executor, which can't wait for
+        # itself.
+        if not self.closed:
+            self.abort(wait=False)
+
+
+class GzipJsonWriter(object):
+    """
+    Writer of records to an S3 object as gzipped json lines, compressed
+    and uploaded as they are written, see MultipartUploadStream. Used as a
+    context manager, the upload is completed at the end of the with block,
+    or aborted if it raises.
+    """
+
+    def __init__(self, upload_stream):
+        self.upload_stream = upload_stream
+        self.gzip_f = gzip.GzipFile(mode='wb', fileobj=upload_stream)
+
+    def write(self, record):
+        """Write a record, as a line of json."""
+        self.write_line(json.dumps(record))
+
+    def write_line(self, line):
+        """Write a line of already encoded json."""
+        self.gzip_f.write(line.encode('utf-8'))
+        self.gzip_f.write(b'\n')
+
+    def write_bytes(self, data):
+        self.gzip_f.write(data)
+
+    def close(self):
+        try:
+            self.gzip_f.close()
+        except Exception:
+            self.upload_stream.abort()
+            raise
+        self.upload_stream.close()
+
+    def abort(self):
+        try:
+            self.gzip_f.close()
+        except Exception:
+            pass
+        self.upload_stream.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
 class S3Hook(object):
     """
     (Blocking!) wrapper for writing things to S3.
@@ -216,6 +433,39 @@ class S3Hook(object):
 
         return None
 
+    def open_stream(self, src_key, chunk_size=1024 * 1024, max_chunks=16):
+        """Return a buffered file object streaming the object at the given
+        S3 location, which is read ahead of the consumer on a background
+        thread so that processing can start on the first bytes.
+        """
+        return io.BufferedReader(
+            ReadAheadStream(self.get(src_key), chunk_size, max_chunks),
+            buffer_size=chunk_size,
+        )
+
+    def open_upload_stream(self, dst_key, part_size=8 * 1024 * 1024,
+                           max_concurrency=4):
+        """Return a write-only file object uploading what is written to it
+        to the given S3 location as it is written, see
+        MultipartUploadStream.
+        """
+        bucket, path = self.parse_s3_url(dst_key)
+        return MultipartUploadStream(
+            self.client.Object(bucket, path),
+            part_size,
+            max_concurrency,
+        )
+
+    def open_json_gz_writer(self, dst_key, part_size=8 * 1024 * 1024,
+                            max_concurrency=4):
+        """Return a GzipJsonWriter of records to the given S3 location,
+        compressing and uploading them as they are written, without a
+        local temporary file.
+        """
+        return GzipJsonWriter(
+            self.open_upload_stream(dst_key, part_size, max_concurrency)
+        )
+
     def get_s3_object(self, src_key):
         """Return a raw S3 object from a given location."""
         try:
@@ -0,0 +1,71 @@
+"""
+Read-only string tables, as used by the local title indexes of the
+reference matchers, stored as numpy arrays so that they can be
+memory-mapped.
+"""
+import array
+import os
+
+import numpy as np
+
+
+class StringTable:
+    """
+    Read-only sequence of strings, stored as a single utf-8 blob and an
+    array of offsets into it, memory-mapped when loaded from disk.
+    """
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        return bytes(self.blob[start:stop]).decode('utf-8')
+
+    @classmethod
+    def from_strings(cls, strings):
+        """ Build a string table in memory from an iterable of strings. """
+        blob = bytearray()
+        offsets = array.array('q', [0])
+        for string in strings:
+            blob += string.encode('utf-8')
+            offsets.append(len(blob))
+        return cls(
+            np.frombuffer(bytes(blob), dtype=np.uint8),
+            np.frombuffer(offsets, dtype=np.int64)
+        )
+
+    @staticmethod
+    def write(path, name, strings):
+        """ Write an iterable of strings as a string table named name in
+        the directory at path.
+
+        Returns:
+            The list of files written.
+        """
+        offsets = array.array('q', [0])
+        with open(os.path.join(path, name + '.bin'), 'wb') as f:
+            for string in strings:
+                encoded = string.encode('utf-8')
+                f.write(encoded)
+                offsets.append(offsets[-1] + len(encoded))
+        np.save(
+            os.path.join(path, name + '.offsets.npy'),
+            np.frombuffer(offsets, dtype=np.int64)
+        )
+        return [name + '.bin', name + '.offsets.npy']
+
+    @classmethod
+    def load(cls, path, name):
+        offsets = np.load(
+            os.path.join(path, name + '.offsets.npy'), mmap_mode='r')
+        if offsets[-1] == 0:
+            blob = np.zeros(0, dtype=np.uint8)
+        else:
+            blob = np.memmap(
+                os.path.join(path, name + '.bin'), dtype=np.uint8, mode='r')
+        return cls(blob, offsets)
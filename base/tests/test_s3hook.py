@@ -0,0 +1,164 @@
+import concurrent.futures
+import gc
+import gzip
+import io
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from hooks.s3hook import GzipJsonWriter, MultipartUploadStream, ReadAheadStream
+
+
+class FailingStream(io.BytesIO):
+    """ Stream raising an error once fail_after bytes have been read. """
+
+    def __init__(self, data, fail_after):
+        super().__init__(data)
+        self.fail_after = fail_after
+
+    def read(self, size=-1):
+        if self.tell() >= self.fail_after:
+            raise IOError('Connection reset')
+        return super().read(size)
+
+
+def test_read_ahead_stream():
+    data = bytes(range(256)) * 1000
+    with ReadAheadStream(io.BytesIO(data), 1000, 4) as f:
+        assert f.read(10) == data[:10]
+        assert f.readall() == data[10:]
+        assert f.read() == b''
+
+def test_read_ahead_stream_empty():
+    with ReadAheadStream(io.BytesIO(b''), 1000, 4) as f:
+        assert f.read() == b''
+        assert f.read() == b''
+
+def test_read_ahead_stream_lines():
+    lines = [b'line %d\n' % i for i in range(1000)]
+    with io.BufferedReader(ReadAheadStream(io.BytesIO(b''.join(lines)), 7)) as f:
+        assert list(f) == lines
+
+def test_read_ahead_stream_error():
+    data = b'x' * 10000
+    with ReadAheadStream(FailingStream(data, 5000), 1000, 4) as f:
+        for _ in range(5):
+            assert f.read(1000) == data[:1000]
+        with pytest.raises(IOError):
+            f.read(1)
+        # Later reads fail too rather than waiting for more data
+        with pytest.raises(IOError):
+            f.read(1)
+
+
+class FakeS3Client:
+    """ Records the calls of a multipart upload, failing to upload part
+    fail_part if set.
+    """
+
+    def __init__(self, fail_part=None):
+        self.fail_part = fail_part
+        self.parts = {}
+        self.completed = None
+        self.aborted = False
+        self.lock = threading.Lock()
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        assert (Bucket, Key, UploadId) == ('bucket', 'key', 'upload-id')
+        # Let parts finish out of order
+        time.sleep(0.001 * (PartNumber % 3))
+        if PartNumber == self.fail_part:
+            raise IOError('Failed to upload part %d' % PartNumber)
+        with self.lock:
+            self.parts[PartNumber] = Body
+        return {'ETag': 'etag-%d' % PartNumber}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId,
+                                  MultipartUpload):
+        self.completed = MultipartUpload['Parts']
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted = True
+
+    def get_data(self):
+        return b''.join(
+            self.parts[part['PartNumber']] for part in self.completed)
+
+
+class FakeS3Object:
+    def __init__(self, client):
+        self.client = client
+
+    def initiate_multipart_upload(self):
+        return SimpleNamespace(
+            meta=SimpleNamespace(client=self.client),
+            bucket_name='bucket',
+            object_key='key',
+            id='upload-id',
+        )
+
+
+def test_multipart_upload():
+    client = FakeS3Client()
+    data = bytes(range(256)) * 40
+    with MultipartUploadStream(FakeS3Object(client), 1000, 3) as f:
+        for i in range(0, len(data), 300):
+            f.write(data[i:i + 300])
+    assert client.completed == [
+        {'PartNumber': i, 'ETag': 'etag-%d' % i} for i in range(1, 12)]
+    assert client.get_data() == data
+    assert not client.aborted
+
+def test_multipart_upload_empty():
+    client = FakeS3Client()
+    with MultipartUploadStream(FakeS3Object(client), 1000, 3):
+        pass
+    assert client.completed == [{'PartNumber': 1, 'ETag': 'etag-1'}]
+    assert client.get_data() == b''
+
+def test_multipart_upload_part_error():
+    client = FakeS3Client(fail_part=2)
+    with pytest.raises(IOError):
+        with MultipartUploadStream(FakeS3Object(client), 1000, 3) as f:
+            for _ in range(100):
+                f.write(b'x' * 500)
+    assert client.aborted
+    assert client.completed is None
+
+def test_multipart_upload_error_in_with_block():
+    client = FakeS3Client()
+    with pytest.raises(ValueError):
+        with MultipartUploadStream(FakeS3Object(client), 1000, 3) as f:
+            f.write(b'x' * 5000)
+            raise ValueError('Failed to write')
+    assert client.aborted
+    assert client.completed is None
+
+def test_multipart_upload_not_closed():
+    client = FakeS3Client()
+    f = MultipartUploadStream(FakeS3Object(client), 1000, 3)
+    f.write(b'x' * 5000)
+    parts = f.parts
+    del f
+    # Parts being sent hold on to the stream until they are
+    concurrent.futures.wait(parts)
+    for _ in range(100):
+        gc.collect()
+        if client.aborted:
+            break
+        time.sleep(0.01)
+    assert client.aborted
+    assert client.completed is None
+
+def test_gzip_json_writer():
+    client = FakeS3Client()
+    records = [{'id': i, 'text': 'record %d' % i} for i in range(1000)]
+    with GzipJsonWriter(
+            MultipartUploadStream(FakeS3Object(client), 1000, 3)) as writer:
+        for record in records:
+            writer.write(record)
+    lines = gzip.decompress(client.get_data()).splitlines()
+    assert [json.loads(line) for line in lines] == records
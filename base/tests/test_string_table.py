@@ -0,0 +1,23 @@
+from string_table import StringTable
+
+STRINGS = ['Malaria', '', 'Zika virus', 'Épidémiologie']
+
+
+def test_from_strings():
+    table = StringTable.from_strings(STRINGS)
+    assert len(table) == len(STRINGS)
+    assert list(table) == STRINGS
+
+def test_write_and_load(tmpdir):
+    files = StringTable.write(str(tmpdir), 'titles', iter(STRINGS))
+    assert sorted(files) == sorted(
+        path.basename for path in tmpdir.listdir())
+
+    table = StringTable.load(str(tmpdir), 'titles')
+    assert len(table) == len(STRINGS)
+    assert [table[i] for i in range(len(table))] == STRINGS
+
+def test_write_and_load_empty(tmpdir):
+    StringTable.write(str(tmpdir), 'titles', [''])
+    table = StringTable.load(str(tmpdir), 'titles')
+    assert list(table) == ['']
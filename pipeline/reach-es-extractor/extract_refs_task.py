@@ -3,11 +3,10 @@
 Operator to run the web scraper on every organisation.
 """
 import logging
-import tempfile
-import json
-import gzip
 import argparse
 import os
+import queue
+import threading
 
 from hooks.s3hook import S3Hook
 from hooks.sentry import report_exception
@@ -17,6 +16,84 @@ from safe_import import safe_import
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 
+# Number of documents to read ahead of the model, and to queue for writing
+# behind it, in pipelined mode
+READ_AHEAD = 64
+WRITE_BEHIND = 64
+
+
+def read_ahead(iterable, maxsize):
+    """
+    Iterate over iterable on a background thread, up to maxsize items ahead
+    of the consumer, re-raising its errors in the consumer.
+    """
+    items = queue.Queue(maxsize)
+
+    def read():
+        try:
+            for item in iterable:
+                items.put(('item', item))
+        except Exception as e:
+            items.put(('error', e))
+        else:
+            items.put(('done', None))
+
+    # Daemon, so that a consumer stopping early doesn't hang on the thread
+    threading.Thread(target=read, daemon=True).start()
+    while True:
+        kind, item = items.get()
+        if kind == 'done':
+            return
+        if kind == 'error':
+            raise item
+        yield item
+
+
+class ReferencesWriter(threading.Thread):
+    """
+    Thread serialising and compressing the split and parsed references of
+    documents put on its queue, writing them to split_writer and
+    parsed_writer, GzipJsonWriters, until it gets None. After an error, it
+    discards the documents still put on its queue, so that the producer
+    doesn't block, and keeps the error to be raised by join() once the
+    thread has finished.
+    """
+
+    def __init__(self, split_writer, parsed_writer, maxsize):
+        super().__init__()
+        self.split_writer = split_writer
+        self.parsed_writer = parsed_writer
+        self.queue = queue.Queue(maxsize)
+        self.error = None
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is not None:
+                continue
+
+            split_references, parsed_references = item
+            try:
+                write_references(
+                    self.split_writer, self.parsed_writer,
+                    split_references, parsed_references)
+            except Exception as e:
+                self.error = e
+
+    def join(self, timeout=None):
+        super().join(timeout)
+        if not self.is_alive() and self.error is not None:
+            raise self.error
+
+
+def write_references(split_writer, parsed_writer, split_references,
+                     parsed_references):
+    split_writer.write(split_references)
+    for ref in parsed_references:
+        parsed_writer.write(ref)
+
 
 class ExtractRefsOperator(object):
     """
@@ -28,50 +105,93 @@ class ExtractRefsOperator(object):
         src_s3_key: S3 URL for input
         split_s3_key: S3 URL for split references
         parsed_s3_key: S3 URL for parsed references
+        num_workers: number of processes to split and parse references with
+        cache_s3_key: S3 URL prefix of a cache of split and parsed sections,
+            so that only new or changed sections are run through the model
+        model_socket: Unix socket of a split/parse model server to use
+            rather than loading the model, see refparse.split_parse_server
+        pipelined: read the input and write the outputs on their own
+            threads, with the outputs uploaded as they are written, so that
+            the model doesn't wait on I/O or compression
     """
 
-    def __init__(self, src_s3_key, split_s3_key, parsed_s3_key):
+    def __init__(self, src_s3_key, split_s3_key, parsed_s3_key,
+                 num_workers=1, cache_s3_key=None, model_socket=None,
+                 pipelined=False):
         self.src_s3_key = src_s3_key
         self.split_s3_key = split_s3_key
         self.parsed_s3_key = parsed_s3_key
+        self.num_workers = num_workers
+        self.cache_s3_key = cache_s3_key
+        self.model_socket = model_socket
+        self.pipelined = pipelined
 
     @report_exception
     def execute(self):
+        if self.pipelined:
+            self.execute_pipelined()
+            return
+
         with safe_import():
             from refparse.refparse import yield_structured_references
 
         s3 = S3Hook()
 
-        with tempfile.NamedTemporaryFile() as split_rawf, \
-             tempfile.NamedTemporaryFile() as parsed_rawf:
-
-            with gzip.GzipFile(mode='wb', fileobj=split_rawf) as split_f, \
-                 gzip.GzipFile(mode='wb', fileobj=parsed_rawf) as parsed_f:
-
-                refs = yield_structured_references(
-                    self.src_s3_key,
-                    logger)
-                for split_references, parsed_references in refs:
-                    split_f.write(json.dumps(split_references).encode('utf-8'))
-                    split_f.write(b'\n')
-                    for ref in parsed_references:
-                        parsed_f.write(json.dumps(ref).encode('utf-8'))
-                        parsed_f.write(b'\n')
-
-            split_rawf.flush()
-            parsed_rawf.flush()
-
-            s3.load_file(
-                split_rawf.name,
-                self.split_s3_key,
-                replace=True,
+        with s3.open_json_gz_writer(self.split_s3_key) as split_writer, \
+             s3.open_json_gz_writer(self.parsed_s3_key) as parsed_writer:
+
+            refs = yield_structured_references(
+                self.src_s3_key,
+                logger,
+                self.num_workers,
+                self.cache_s3_key,
+                self.model_socket)
+            for split_references, parsed_references in refs:
+                write_references(
+                    split_writer, parsed_writer,
+                    split_references, parsed_references)
+
+    def execute_pipelined(self):
+        """
+        Run the operator as three stages: a thread reading and decoding the
+        input, split/parse on the calling thread, and a thread serialising
+        and compressing the outputs into multipart uploads, joined by
+        bounded queues. Both uploads are aborted if any stage fails.
+        """
+        with safe_import():
+            from refparse.refparse import (
+                transform_scraper_file,
+                yield_scraper_file,
+                yield_split_parsed_documents,
             )
 
-            s3.load_file(
-                parsed_rawf.name,
-                self.parsed_s3_key,
-                replace=True,
-            )
+        s3 = S3Hook()
+
+        with s3.open_json_gz_writer(self.split_s3_key) as split_writer, \
+             s3.open_json_gz_writer(self.parsed_s3_key) as parsed_writer:
+
+            writer = ReferencesWriter(
+                split_writer, parsed_writer, WRITE_BEHIND)
+            writer.start()
+            try:
+                sectioned_documents = read_ahead(
+                    transform_scraper_file(
+                        yield_scraper_file(self.src_s3_key)),
+                    READ_AHEAD
+                )
+                refs = yield_split_parsed_documents(
+                    sectioned_documents,
+                    logger,
+                    self.num_workers,
+                    self.cache_s3_key,
+                    self.model_socket)
+                for item in refs:
+                    if writer.error is not None:
+                        break
+                    writer.queue.put(item)
+            finally:
+                writer.queue.put(None)
+                writer.join()
 
 
 if __name__ == '__main__':
@@ -91,12 +211,38 @@ if __name__ == '__main__':
         'dst_split_s3_key',
         help='The destination path to s3 for split refs.'
     )
+    arg_parser.add_argument(
+        '--num_workers',
+        default=1,
+        type=int,
+        help='The number of processes to split and parse references with.'
+    )
+    arg_parser.add_argument(
+        '--cache_s3_key',
+        default=None,
+        help='The S3 prefix to cache split and parsed sections in.'
+    )
+    arg_parser.add_argument(
+        '--model_socket',
+        default=None,
+        help='The Unix socket of a split/parse model server to use.'
+    )
+    arg_parser.add_argument(
+        '--pipelined',
+        action='store_true',
+        help='Read, split and parse, and write and upload on separate'
+             ' threads.'
+    )
 
     args = arg_parser.parse_args()
 
     extracter = ExtractRefsOperator(
         args.src_s3_key,
         args.dst_s3_key,
-        args.dst_split_s3_key
+        args.dst_split_s3_key,
+        num_workers=args.num_workers,
+        cache_s3_key=args.cache_s3_key,
+        model_socket=args.model_socket,
+        pipelined=args.pipelined,
     )
     extracter.execute()
@@ -7,7 +7,7 @@ from sklearn.metrics import classification_report, f1_score, recall_score, preci
 
 from refparse.utils import FuzzyMatcher
 
-def predict_match_data(matcher, match_data):
+def predict_match_data(matcher, match_data, batch_size=1000):
     """
     Input:
         matcher: A matcher object initialised
@@ -27,15 +27,18 @@ def predict_match_data(matcher, match_data):
                 the Matched publication id column will be None. The 'Cosine Similarity'
                 column gives the score of how similar the matched
                 reference titles are.
+        batch_size: The number of references to pass to the matcher
+                at once.
     """
 
     predictions = []
-    for ref in match_data:
-        matched_publications = matcher.match(ref)
-        if matched_publications:
-            predictions.append(matched_publications['Matched publication id'])
-        else:
-            predictions.append(None)
+    for i in range(0, len(match_data), batch_size):
+        for matched_publications in matcher.match_many(
+                match_data[i:i + batch_size]):
+            if matched_publications:
+                predictions.append(matched_publications['Matched publication id'])
+            else:
+                predictions.append(None)
 
     return predictions
 
@@ -97,7 +100,8 @@ def evaluate_metric(actual, predicted):
     return metrics
 
 def evaluate_match_references(
-        evaluation_references, match_threshold, length_threshold, sample_N
+        evaluation_references, match_threshold, length_threshold, sample_N,
+        matcher_class=FuzzyMatcher
     ):
 
     # Take a random sample of the evaluation references to find matches for
@@ -111,14 +115,14 @@ def evaluate_match_references(
         ~evaluation_references['uber_id'].isin(match_data_negative['uber_id'])
         ]
 
-    fuzzy_matcher = FuzzyMatcher(
+    matcher = matcher_class(
         evaluation_references_without_negative, match_threshold, length_threshold)
 
     predictions = predict_match_data(
         match_data=
             match_data_positive.to_dict('records') +
             match_data_negative.to_dict('records'),
-        matcher=fuzzy_matcher
+        matcher=matcher
         )
     actual = match_data_positive['Reference id'].to_list()+[None]*sample_N
 
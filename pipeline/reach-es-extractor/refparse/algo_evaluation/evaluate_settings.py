@@ -33,5 +33,6 @@ class TestSettings(BaseSettings):
     EVAL_SAMPLE_MATCH_NUMBER = 1000
     LENGTH_THRESHOLD = 50
     MATCH_THRESHOLD = 0.8
+    MINHASH_MATCH_THRESHOLD = 0.6
 
 settings = TestSettings()
@@ -29,10 +29,11 @@ def get_matches(evaluation_references, sample_N):
     fuzzy_matcher = FuzzyMatcher(evaluation_references_without_negative, -1)
 
     match_data_pos_neg = pd.concat([match_data_positive, match_data_negative])
+    match_data_pos_neg = match_data_pos_neg.to_dict('records')
     eval_references = []
-    for i, ref in match_data_pos_neg.iterrows():
-        match_ref = fuzzy_matcher.match(ref)
-        eval_references.append(match_ref)
+    for i in range(0, len(match_data_pos_neg), 1000):
+        eval_references.extend(
+            fuzzy_matcher.match_many(match_data_pos_neg[i:i + 1000]))
     eval_references = pd.DataFrame(eval_references)
     eval_references["Title Length"] = [len(title) for title in eval_references["Extracted title"]]
     eval_references["Match Type"] = ["Positive"]*sample_N + ["Negative"]*sample_N
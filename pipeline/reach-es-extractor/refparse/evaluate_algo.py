@@ -21,7 +21,7 @@ from reach.refparse.algo_evaluation.evaluate_parse import evaluate_parse
 from reach.refparse.algo_evaluation.evaluate_settings import settings
 from reach.refparse.algo_evaluation.evaluate_split_section import \
     evaluate_split_section
-from reach.refparse.utils import FileManager
+from reach.refparse.utils import FileManager, MinHashMatcher
 
 logging.basicConfig(
     format="%(asctime)s %(name)s %(levelname)s: %(message)s",
@@ -262,18 +262,31 @@ if __name__ == '__main__':
         )
     logger.info('main: ---> Took %0.3f seconds', time.time() - start)
 
+    start = time.time()
+    logger.info('main: Running MinHash match references evaluation')
+    eval_score_minhash_match = evaluate_match_references(
+        evaluation_references,
+        settings.MINHASH_MATCH_THRESHOLD,
+        settings.LENGTH_THRESHOLD,
+        settings.EVAL_SAMPLE_MATCH_NUMBER,
+        matcher_class=MinHashMatcher
+        )
+    logger.info('main: ---> Took %0.3f seconds', time.time() - start)
+
     eval_scores_list = [
         eval_scores_find,
         eval_score_split,
         eval_score_parse,
-        eval_score_match
+        eval_score_match,
+        eval_score_minhash_match
         ]
 
     eval_names = [
         "How well the scraper finds the references section",
         "How well the splitter predicted how many references there were",
         "How well the parser predicted reference component texts",
-        "How well the matcher matched references"
+        "How well the matcher matched references",
+        "How well the MinHash matcher matched references"
     ]
 
     if eval(args.verbose):
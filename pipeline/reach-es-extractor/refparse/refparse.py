@@ -3,12 +3,16 @@ and a list of publication.
 """
 
 from argparse import ArgumentParser
-from collections import namedtuple
+from collections import deque, namedtuple
 from urllib.parse import urlparse
 from functools import partial
+from itertools import islice
+import multiprocessing
 import os
 import os.path
+import queue
 import time
+import traceback
 import json
 
 import sentry_sdk
@@ -16,12 +20,17 @@ import pandas as pd
 
 from .utils import (FileManager,
                    FuzzyMatcher,
+                   ShardedFuzzyMatcher,
                    structure_reference,
-                   ExactMatcher)
+                   ExactMatcher,
+                   BatchSplitParser,
+                   SplitParseCache,
+                   get_model_version,
+                   split_windows,
+                   merge_window_predictions,
+                   SplitParseClient)
 from .settings import settings
 
-from deep_reference_parser.split_parse import SplitParser
-from deep_reference_parser.common import MULTITASK_CFG
 
 
 SectionedDocument = namedtuple(
@@ -44,11 +53,11 @@ def check_publications_file(publications, publications_file):
 
 
 def transform_scraper_file(scraper_data, section_column="sections"):
-    """Takes a pandas dataframe. Yields back individual
+    """Takes an iterable of scraper result dicts. Yields back individual
     SectionedDocument tuples.
     """
-    for _, document in scraper_data.iterrows():
-        if document[section_column]:
+    for document in scraper_data:
+        if document.get(section_column):
             try:
                 sections = document[section_column]
             except KeyError:
@@ -64,14 +73,14 @@ def transform_scraper_file(scraper_data, section_column="sections"):
                     )
 
 def transform_scraper_text_file(scraper_data, text_column="text"):
-    """Takes a pandas dataframe. Yields back individual
+    """Takes an iterable of scraper result dicts. Yields back individual
     SectionedDocument tuples.
     """
-    for _, document in scraper_data.iterrows():
+    for document in scraper_data:
         metadata = {}
-        metadata.update(document.get("source_metadata", {}))
-        metadata.update(document.get("pdf_metadata", {}))
-        if document[text_column]:
+        metadata.update(document.get("source_metadata") or {})
+        metadata.update(document.get("pdf_metadata") or {})
+        if document.get(text_column):
             text = document[text_column]
             yield SectionedDocument(
                 text,
@@ -109,12 +118,15 @@ SCRAPING_COLUMNS = [
     'types'
 ]
 
-def get_file(
-        file_str,
-        file_type,
-        get_scraped=False,
-        scraping_columns=('title', 'file_hash', 'sections', 'uri', 'url', 'keywords')
-        ):
+TEXT_SCRAPING_COLUMNS = [
+    'file_hash',
+    'url',
+    'text',
+    'source_metadata',
+    'pdf_metadata'
+]
+
+def get_file(file_str, file_type):
     if file_str.startswith('s3://'):
         u = urlparse(file_str)
         fm = FileManager('S3', bucket=u.netloc)
@@ -124,98 +136,441 @@ def get_file(
         fm = FileManager('LOCAL')
         file_name = os.path.basename(file_str)
         file_dir = os.path.dirname(file_str)
-    if get_scraped:
-        file = fm.get_scraping_results(
-            file_name,
-            file_dir,
-            SCRAPING_COLUMNS,)
+    return fm.get_file(
+        file_name,
+        file_dir,
+        file_type)
+
+
+def get_section_text(doc):
+    return doc.section[0:settings.SPLIT_PARSE_MAX_SECTION_LENGTH]
+
+
+def get_section_windows(doc):
+    """
+    Return the (start, stop) offsets of the windows of the section of a
+    SectionedDocument to split and parse, see split_windows.
+    """
+    if settings.SPLIT_PARSE_WINDOW_SIZE:
+        return split_windows(
+            doc.section,
+            settings.SPLIT_PARSE_WINDOW_SIZE,
+            settings.SPLIT_PARSE_WINDOW_OVERLAP
+        )
+    return [(0, len(get_section_text(doc)))]
+
+
+def yield_scraper_file(file_str, scraping_columns=SCRAPING_COLUMNS):
+    """
+    Yield the documents of a scraper results file, as dicts of their
+    scraping_columns, streaming them from the file rather than loading
+    them all in memory.
+    """
+    if file_str.startswith('s3://'):
+        u = urlparse(file_str)
+        fm = FileManager('S3', bucket=u.netloc)
+        file_name = os.path.basename(u.path)
+        file_dir = os.path.dirname(u.path)[1:]  # strip /
     else:
-        file = fm.get_file(
-            file_name,
-            file_dir,
-            file_type)
-    return file
+        fm = FileManager('LOCAL')
+        file_name = os.path.basename(file_str)
+        file_dir = os.path.dirname(file_str)
+    yield from fm.yield_scraping_results(file_name, file_dir, scraping_columns)
 
 
-def yield_structured_references(scraper_file, logger):
+def split_parse_document(splitter_parser, doc):
     """
-    Split and parse references using a (potentially parallelized) map()
-    implementation, yielding back a list of reference dicts for each
-    document in scraper_file.
-    Args:
-        scraper_file: path / S3 url to scraper results file
-        logger: logging configuration name
+    Split and parse the references of a SectionedDocument.
+    Returns:
+        The split references of the document, as a dict, and a list of its
+        structured references.
     """
+    reference_predictions = splitter_parser.split_parse(
+        get_section_text(doc)
+        )
+    return transform_reference_predictions(doc, reference_predictions)
 
-    logger.info("[+] Reading input files")
 
-    # Loading the scraper results
-    scraper_file = get_file(scraper_file, "", get_scraped=True)
+def transform_reference_predictions(doc, reference_predictions):
+    """
+    Turn the split_parse predictions of a SectionedDocument into its split
+    references, as a dict, and a list of its structured references.
+    """
+    splitted_references = [reference['Reference'] for reference in reference_predictions]
+    reference_components = [reference['Attributes'] for reference in reference_predictions]
+    structured_references = map(structure_reference, reference_components)
+
+    structured_references = transform_structured_references(
+        splitted_references,
+        structured_references,
+        doc.id,
+        doc.uri,
+        doc.metadata
+    )
 
-    sectioned_documents = transform_scraper_file(scraper_file)
+    splitted_references = {
+        "doc_id": doc.id,
+        "doc_url": doc.uri,
+        "references": splitted_references
+    }
+    return splitted_references, structured_references
 
-    # Instantiate deep_reference_parser model here (not in loop!)
 
-    splitter_parser = SplitParser(config_file=MULTITASK_CFG)
+def get_multitask_config():
+    # Imported here rather than at the top, as importing deep_reference_parser
+    # loads tensorflow, which is slow and not needed when split/parse runs
+    # on a model server
+    from deep_reference_parser.common import MULTITASK_CFG
+    return MULTITASK_CFG
+
+
+def load_split_parser():
+    from deep_reference_parser.split_parse import SplitParser
+    return SplitParser(config_file=get_multitask_config())
+
+
+def split_parse_worker(task_queue, result_queue):
+    """
+    Worker process of yield_split_parsed_texts, loading the model once
+    then split and parsing (index, section text) tasks from task_queue
+    until it gets None. Results, errors, and finally a summary of the
+    worker's throughput are put on result_queue.
+    """
+    splitter_parser = load_split_parser()
 
-    t0 = time.time()
+    nb_documents = 0
     nb_references = 0
-    for i, doc in enumerate(sectioned_documents):
-        logger.info('[+] Processing references from document {}'.format(
-            i
-        ))
+    busy_time = 0
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+
+        i, text = task
+        t0 = time.time()
+        try:
+            result = splitter_parser.split_parse(text)
+        except Exception:
+            result_queue.put(('error', i, traceback.format_exc()))
+            continue
+        busy_time += time.time() - t0
+        nb_documents += 1
+        nb_references += len(result)
+        result_queue.put(('result', i, result))
+
+    result_queue.put((
+        'summary', os.getpid(), (nb_documents, nb_references, busy_time)
+    ))
+
+
+class SplitParseWorkers:
+    """
+    Pool of num_workers processes splitting and parsing section texts,
+    each loading the model once, see yield_split_parsed. Use as a context
+    manager: on exit, workers are shut down, logging their throughput, or
+    terminated if an exception was raised.
+    """
 
-        reference_predictions = splitter_parser.split_parse(
-            doc.section[0:1000000]
+    def __init__(self, num_workers, logger):
+        self.logger = logger
+        # Workers are spawned rather than forked, as tensorflow doesn't
+        # support being used from forked processes.
+        context = multiprocessing.get_context('spawn')
+        self.task_queue = context.Queue(maxsize=num_workers)
+        self.result_queue = context.Queue()
+        self.workers = [
+            context.Process(
+                target=split_parse_worker,
+                args=(self.task_queue, self.result_queue)
             )
+            for _ in range(num_workers)
+        ]
+        self.window = 4 * num_workers
+        self.poll_interval = settings.SPLIT_PARSE_WORKER_POLL_INTERVAL
+        self.finishing = False
+        # Texts sent to the workers whose results weren't yielded back
+        self.in_flight = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.shutdown()
+        finally:
+            self.terminate()
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def terminate(self):
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.terminate()
+
+    def check_workers(self):
+        # Workers only exit once told to finish, and then with code 0
+        for worker in self.workers:
+            if worker.exitcode is not None and (
+                    worker.exitcode != 0 or not self.finishing):
+                raise RuntimeError(
+                    'Split parse worker %d exited with code %d' % (
+                        worker.pid, worker.exitcode)
+                )
+        if all(worker.exitcode is not None for worker in self.workers):
+            raise RuntimeError('All split parse workers exited')
+
+    def put_task(self, task):
+        while True:
+            try:
+                return self.task_queue.put(task, timeout=self.poll_interval)
+            except queue.Full:
+                self.check_workers()
 
-        logger.info('[+] Extracted {} references from document {}'.format(
-            len(reference_predictions),
-            i
-        ))
-
-        splitted_references = [reference['Reference'] for reference in reference_predictions]
-        reference_components = [reference['Attributes'] for reference in reference_predictions]
-        structured_references = map(structure_reference, reference_components)
-
-        structured_references = transform_structured_references(
-            splitted_references,
-            structured_references,
-            doc.id,
-            doc.uri,
-            doc.metadata
-        )
+    def get_result(self):
+        while True:
+            try:
+                return self.result_queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                self.check_workers()
+
+    def yield_split_parsed(self, texts):
+        """
+        Split and parse an iterable of section texts, yielding back
+        split_parse results in the order of the texts, holding at most a
+        few texts per worker in memory. Can be called again once the
+        results of a previous call have all been yielded.
+        """
+        if self.in_flight:
+            raise RuntimeError(
+                'Split/parse results of previous texts not yielded yet')
+
+        documents = enumerate(texts)
+        nb_sent = 0
+        nb_yielded = 0
+        exhausted = False
+        results = {}
+        while True:
+            while not exhausted and nb_sent - nb_yielded < self.window:
+                task = next(documents, None)
+                if task is None:
+                    exhausted = True
+                else:
+                    self.put_task(task)
+                    nb_sent += 1
+                    self.in_flight += 1
+            if exhausted and nb_yielded == nb_sent:
+                return
 
-        splitted_references = {
-            "doc_id": doc.id,
-            "doc_url": doc.uri,
-            "references": splitted_references
-        }
-        yield splitted_references, structured_references
+            kind, i, result = self.get_result()
+            if kind == 'error':
+                raise RuntimeError(
+                    'Failed to split and parse document %d:\n%s' % (i, result))
+            results[i] = result
+            while nb_yielded in results:
+                self.in_flight -= 1
+                yield results.pop(nb_yielded)
+                nb_yielded += 1
+
+    def shutdown(self):
+        """ Tell the workers to finish, and log their throughput. """
+        if self.in_flight:
+            raise RuntimeError(
+                'Shutting down split/parse workers with %d texts in flight'
+                % self.in_flight)
+
+        self.finishing = True
+        for _ in self.workers:
+            self.put_task(None)
+        for _ in self.workers:
+            kind, pid, (nb_documents, nb_references, busy_time) = \
+                self.get_result()
+            self.logger.info(
+                '[+] Worker %d split and parsed %d documents and %d'
+                ' references in %.1fs (%.2f documents/s)',
+                pid,
+                nb_documents,
+                nb_references,
+                busy_time,
+                nb_documents / busy_time if busy_time else 0
+            )
+        for worker in self.workers:
+            worker.join()
 
-        nb_references += len(splitted_references)
 
-    t1 = time.time()
-    total = t1-t0
+def yield_split_parsed_texts(texts, num_workers, logger):
+    """
+    Split and parse section texts across num_workers processes, each
+    loading the model once, see SplitParseWorkers.
+    """
+    with SplitParseWorkers(num_workers, logger) as workers:
+        yield from workers.yield_split_parsed(texts)
 
-    logger.info(
-        "Time taken to predict for %s is %s",
-        str(nb_references),
-        str(total)
-    )
 
+def yield_structured_references(scraper_file, logger, num_workers=1,
+                                cache_path=None, model_socket=None):
+    """
+    Split and parse references, sequentially or across num_workers
+    processes, yielding back a list of reference dicts for each
+    document in scraper_file.
+    Args:
+        scraper_file: path / S3 url to scraper results file
+        logger: logging configuration name
+        num_workers: number of processes to split and parse with
+        cache_path: local directory or S3 URL prefix of a cache of split
+            and parsed sections, so that only new or changed sections are
+            run through the model
+        model_socket: path of the Unix socket of a split/parse model server
+            to use rather than loading the model, see split_parse_server
+    """
+
+    logger.info("[+] Reading input files")
+
+    # Streaming the scraper results
+    sectioned_documents = transform_scraper_file(
+        yield_scraper_file(scraper_file))
 
-def parse_references(scraper_file, logger):
+    yield from yield_split_parsed_documents(
+        sectioned_documents, logger, num_workers, cache_path, model_socket)
+
+
+def yield_split_parsed_documents(sectioned_documents, logger, num_workers=1,
+                                 cache_path=None, model_socket=None):
+    """
+    Split and parse the references of an iterable of SectionedDocuments,
+    yielding back the split references and the list of structured
+    references of each document. See yield_structured_references.
+    """
+
+    # Documents, and the windows of their section, whose text was read but
+    # predictions not yet yielded
+    documents = deque()
+
+    def yield_texts():
+        for doc in sectioned_documents:
+            windows = get_section_windows(doc)
+            documents.append((doc, windows))
+            for start, stop in windows:
+                yield doc.section[start:stop]
+
+    client = None
+    if model_socket:
+        client = SplitParseClient(model_socket)
+    # Loaded once there is a text to predict, and kept for the whole run,
+    # as split_parse_texts can be called more than once, see
+    # SplitParseCache.yield_split_parsed
+    workers = None
+    model_split_parse_texts = None
+
+    def split_parse_texts(texts):
+        nonlocal workers, model_split_parse_texts
+        if client is not None:
+            yield from client.yield_split_parsed(texts)
+            return
+
+        if num_workers > 1:
+            if workers is None:
+                workers = SplitParseWorkers(num_workers, logger)
+                workers.start()
+            yield from workers.yield_split_parsed(texts)
+            return
+
+        # Instantiate deep_reference_parser model here (not in loop!)
+        if model_split_parse_texts is None:
+            splitter_parser = load_split_parser()
+            if settings.SPLIT_PARSE_TOKEN_BUDGET:
+                model_split_parse_texts = BatchSplitParser(
+                    splitter_parser,
+                    settings.SPLIT_PARSE_TOKEN_BUDGET
+                ).yield_split_parsed
+            else:
+                model_split_parse_texts = partial(
+                    map, splitter_parser.split_parse)
+
+        yield from model_split_parse_texts(texts)
+
+    cache = None
+    predictions = None
+    try:
+        if cache_path:
+            if client is not None:
+                model_version = client.get_model_version()
+            else:
+                model_version = get_model_version(get_multitask_config())
+            cache = SplitParseCache(cache_path, model_version)
+            cache.load()
+            predictions = cache.yield_split_parsed(
+                yield_texts(),
+                split_parse_texts,
+                settings.SPLIT_PARSE_CACHE_MAX_PENDING
+            )
+        else:
+            predictions = split_parse_texts(yield_texts())
+
+        t0 = time.time()
+        nb_references = 0
+        for i, first_window_predictions in enumerate(predictions):
+            doc, windows = documents.popleft()
+            window_predictions = [first_window_predictions] + [
+                next(predictions) for _ in windows[1:]
+            ]
+            reference_predictions = merge_window_predictions(
+                doc.section, windows, window_predictions)
+            splitted_references, structured_references = \
+                transform_reference_predictions(doc, reference_predictions)
+
+            logger.info('[+] Extracted {} references from document {}'.format(
+                len(splitted_references['references']),
+                i
+            ))
+
+            yield splitted_references, structured_references
+
+            nb_references += len(splitted_references['references'])
+
+        t1 = time.time()
+        total = t1-t0
+
+        logger.info(
+            "Time taken to predict for %s is %s",
+            str(nb_references),
+            str(total)
+        )
+
+        if cache is not None:
+            cache.log_stats(logger)
+            cache.save()
+        if workers is not None:
+            workers.shutdown()
+    finally:
+        if predictions is not None:
+            predictions.close()
+        if workers is not None:
+            workers.terminate()
+        if cache is not None:
+            cache.close()
+        if client is not None:
+            client.close()
+
+
+def parse_references(scraper_file, logger, num_workers=1, cache_path=None,
+                     model_socket=None):
 
     """
     Entry point for reference parser.
     Args:
         scraper_file: path / S3 url to scraper results file
         logger: logging configuration name
+        num_workers: number of processes to split and parse with
+        cache_path: see yield_structured_references
+        model_socket: see yield_structured_references
     """
 
     yield from yield_structured_references(
-        scraper_file, logger)
+        scraper_file, logger, num_workers, cache_path, model_socket)
 
 #
 # Module entry points
@@ -231,6 +586,25 @@ def fuzzy_match_reference(fuzzy_matcher, reference):
     """
     return fuzzy_matcher.match(reference)
 
+def fuzzy_match_references(fuzzy_matcher, references):
+    """
+    Args:
+        fuzzy_matcher: instance of FuzzyMatcher, with index of publications in place.
+        references: list of references
+    Returns:
+        list of matched references (citations) or None, one per reference.
+    """
+    return fuzzy_matcher.match_many(references)
+
+def yield_chunks(iterable, chunk_size):
+    """ Yield lists of up to chunk_size consecutive items from iterable. """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
 def exact_match_publication(exact_matcher, publication):
     """
     Args:
@@ -241,12 +615,25 @@ def exact_match_publication(exact_matcher, publication):
     """
     return exact_matcher.match(publication)
 
+def exact_match_publications(exact_matcher, publications, num_workers=1):
+    """
+    Args:
+        exact_matcher: instance of ExactMatcher, with index of documents in place.
+        publications: list of publications
+        num_workers: number of processes to match documents with
+    Returns:
+        matched references (citations) of all publications, including
+        publication & doc id.
+    """
+    return exact_matcher.match_all(publications, num_workers)
+
 #
 # CLI functions
 #
 
 def refparse(scraper_file, publications_file,
-              output_dir, logger):
+              output_dir, logger, fuzzy_index_dir=None, num_workers=1,
+              split_parse_cache_dir=None, model_socket=None):
 
     # Loading the references file
     publications_df = get_file(publications_file, 'csv')
@@ -266,43 +653,64 @@ def refparse(scraper_file, publications_file,
         f"exact_{settings.MATCHED_REFS_FILENAME}"
     )
 
-    fuzzy_matcher = FuzzyMatcher(
-        publications,
-        settings.FUZZYMATCH_SIMILARITY_THRESHOLD
-    )
+    if settings.FUZZYMATCH_NB_SHARDS > 1:
+        fuzzy_matcher = ShardedFuzzyMatcher(
+            publications,
+            settings.FUZZYMATCH_SIMILARITY_THRESHOLD,
+            index_path=fuzzy_index_dir,
+            nb_shards=settings.FUZZYMATCH_NB_SHARDS
+        )
+    else:
+        fuzzy_matcher = FuzzyMatcher(
+            publications,
+            settings.FUZZYMATCH_SIMILARITY_THRESHOLD,
+            index_path=fuzzy_index_dir
+        )
 
     with open(structured_references_filepath, 'w') as srefs_f:
         with open(fuzzy_matched_references_filepath, 'w') as fmrefs_f:
 
             refs = parse_references(
-                scraper_file, logger)
-            for structured_references in refs:
-                for structured_reference in structured_references:
-
-                    fuzzy_matched_reference = fuzzy_match_reference(
-                        fuzzy_matcher,
-                        structured_reference
-                    )
+                scraper_file, logger, num_workers, split_parse_cache_dir,
+                model_socket)
+            structured_references = (
+                structured_reference
+                for _, doc_structured_references in refs
+                for structured_reference in doc_structured_references
+            )
+            chunks = yield_chunks(
+                structured_references,
+                settings.FUZZYMATCH_BATCH_SIZE
+            )
+            for chunk in chunks:
+                fuzzy_matched_references = fuzzy_match_references(
+                    fuzzy_matcher,
+                    chunk
+                )
+                for structured_reference, fuzzy_matched_reference in zip(
+                        chunk, fuzzy_matched_references):
                     if fuzzy_matched_reference:
                         fmrefs_f.write(json.dumps(fuzzy_matched_reference)+'\n')
                     if structured_reference:
                         srefs_f.write(json.dumps(structured_reference)+'\n')
 
-    scraper_file = get_file(
-        scraper_file, "",
-        get_scraped=True,
-        scraping_columns=('title', 'file_hash', 'uri', 'text')
-        )
+    fuzzy_matcher.close()
 
-    document_texts = transform_scraper_text_file(scraper_file)
+    document_texts = transform_scraper_text_file(
+        yield_scraper_file(scraper_file, TEXT_SCRAPING_COLUMNS)
+    )
+    # The matcher keeps its own copy of the cleaned texts, in a
+    # memory-mapped file, as they are streamed
     exact_matcher = ExactMatcher(document_texts, settings.MATCH_TITLE_LENGTH_THRESHOLD)
 
     with open(exact_matched_reference_filepath, 'w') as emrefs_f:
-        for publication in publications:
-            exact_matched_references = exact_match_publication(exact_matcher, publication)
-            for exact_matched_reference in exact_matched_references:
-                if exact_matched_reference:
-                    emrefs_f.write(json.dumps(exact_matched_reference)+'\n')
+        exact_matched_references = exact_match_publications(
+            exact_matcher, publications, num_workers)
+        for exact_matched_reference in exact_matched_references:
+            if exact_matched_reference:
+                emrefs_f.write(json.dumps(exact_matched_reference)+'\n')
+
+    exact_matcher.close()
 
 def refparse_profile(scraper_file, references_file,
                         output_dir, logger):
@@ -342,6 +750,27 @@ def create_argparser(description):
         type=int
     )
 
+    parser.add_argument(
+        '--fuzzy-index-dir',
+        help='Directory to keep the fuzzy matcher index of the references'
+             ' in, so that it is only rebuilt when they change',
+        default=None
+    )
+
+    parser.add_argument(
+        '--split-parse-cache-dir',
+        help='Path or S3 URL to keep split and parsed sections in, so that'
+             ' only new or changed sections are run through the model',
+        default=None
+    )
+
+    parser.add_argument(
+        '--model-socket',
+        help='Unix socket of a split/parse model server to use rather than'
+             ' loading the model, see refparse.split_parse_server',
+        default=None
+    )
+
     return parser
 
 
@@ -387,7 +816,11 @@ if __name__ == '__main__':
                 args.scraper_file,
                 args.references_file,
                 args.output_dir,
-                logger
+                logger,
+                fuzzy_index_dir=args.fuzzy_index_dir,
+                num_workers=args.num_workers or 1,
+                split_parse_cache_dir=args.split_parse_cache_dir,
+                model_socket=args.model_socket
             )
 
     except Exception as e:
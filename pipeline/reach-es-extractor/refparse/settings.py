@@ -8,6 +8,27 @@ class BaseSettings:
 
     PREDICTION_PROBABILITY_THRESHOLD = 0.75
     FUZZYMATCH_SIMILARITY_THRESHOLD = 0.8
+    FUZZYMATCH_BATCH_SIZE = 1000
+    # Split publications across this many processes when fuzzy matching
+    FUZZYMATCH_NB_SHARDS = 1
+    # Run the sections of several documents through the split/parse model
+    # at once, up to this many tokens. 0 to split and parse them one by one.
+    SPLIT_PARSE_TOKEN_BUDGET = 0
+    # Split and parse sections longer than this many characters, e.g.
+    # 100000, in windows overlapping by SPLIT_PARSE_WINDOW_OVERLAP
+    # characters. 0 to truncate them to SPLIT_PARSE_MAX_SECTION_LENGTH
+    # characters instead.
+    SPLIT_PARSE_WINDOW_SIZE = 0
+    SPLIT_PARSE_WINDOW_OVERLAP = 5000
+    SPLIT_PARSE_MAX_SECTION_LENGTH = 1000000
+    # Default Unix socket of the split/parse model server
+    SPLIT_PARSE_SOCKET = '/tmp/refparse-split-parse.sock'
+    # Seconds to wait on split/parse worker processes before checking
+    # that they are still alive
+    SPLIT_PARSE_WORKER_POLL_INTERVAL = 10
+    # Maximum number of section texts read ahead of the predictions yielded
+    # when using the split/parse cache
+    SPLIT_PARSE_CACHE_MAX_PENDING = 1000
 
     BUCKET = "datalabs-data"
 
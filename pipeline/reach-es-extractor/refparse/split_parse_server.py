@@ -0,0 +1,132 @@
+"""Serve split/parse requests over a Unix socket, loading the deep reference
+parser model once, so that refparse and ExtractRefsOperator runs don't each
+pay for importing tensorflow and loading the model. See SplitParseClient.
+"""
+
+from argparse import ArgumentParser
+import os
+import socketserver
+import threading
+import traceback
+
+import sentry_sdk
+
+from .utils import BatchSplitParser, get_model_version
+from .utils.split_parse_client import send_message, recv_message
+from .settings import settings
+
+
+class SplitParseHandler(socketserver.BaseRequestHandler):
+    """
+    Answers the requests of a client connection until it is closed:
+        {"command": "split_parse", "texts": [...]}
+            -> {"predictions": [split_parse(text) for each text]}
+        {"command": "model_version"}
+            -> {"model_version": ...}
+    Failed requests are answered with {"error": traceback}.
+    """
+
+    def handle(self):
+        while True:
+            message = recv_message(self.request)
+            if message is None:
+                return
+
+            try:
+                response = self.server.answer(message)
+            except Exception:
+                self.server.logger.exception('Failed to answer request')
+                response = {'error': traceback.format_exc()}
+            send_message(self.request, response)
+
+
+def load_model():
+    """ Return a deep_reference_parser SplitParser and its model version,
+    see get_model_version.
+    """
+    # Imported here, as loading tensorflow is slow
+    from deep_reference_parser.split_parse import SplitParser
+    from deep_reference_parser.common import MULTITASK_CFG
+
+    return SplitParser(config_file=MULTITASK_CFG), \
+        get_model_version(MULTITASK_CFG)
+
+
+class SplitParseServer(socketserver.ThreadingUnixStreamServer):
+    """
+    Unix socket server answering split/parse requests with a model loaded
+    once. Each connection is served on its own thread, so that a client
+    holding its connection for a whole run doesn't keep others waiting,
+    but the model runs one request at a time.
+
+    Args:
+        socket_path: path of the Unix socket to listen on
+        logger: logger
+        splitter_parser: deep_reference_parser SplitParser
+        model_version: version of its model, see get_model_version
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, logger, splitter_parser, model_version):
+        self.logger = logger
+        self.model_version = model_version
+        self.splitter_parser = splitter_parser
+        self.batch_split_parser = BatchSplitParser(
+            self.splitter_parser,
+            settings.SPLIT_PARSE_TOKEN_BUDGET
+        ) if settings.SPLIT_PARSE_TOKEN_BUDGET else None
+        self.model_lock = threading.Lock()
+
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, SplitParseHandler)
+
+    def answer(self, message):
+        command = message.get('command')
+        if command == 'model_version':
+            return {'model_version': self.model_version}
+        if command == 'split_parse':
+            with self.model_lock:
+                if self.batch_split_parser is not None:
+                    predictions = list(
+                        self.batch_split_parser.yield_split_parsed(
+                            message['texts']))
+                else:
+                    predictions = [
+                        self.splitter_parser.split_parse(text)
+                        for text in message['texts']
+                    ]
+            self.logger.info(
+                '[+] Split and parsed %d sections', len(predictions))
+            return {'predictions': predictions}
+        raise ValueError('Unknown command: %r' % command)
+
+
+if __name__ == '__main__':
+    import logging
+    logging.basicConfig(format='[%(asctime)s]:%(levelname)s - %(message)s')
+    logger = settings.logger
+    logger.setLevel('INFO')
+
+    if 'SENTRY_DSN' in os.environ:
+        logger.info("[+] Initialising Sentry")
+        sentry_sdk.init(os.environ['SENTRY_DSN'])
+
+    parser = ArgumentParser(description=__doc__.strip())
+    parser.add_argument(
+        '--socket',
+        help='Path of the Unix socket to listen on',
+        default=settings.SPLIT_PARSE_SOCKET
+    )
+    args = parser.parse_args()
+
+    splitter_parser, model_version = load_model()
+    server = SplitParseServer(
+        args.socket, logger, splitter_parser, model_version)
+    logger.info('[+] Serving split/parse requests on %s', args.socket)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(args.socket)
@@ -0,0 +1,109 @@
+import pytest
+
+from refparse.utils import BatchSplitParser
+
+
+class FakeModel:
+    """ Stands in for a deep_reference_parser model, labelling each token
+    on its own, in rows of max_len tokens.
+    """
+
+    max_len = 4
+
+    def __init__(self):
+        self.calls = []
+
+    def predict(self, tokens, load_weights=False):
+        self.calls.append(len(tokens))
+        split_labels = [
+            'b-r' if token[:1].isupper() else 'i-r' for token in tokens]
+        parse_labels = [
+            'year' if token.isdigit() else 'title' for token in tokens]
+        return [split_labels, parse_labels]
+
+
+class FakeSplitParser:
+    """ Stands in for deep_reference_parser's SplitParser, making a single
+    drp.predict call per section. """
+
+    def __init__(self):
+        self.drp = FakeModel()
+
+    def split_parse(self, text):
+        tokens = text.split()
+        if not tokens:
+            return []
+        split_labels, parse_labels = self.drp.predict(
+            tokens, load_weights=True)
+
+        references = []
+        for token, split_label, parse_label in zip(
+                tokens, split_labels, parse_labels):
+            if split_label == 'b-r' or not references:
+                references.append({'Reference': [], 'Attributes': []})
+            references[-1]['Reference'].append(token)
+            references[-1]['Attributes'].append((token, parse_label))
+        for reference in references:
+            reference['Reference'] = ' '.join(reference['Reference'])
+        return references
+
+
+@pytest.fixture
+def texts():
+    return [
+        'Malaria in Africa 2010 Zika outbreaks 2016',
+        '',
+        'Ebola',
+        'Tuberculosis treatment outcomes in children 2001',
+        'Cholera 1999 Measles vaccination coverage',
+    ]
+
+
+def test_batched_equals_one_by_one(texts):
+    expected = [FakeSplitParser().split_parse(text) for text in texts]
+
+    splitter_parser = FakeSplitParser()
+    batch_split_parser = BatchSplitParser(splitter_parser, 1000)
+    assert list(batch_split_parser.yield_split_parsed(texts)) == expected
+    # A model call for the section before the empty one, and another for
+    # the three after it, each padded to whole rows of 4 tokens
+    assert splitter_parser.drp.calls == [7, 4 + 8 + 8]
+
+def test_token_budget(texts):
+    splitter_parser = FakeSplitParser()
+    batch_split_parser = BatchSplitParser(splitter_parser, 8)
+    results = list(batch_split_parser.yield_split_parsed(texts))
+    assert results == [FakeSplitParser().split_parse(text) for text in texts]
+    assert all(nb_tokens <= 8 for nb_tokens in splitter_parser.drp.calls)
+
+def test_predict_restored(texts):
+    splitter_parser = FakeSplitParser()
+    batch_split_parser = BatchSplitParser(splitter_parser, 1000)
+    list(batch_split_parser.yield_split_parsed(texts))
+
+    splitter_parser.drp.calls = []
+    splitter_parser.split_parse('Malaria')
+    assert splitter_parser.drp.calls == [1]
+
+def test_misaligned_predictions(monkeypatch, texts):
+    splitter_parser = FakeSplitParser()
+    model_predict = splitter_parser.drp.predict
+
+    def predict(tokens, load_weights=False):
+        predictions = model_predict(tokens, load_weights)
+        if len(tokens) > 8:
+            return [labels[:-1] for labels in predictions]
+        return predictions
+    monkeypatch.setattr(splitter_parser.drp, 'predict', predict)
+
+    batch_split_parser = BatchSplitParser(splitter_parser, 1000)
+    results = list(batch_split_parser.yield_split_parsed(texts))
+    assert results == [FakeSplitParser().split_parse(text) for text in texts]
+
+def test_without_model(texts):
+    splitter_parser = FakeSplitParser()
+    del splitter_parser.drp
+    splitter_parser.split_parse = lambda text: [{'Reference': text}]
+    batch_split_parser = BatchSplitParser(splitter_parser, 1000)
+    assert list(batch_split_parser.yield_split_parsed(texts)) == [
+        [{'Reference': text}] for text in texts]
@@ -1,10 +1,14 @@
+import multiprocessing
+import pickle
 import unittest
 from collections import namedtuple
+from unittest import mock
 
 from pandas.util.testing import assert_frame_equal
 import pandas as pd
 
 from refparse.utils import ExactMatcher
+from refparse.utils import exact_match
 from refparse.settings import settings
 
 SectionedDocument = namedtuple(
@@ -36,7 +40,7 @@ class TestExactMatcherInit(unittest.TestCase):
             ]
         threshold = 3
         exact_matcher = ExactMatcher(doc_texts, threshold)
-        self.assertEqual(exact_matcher.texts, [(123, "malaria")])
+        self.assertEqual(list(exact_matcher.texts), [(123, "malaria")])
         self.assertEqual(
             exact_matcher.title_length_threshold, threshold
         )
@@ -98,3 +102,78 @@ class TestExactMatch(unittest.TestCase):
         }
         matched_text_generator = exact_matcher.match(publication)
         self.assertEqual(len(list(matched_text_generator)), 0)
+
+
+class TestExactMatchAll(unittest.TestCase):
+    def test_same_matches_as_match(self):
+        doc_texts = [
+            SectionedDocument("Malaria in Africa. Zika in-Brazil", 123),
+            SectionedDocument("Zika in Brazil and malaria in Africa", 456),
+            SectionedDocument("Ebola", 789),
+            ]
+        publications = [
+            {'uber_id': 1, 'title': "Malaria in Africa"},
+            {'uber_id': 2, 'title': "Zika in Brazil"},
+            {'uber_id': 3, 'title': "Malaria in Africa"},
+            {'uber_id': 4, 'title': "Yellow fever"},
+            {'uber_id': 5, 'title': "in"},
+        ]
+        threshold = 3
+        exact_matcher = ExactMatcher(doc_texts, threshold)
+
+        expected = [
+            matched_reference
+            for publication in publications
+            for matched_reference in exact_matcher.match(publication)
+        ]
+        matched_references = list(exact_matcher.match_all(publications))
+
+        def key(matched_reference):
+            return (
+                matched_reference['Document id'],
+                matched_reference['Matched publication id']
+            )
+        self.assertEqual(len(matched_references), 5)
+        self.assertEqual(
+            sorted(matched_references, key=key),
+            sorted(expected, key=key)
+        )
+
+    def test_parallel_same_matches(self):
+        doc_texts = [
+            SectionedDocument("Malaria in Africa %d" % i, i)
+            for i in range(20)
+            ]
+        publications = [
+            {'uber_id': 1, 'title': "Malaria in Africa"},
+            {'uber_id': 2, 'title': "Africa 1"},
+        ]
+        exact_matcher = ExactMatcher(doc_texts, 3)
+
+        self.assertEqual(
+            list(exact_matcher.match_all(publications, num_workers=3)),
+            list(exact_matcher.match_all(publications))
+        )
+
+    def test_parallel_workers_spawned(self):
+        doc_texts = [
+            SectionedDocument("Malaria in Africa %d" % i, i)
+            for i in range(4)
+            ]
+        publications = [{'uber_id': 1, 'title': "Malaria in Africa"}]
+        exact_matcher = ExactMatcher(doc_texts, 3)
+
+        with mock.patch.object(
+                exact_match.multiprocessing, 'get_context',
+                wraps=multiprocessing.get_context) as get_context:
+            matched_references = list(
+                exact_matcher.match_all(publications, num_workers=2))
+        get_context.assert_called_once_with('spawn')
+        self.assertEqual(len(matched_references), 4)
+
+    def test_text_store_pickle(self):
+        doc_texts = [SectionedDocument("Malaria", 1), SectionedDocument("", 2)]
+        texts = ExactMatcher(doc_texts, 3).texts
+        unpickled = pickle.loads(pickle.dumps(texts))
+        self.assertEqual(list(unpickled), [(1, 'malaria'), (2, '')])
+        unpickled.close()
@@ -0,0 +1,130 @@
+import io
+import threading
+
+import pytest
+
+import extract_refs_task
+from extract_refs_task import ExtractRefsOperator, ReferencesWriter, read_ahead
+from hooks.s3hook import GzipJsonWriter
+from refparse import refparse as refparse_module
+
+
+class FailingWriter:
+    def __init__(self, fail_after):
+        self.records = []
+        self.fail_after = fail_after
+
+    def write(self, record):
+        if len(self.records) == self.fail_after:
+            raise IOError('Upload failed')
+        self.records.append(record)
+
+
+def test_references_writer():
+    split_writer = FailingWriter(None)
+    parsed_writer = FailingWriter(None)
+    writer = ReferencesWriter(split_writer, parsed_writer, 2)
+    writer.start()
+    for i in range(10):
+        writer.queue.put(({'doc': i}, [{'ref': i}, {'ref': -i}]))
+    writer.queue.put(None)
+    writer.join()
+    assert split_writer.records == [{'doc': i} for i in range(10)]
+    assert len(parsed_writer.records) == 20
+
+def test_references_writer_error():
+    writer = ReferencesWriter(FailingWriter(3), FailingWriter(None), 2)
+    writer.start()
+
+    def produce():
+        # Many more items than the queue holds
+        for i in range(100):
+            writer.queue.put(({'doc': i}, []))
+        writer.queue.put(None)
+    producer = threading.Thread(target=produce)
+    producer.start()
+    producer.join(10)
+    assert not producer.is_alive()
+
+    with pytest.raises(IOError):
+        writer.join()
+
+def test_references_writer_join_timeout():
+    writer = ReferencesWriter(FailingWriter(0), FailingWriter(None), 2)
+    writer.start()
+    writer.queue.put(({'doc': 0}, []))
+    # Still running, so no error yet
+    writer.join(0.1)
+    assert writer.is_alive()
+    writer.queue.put(None)
+    with pytest.raises(IOError):
+        writer.join()
+
+
+def failing_iterable():
+    yield 1
+    yield 2
+    raise ValueError('Failed to read')
+
+def test_read_ahead():
+    assert list(read_ahead(iter(range(100)), 4)) == list(range(100))
+
+def test_read_ahead_error():
+    items = read_ahead(failing_iterable(), 4)
+    assert next(items) == 1
+    assert next(items) == 2
+    with pytest.raises(ValueError):
+        next(items)
+
+
+class FakeUploadStream(io.BytesIO):
+    def __init__(self, uploads, key):
+        super().__init__()
+        self.uploads = uploads
+        self.key = key
+
+    def close(self):
+        if not self.closed:
+            self.uploads[self.key] = 'completed'
+        super().close()
+
+    def abort(self):
+        self.uploads[self.key] = 'aborted'
+        super().close()
+
+
+class FakeS3Hook:
+    uploads = {}
+
+    def open_json_gz_writer(self, key):
+        return GzipJsonWriter(FakeUploadStream(self.uploads, key))
+
+
+@pytest.fixture
+def operator(monkeypatch):
+    FakeS3Hook.uploads = {}
+    monkeypatch.setattr(extract_refs_task, 'S3Hook', FakeS3Hook)
+    monkeypatch.setattr(
+        refparse_module, 'yield_scraper_file', lambda src: iter([]))
+    monkeypatch.setattr(
+        refparse_module, 'transform_scraper_file',
+        lambda documents: failing_iterable())
+
+    def yield_split_parsed_documents(documents, *args):
+        for i in documents:
+            yield {'doc': i}, [{'ref': i}]
+    monkeypatch.setattr(
+        refparse_module, 'yield_split_parsed_documents',
+        yield_split_parsed_documents)
+
+    return ExtractRefsOperator(
+        's3://bucket/src.json.gz', 's3://bucket/split.json.gz',
+        's3://bucket/parsed.json.gz', pipelined=True)
+
+def test_pipelined_read_error(operator):
+    with pytest.raises(ValueError):
+        operator.execute()
+    assert FakeS3Hook.uploads == {
+        's3://bucket/split.json.gz': 'aborted',
+        's3://bucket/parsed.json.gz': 'aborted',
+    }
@@ -0,0 +1,89 @@
+import gzip
+import io
+import json
+import os
+
+import pytest
+
+from refparse.utils import FileManager
+
+
+def write_lines(path, rows):
+    with gzip.open(path, 'wt') as f:
+        for row in rows:
+            f.write(json.dumps(row) + '\n')
+
+
+def test_yield_scraping_results(tmpdir):
+    rows = [
+        {'file_hash': 'a', 'sections': {'Reference': ['ref a']}, 'text': 'a'},
+        {'file_hash': 'b', 'sections': None, 'text': 'b'},
+    ]
+    write_lines(str(tmpdir.join('scraped.json.gz')), rows)
+
+    fm = FileManager('LOCAL')
+    results = fm.yield_scraping_results(
+        'scraped.json.gz', str(tmpdir), ('file_hash', 'sections'))
+    assert list(results) == [
+        {'file_hash': 'a', 'sections': {'Reference': ['ref a']}},
+        {'file_hash': 'b', 'sections': None},
+    ]
+
+def test_yield_scraping_results_is_lazy(tmpdir):
+    write_lines(
+        str(tmpdir.join('scraped.json.gz')),
+        ({'file_hash': str(i)} for i in range(3))
+    )
+    with gzip.open(str(tmpdir.join('scraped.json.gz')), 'ab') as f:
+        f.write(b'not json\n')
+
+    fm = FileManager('LOCAL')
+    results = fm.yield_scraping_results(
+        'scraped.json.gz', str(tmpdir), ('file_hash',))
+    assert next(results) == {'file_hash': '0'}
+
+
+class FakeBody(io.BytesIO):
+    """ Stands in for the streaming body of an S3 object. """
+
+    def iter_lines(self):
+        for line in self:
+            yield line.rstrip(b'\n')
+
+
+class FakeS3:
+    def __init__(self, objects):
+        self.objects = objects
+        self.bodies = []
+
+    def open(self, key):
+        body = FakeBody(self.objects[key])
+        self.bodies.append(body)
+        return body
+
+
+def s3_file_manager(objects):
+    fm = FileManager('LOCAL')
+    fm.mode = 'S3'
+    fm.s3 = FakeS3(objects)
+    return fm
+
+@pytest.mark.parametrize('file_name', ['scraped.json.gz', 'scraped.json'])
+def test_yield_scraping_results_from_s3(file_name):
+    data = b''.join(
+        json.dumps({'file_hash': str(i), 'text': os.urandom(500).hex()}).encode() + b'\n'
+        for i in range(1000)
+    )
+    if file_name.endswith('.gz'):
+        data = gzip.compress(data)
+    fm = s3_file_manager({'prefix/' + file_name: data})
+
+    results = fm.yield_scraping_results(file_name, 'prefix', ('file_hash',))
+    assert next(results) == {'file_hash': '0'}
+    # The object is streamed rather than downloaded first
+    body, = fm.s3.bodies
+    assert body.tell() < len(data)
+
+    assert [row['file_hash'] for row in results] == [
+        str(i) for i in range(1, 1000)]
+    assert body.closed
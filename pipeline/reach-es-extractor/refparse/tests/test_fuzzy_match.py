@@ -1,7 +1,8 @@
 import pandas as pd
 import pytest
 from pandas.util.testing import assert_frame_equal
-from refparse.utils import FuzzyMatcher
+from refparse.utils import FuzzyMatcher, ShardedFuzzyMatcher
+from refparse.utils.publication_store import PublicationStore
 
 
 @pytest.fixture
@@ -37,7 +38,8 @@ def test_init_variables():
 
     threshold = 0.75
     fuzzy_matcher = FuzzyMatcher(real_publications, threshold)
-    assert isinstance(fuzzy_matcher.publications, dict)
+    assert isinstance(fuzzy_matcher.publications, PublicationStore)
+    assert len(fuzzy_matcher.publications) == 2
     assert isinstance(fuzzy_matcher.publications[0], dict)
     assert fuzzy_matcher.publications[0] == real_publications[0]
     assert fuzzy_matcher.similarity_threshold == threshold
@@ -66,6 +68,21 @@ def test_one_match(fuzzy_matcher):
     matched_publication = fuzzy_matcher.match(reference)
     assert matched_publication['Document id'] == '10'
 
+def test_match_many(fuzzy_matcher):
+    references = [
+        {'Document id': '10', 'Reference id': '11', 'Title': 'Zika'},
+        {},
+        {'Document id': '10', 'Reference id': '12', 'Title': 'Ebola'},
+        {'Document id': '10', 'Reference id': '13', 'Title': 'Malaria'},
+    ]
+    matched_publications = fuzzy_matcher.match_many(references)
+    assert len(matched_publications) == 4
+    assert matched_publications[0]['Matched publication pmcid'] == 1
+    assert matched_publications[1] is None
+    assert matched_publications[2] is None
+    assert matched_publications[3]['Matched publication pmcid'] == 0
+    assert matched_publications[3]['Reference id'] == '13'
+
 def test_close_match():
     real_publications = [
         {'title': 'Malaria is caused by mosquitos', 'pmcid': 0},
@@ -96,3 +113,75 @@ def test_close_match_reverse(fuzzy_matcher):
 
     matched_publication = fuzzy_matcher.match(reference)
     assert matched_publication is None
+
+def test_index_path(tmp_path):
+    real_publications = [
+        {'title': 'Malaria', 'pmcid': 0},
+        {'title': 'Zika', 'pmcid': 1},
+    ]
+    reference = {
+        'Document id': '10',
+        'Reference id': '11',
+        'Title': 'Zika'
+    }
+    index_path = str(tmp_path / 'index')
+
+    fuzzy_matcher = FuzzyMatcher(
+        real_publications, similarity_threshold=0.75, index_path=index_path)
+    assert fuzzy_matcher.match(reference)['Matched publication pmcid'] == 1
+
+    # Loaded back from index_path
+    fuzzy_matcher = FuzzyMatcher(
+        real_publications, similarity_threshold=0.75, index_path=index_path)
+    assert fuzzy_matcher.match(reference)['Matched publication pmcid'] == 1
+
+    # Rebuilt as the publications changed
+    fuzzy_matcher = FuzzyMatcher(
+        real_publications[:1], similarity_threshold=0.75, index_path=index_path)
+    assert fuzzy_matcher.match(reference) is None
+
+def test_pruned_search():
+    real_publications = [
+        {'title': 'Malaria in Africa', 'pmcid': 0},
+        {'title': 'Zika in Brazil', 'pmcid': 1},
+        {'title': 'Malaria vaccines in Africa', 'pmcid': 2},
+        {'title': 'Ebola in Africa', 'pmcid': 3},
+    ]
+    fuzzy_matcher = FuzzyMatcher(real_publications, similarity_threshold=0.5)
+    titles = ['Malaria in Africa', 'Ebola in Brazil', 'Yellow fever']
+
+    full = fuzzy_matcher.search_publications_many(titles, nb_results=2)
+    pruned = fuzzy_matcher.search_publications_many(
+        titles, nb_results=2, min_similarity=0.5)
+    for (full_indices, full_similarities), (indices, similarities) in zip(
+            full, pruned):
+        above = full_similarities > 0.5
+        assert list(indices[above]) == list(full_indices[above])
+        assert list(similarities[above]) == pytest.approx(
+            list(full_similarities[above]))
+
+def test_sharded_match(tmp_path):
+    real_publications = [
+        {'title': 'Malaria in Africa', 'pmcid': 0},
+        {'title': 'Zika in Brazil', 'pmcid': 1},
+        {'title': 'Malaria vaccines in Africa', 'pmcid': 2},
+        {'title': 'Ebola in Africa', 'pmcid': 3},
+        {'title': 'Yellow fever', 'pmcid': 4},
+    ]
+    references = [
+        {'Document id': '10', 'Reference id': '11', 'Title': 'Yellow fever'},
+        {'Document id': '10', 'Reference id': '12', 'Title': 'Zika'},
+        {'Document id': '10', 'Reference id': '13', 'Title': 'Ebola in Africa'},
+    ]
+    fuzzy_matcher = FuzzyMatcher(real_publications, similarity_threshold=0.75)
+    sharded_fuzzy_matcher = ShardedFuzzyMatcher(
+        real_publications,
+        similarity_threshold=0.75,
+        index_path=str(tmp_path / 'index'),
+        nb_shards=2
+    )
+    try:
+        assert sharded_fuzzy_matcher.match_many(references) == \
+            fuzzy_matcher.match_many(references)
+    finally:
+        sharded_fuzzy_matcher.close()
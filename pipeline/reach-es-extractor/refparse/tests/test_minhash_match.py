@@ -0,0 +1,51 @@
+import pytest
+from refparse.utils import MinHashMatcher
+
+
+@pytest.fixture
+def minhash_matcher():
+    real_publications = [
+        {'title': 'Malaria transmission in sub-Saharan Africa', 'pmcid': 0},
+        {'title': 'Zika virus outbreaks in Brazil', 'pmcid': 1},
+    ]
+    return MinHashMatcher(real_publications, similarity_threshold=0.6)
+
+def test_empty_reference(minhash_matcher):
+    reference = {}
+    assert minhash_matcher.match(reference) is None
+
+def test_no_match(minhash_matcher):
+    reference = {
+        'Document id': 1,
+        'Reference id': 1,
+        'Title': 'Ebola vaccine trials in Guinea'
+    }
+    assert minhash_matcher.match(reference) is None
+
+def test_broken_words_match(minhash_matcher):
+    reference = {
+        'Document id': '10',
+        'Reference id': '11',
+        'Title': 'Malaria trans- mission in sub-Saha ran Africa'
+    }
+    matched_publication = minhash_matcher.match(reference)
+    assert matched_publication['Document id'] == '10'
+    assert matched_publication['Matched publication pmcid'] == 0
+    assert matched_publication['Match algorithm'] == 'MinHash match'
+
+def test_index_path(tmp_path):
+    real_publications = [
+        {'title': 'Zika virus outbreaks in Brazil', 'pmcid': 1},
+    ]
+    reference = {
+        'Document id': '10',
+        'Reference id': '11',
+        'Title': 'Zika virus out- breaks in Brazil'
+    }
+    index_path = str(tmp_path / 'index')
+
+    for _ in range(2):
+        minhash_matcher = MinHashMatcher(
+            real_publications, similarity_threshold=0.6, index_path=index_path)
+        matched_publication = minhash_matcher.match(reference)
+        assert matched_publication['Matched publication pmcid'] == 1
@@ -0,0 +1,70 @@
+import gzip
+import json
+import logging
+
+import pandas as pd
+import pytest
+
+from refparse import refparse as refparse_module
+from refparse.refparse import (SectionedDocument, refparse,
+                               transform_structured_references)
+from refparse.settings import settings
+
+
+def structured_reference(title):
+    reference = {ref_class: '' for ref_class in settings.REF_CLASSES}
+    reference['Title'] = title
+    return reference
+
+
+@pytest.fixture
+def parsed_documents():
+    doc = SectionedDocument(
+        'references', 'http://example.com/a.pdf', 'doc-a', {'title': 'A'})
+    splitted_references = [
+        'Malaria in sub-Saharan Africa. 2010.',
+        'A title nowhere to be found. 2011.',
+    ]
+    structured_references = transform_structured_references(
+        splitted_references,
+        [structured_reference('Malaria in sub-Saharan Africa'),
+         structured_reference('A title nowhere to be found')],
+        doc.id, doc.uri, doc.metadata
+    )
+    return [(doc, structured_references)]
+
+
+def test_refparse_fuzzy_match(tmpdir, monkeypatch, parsed_documents):
+    publications_file = str(tmpdir.join('publications.csv'))
+    pd.DataFrame([
+        {'title': 'Malaria in sub-Saharan Africa', 'uber_id': 1,
+         'pmid': '10'},
+        {'title': 'Zika virus transmission in Brazil', 'uber_id': 2,
+         'pmid': '20'},
+    ]).to_csv(publications_file, index=False)
+
+    scraper_file = str(tmpdir.join('scraped.json.gz'))
+    with gzip.open(scraper_file, 'wt') as f:
+        f.write(json.dumps({'file_hash': 'doc-a', 'text': 'No titles'}))
+        f.write('\n')
+
+    monkeypatch.setattr(
+        refparse_module, 'parse_references',
+        lambda *args, **kwargs: iter(parsed_documents))
+
+    refparse(
+        scraper_file, publications_file, str(tmpdir),
+        logging.getLogger(__name__))
+
+    with open(str(tmpdir.join(
+            'fuzzy_' + settings.MATCHED_REFS_FILENAME))) as f:
+        matched = [json.loads(line) for line in f]
+    reference = parsed_documents[0][1][0]
+    assert len(matched) == 1
+    assert matched[0]['Document id'] == 'doc-a'
+    assert matched[0]['Reference id'] == reference['reference_id']
+    assert matched[0]['Matched publication id'] == 1
+    assert matched[0]['Extracted title'] == 'Malaria in sub-Saharan Africa'
+
+    with open(str(tmpdir.join(settings.STRUCTURED_REFS_FILENAME))) as f:
+        assert len(f.readlines()) == 2
@@ -0,0 +1,105 @@
+import pytest
+from refparse.refparse import SectionedDocument, get_section_windows
+from refparse.settings import settings
+from refparse.utils import split_windows, merge_window_predictions
+from refparse.utils.section_windows import locate_references
+
+
+def split_parse(text):
+    """ Split references on lines, as a stand-in for the model. """
+    return [
+        {'Reference': ' '.join(line.split()), 'Attributes': []}
+        for line in text.split('\n') if line.strip()
+    ]
+
+
+@pytest.fixture
+def section():
+    return '\n'.join(
+        'Author {0}. Title number {0}. Journal {1} ({0})'.format(i, i % 7)
+        for i in range(200)
+    )
+
+
+def test_short_section():
+    assert split_windows('a\nb', 100, 10) == [(0, 3)]
+
+def test_windows_cover_section(section):
+    windows = split_windows(section, 500, 100)
+    assert windows[0][0] == 0
+    assert windows[-1][1] == len(section)
+    for (start, stop), (next_start, next_stop) in zip(windows, windows[1:]):
+        assert stop - start <= 500
+        assert stop - next_start >= 100
+        assert section[stop - 1] == '\n'
+        assert section[next_start - 1] == '\n'
+
+def test_invalid_overlap():
+    with pytest.raises(ValueError):
+        split_windows('abc', 10, 10)
+    with pytest.raises(ValueError):
+        split_windows('abc', 20, 10)
+
+def test_windows_with_distant_lines():
+    # The only line boundaries are too far from the ends of the windows to
+    # start or end them on
+    text = 'a\n' + 'b' * 200000 + '\nc'
+    assert split_windows(text, 100000, 5000) == [
+        (0, 100000), (95000, 195000), (190000, len(text))]
+
+def test_merged_references(section):
+    windows = split_windows(section, 500, 100)
+    window_predictions = [
+        split_parse(section[start:stop]) for start, stop in windows
+    ]
+    merged = merge_window_predictions(section, windows, window_predictions)
+    assert merged == split_parse(section)
+
+def test_merged_references_within_lines(section):
+    section = section.replace('\n', ' ')
+    windows = split_windows(section, 500, 100)
+    window_predictions = [
+        [
+            {'Reference': reference, 'Attributes': []}
+            for reference in section[start:stop].split('.')
+        ]
+        for start, stop in windows
+    ]
+    merged = merge_window_predictions(section, windows, window_predictions)
+    references = [reference['Reference'].strip() for reference in merged]
+    expected = [reference.strip() for reference in section.split('.')]
+    # References cut by a window boundary are kept whole from the window
+    # in which they start before the middle of the overlap
+    assert references == expected
+
+def test_locate_references():
+    text = 'Smith J. Malaria. 2010.\nJones K. Zika. 2016.\n'
+    predictions = [
+        {'Reference': 'Smith J. Malaria. 2010.'},
+        {'Reference': 'Jones K. Zika. 2016.'},
+    ]
+    assert locate_references(text, predictions) == [0, 24]
+
+def test_locate_references_ignores_distant_tokens():
+    # Tokens that can't be found near the previous reference are not looked
+    # for in the rest of the text, where they would match another reference
+    text = 'Smith J. Malaria. 2010.\n' + 'x' * 1000 + '\nMalariae 2016.'
+    predictions = [
+        {'Reference': 'Smith J. Malaria. 2010.'},
+        {'Reference': 'Malariae'},
+        {'Reference': 'Unrelated'},
+    ]
+    offsets = locate_references(text, predictions)
+    assert offsets == [0, 23, 23]
+
+def test_section_windows_setting(monkeypatch):
+    doc = SectionedDocument('a\n' * 100, None, 'doc', {})
+    monkeypatch.setattr(settings, 'SPLIT_PARSE_MAX_SECTION_LENGTH', 150)
+    # Off by default, only truncating sections
+    assert get_section_windows(doc) == [(0, 150)]
+
+    monkeypatch.setattr(settings, 'SPLIT_PARSE_WINDOW_SIZE', 100)
+    monkeypatch.setattr(settings, 'SPLIT_PARSE_WINDOW_OVERLAP', 10)
+    windows = get_section_windows(doc)
+    assert len(windows) == 3
+    assert windows[-1][1] == 200
@@ -0,0 +1,174 @@
+from itertools import islice
+
+import pytest
+from botocore.exceptions import ClientError
+from refparse.utils import SplitParseCache, get_model_version
+
+
+def split_parse(text):
+    return [
+        {'Reference': reference, 'Attributes': [[reference, 'title']]}
+        for reference in text.split('|')
+    ]
+
+
+class SplitParseCounter:
+    def __init__(self):
+        self.texts = []
+
+    def __call__(self, texts):
+        for text in texts:
+            self.texts.append(text)
+            yield split_parse(text)
+
+
+@pytest.fixture
+def texts():
+    return ['a|b', 'c', 'd|e|f', 'g']
+
+
+def test_predictions_in_order(tmpdir, texts):
+    cache = SplitParseCache(str(tmpdir), 'v1')
+    counter = SplitParseCounter()
+    predictions = list(cache.yield_split_parsed(texts, counter))
+    assert predictions == [split_parse(text) for text in texts]
+    assert counter.texts == texts
+
+def test_cached_across_runs(tmpdir, texts):
+    cache = SplitParseCache(str(tmpdir), 'v1')
+    list(cache.yield_split_parsed(texts, SplitParseCounter()))
+    cache.save()
+
+    cache = SplitParseCache(str(tmpdir), 'v1')
+    cache.load()
+    counter = SplitParseCounter()
+    new_texts = ['c', 'h|i', 'a|b']
+    predictions = list(cache.yield_split_parsed(new_texts, counter))
+    assert predictions == [split_parse(text) for text in new_texts]
+    assert counter.texts == ['h|i']
+    assert (cache.hits, cache.misses) == (2, 1)
+
+def test_model_version_change(tmpdir, texts):
+    cache = SplitParseCache(str(tmpdir), 'v1')
+    list(cache.yield_split_parsed(texts, SplitParseCounter()))
+    cache.save()
+
+    cache = SplitParseCache(str(tmpdir), 'v2')
+    cache.load()
+    counter = SplitParseCounter()
+    list(cache.yield_split_parsed(texts, counter))
+    assert counter.texts == texts
+
+class ReadAheadSplitParser:
+    """ split_parse_texts reading ahead up to batch_size texts before
+    yielding their predictions, like the workers or model server, and
+    recording how each call ended.
+    """
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.calls = []
+
+    def __call__(self, texts):
+        texts = iter(texts)
+        call = {'texts': [], 'ended': 'running'}
+        self.calls.append(call)
+        try:
+            while True:
+                batch = list(islice(texts, self.batch_size))
+                if not batch:
+                    break
+                call['texts'].extend(batch)
+                for text in batch:
+                    yield split_parse(text)
+            call['ended'] = 'finished'
+        finally:
+            if call['ended'] == 'running':
+                call['ended'] = 'closed'
+
+
+def test_bounded_lookahead(tmpdir):
+    cache = SplitParseCache(str(tmpdir), 'v1')
+    cached_texts = ['cached%d' % i for i in range(20)]
+    list(cache.yield_split_parsed(cached_texts, SplitParseCounter()))
+
+    texts = ['a'] + cached_texts[:10] + ['b', 'c'] + cached_texts[10:] + ['d']
+    read = []
+    def yield_texts():
+        for text in texts:
+            read.append(text)
+            yield text
+
+    split_parser = ReadAheadSplitParser(3)
+    predictions = []
+    for prediction in cache.yield_split_parsed(
+            yield_texts(), split_parser, max_pending=5):
+        # Texts read besides the one whose predictions are yielded
+        assert len(read) - len(predictions) - 1 <= 5
+        predictions.append(prediction)
+
+    assert predictions == [split_parse(text) for text in texts]
+    assert [call['texts'] for call in split_parser.calls] == \
+        [['a'], ['b', 'c'], ['d']]
+    assert [call['ended'] for call in split_parser.calls] == \
+        ['finished'] * 3
+
+def test_split_parse_texts_closed(tmpdir, texts):
+    cache = SplitParseCache(str(tmpdir), 'v1')
+    split_parser = ReadAheadSplitParser(2)
+    predictions = cache.yield_split_parsed(texts, split_parser)
+    assert next(predictions) == split_parse(texts[0])
+    predictions.close()
+    assert [call['ended'] for call in split_parser.calls] == ['closed']
+
+def test_missing_cache(tmpdir):
+    cache = SplitParseCache(str(tmpdir.join('missing')), 'v1')
+    cache.load()
+    assert cache.entries == {}
+
+def write_config(tmpdir, model_dir):
+    config_file = tmpdir.join('config.ini')
+    config_file.write('[build]\noutput_path = %s\n' % model_dir)
+    return str(config_file)
+
+def test_model_version_hashes_weights(tmpdir):
+    model_dir = tmpdir.mkdir('model')
+    config_file = write_config(tmpdir, str(model_dir))
+    model_dir.join('weights.h5').write_binary(b'weights')
+    model_dir.join('indices.pickle').write_binary(b'indices')
+    version = get_model_version(config_file)
+    assert get_model_version(config_file) == version
+
+    model_dir.join('weights.h5').write_binary(b'retrained weights')
+    assert get_model_version(config_file) != version
+
+def test_model_version_without_weights(tmpdir):
+    config_file = write_config(tmpdir, str(tmpdir.join('missing')))
+    version = get_model_version(config_file)
+    assert version == get_model_version(config_file)
+
+    tmpdir.join('config.ini').write('[build]\noutput_path = other\n')
+    assert get_model_version(config_file) != version
+
+
+class FakeS3:
+    def __init__(self, error_code):
+        self.error_code = error_code
+
+    def get(self, key, f):
+        raise ClientError(
+            {'Error': {'Code': self.error_code, 'Message': ''}}, 'HeadObject')
+
+
+@pytest.mark.parametrize('error_code', ['404', 'NoSuchKey'])
+def test_missing_s3_cache(monkeypatch, error_code):
+    cache = SplitParseCache('s3://bucket/cache', 'v1')
+    monkeypatch.setattr(
+        cache, 'get_s3', lambda: (FakeS3(error_code), 'cache/key'))
+    cache.load()
+    assert cache.entries == {}
+
+def test_s3_cache_error(monkeypatch):
+    cache = SplitParseCache('s3://bucket/cache', 'v1')
+    monkeypatch.setattr(cache, 'get_s3', lambda: (FakeS3('403'), 'cache/key'))
+    with pytest.raises(ClientError):
+        cache.load()
@@ -0,0 +1,54 @@
+import socket
+import threading
+
+import pytest
+from refparse.utils import SplitParseClient
+from refparse.utils.split_parse_client import send_message, recv_message
+
+
+def test_message_roundtrip():
+    left, right = socket.socketpair()
+    message = {'texts': ['a' * 100000, 'é']}
+    send_message(left, message)
+    assert recv_message(right) == message
+    left.close()
+    assert recv_message(right) is None
+
+
+@pytest.fixture
+def socket_path(tmpdir):
+    path = str(tmpdir.join('split_parse.sock'))
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+
+    def serve():
+        conn, _ = server.accept()
+        while True:
+            message = recv_message(conn)
+            if message is None:
+                break
+            if message['command'] == 'split_parse':
+                send_message(conn, {'predictions': [
+                    [{'Reference': text, 'Attributes': []}]
+                    for text in message['texts']
+                ]})
+            else:
+                send_message(conn, {'error': 'Unknown command'})
+        conn.close()
+
+    thread = threading.Thread(target=serve)
+    thread.start()
+    yield path
+    thread.join()
+    server.close()
+
+
+def test_client(socket_path):
+    client = SplitParseClient(socket_path, batch_size=2)
+    texts = ['a', 'b', 'c', 'd', 'e']
+    predictions = list(client.yield_split_parsed(texts))
+    assert [p[0]['Reference'] for p in predictions] == texts
+    with pytest.raises(RuntimeError):
+        client.get_model_version()
+    client.close()
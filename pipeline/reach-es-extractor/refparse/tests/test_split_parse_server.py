@@ -0,0 +1,71 @@
+import logging
+import threading
+
+import pytest
+from refparse.split_parse_server import SplitParseServer
+from refparse.utils import SplitParseClient
+
+logger = logging.getLogger(__name__)
+
+
+class StubSplitParser:
+    def split_parse(self, text):
+        if text == 'BOOM':
+            raise ValueError('Failed to split and parse')
+        return [
+            {'Reference': reference, 'Attributes': []}
+            for reference in text.split('|')
+        ]
+
+
+@pytest.fixture
+def server(tmpdir):
+    server = SplitParseServer(
+        str(tmpdir.join('split_parse.sock')), logger, StubSplitParser(), 'v1')
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def test_answer(tmpdir):
+    server = SplitParseServer(
+        str(tmpdir.join('split_parse.sock')), logger, StubSplitParser(), 'v1')
+    try:
+        assert server.answer({'command': 'model_version'}) == {
+            'model_version': 'v1'}
+        assert server.answer({'command': 'split_parse', 'texts': ['a|b']}) \
+            == {'predictions': [StubSplitParser().split_parse('a|b')]}
+        with pytest.raises(ValueError):
+            server.answer({'command': 'unknown'})
+    finally:
+        server.server_close()
+
+def test_error_response(server):
+    client = SplitParseClient(server.server_address, batch_size=2)
+    try:
+        with pytest.raises(RuntimeError, match='Failed to split and parse'):
+            client.split_parse_many(['a', 'BOOM'])
+        # The connection is still usable after an error
+        assert client.split_parse('a|b') == \
+            StubSplitParser().split_parse('a|b')
+    finally:
+        client.close()
+
+def test_concurrent_clients(server):
+    # A client holding its connection doesn't keep others waiting
+    first = SplitParseClient(server.server_address)
+    second = SplitParseClient(server.server_address)
+    try:
+        assert first.get_model_version() == 'v1'
+        second.sock.settimeout(5)
+        assert list(second.yield_split_parsed(['a', 'b|c'])) == [
+            StubSplitParser().split_parse('a'),
+            StubSplitParser().split_parse('b|c'),
+        ]
+        assert first.split_parse('d') == StubSplitParser().split_parse('d')
+    finally:
+        first.close()
+        second.close()
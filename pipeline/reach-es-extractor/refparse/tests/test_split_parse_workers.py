@@ -0,0 +1,89 @@
+import logging
+import os
+import time
+
+import pytest
+
+from refparse import refparse as refparse_module
+from refparse.refparse import SplitParseWorkers, yield_split_parsed_texts
+from refparse.settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+def split_parse(text):
+    return [{'Reference': reference} for reference in text.split('|')]
+
+
+def echo_worker(task_queue, result_queue):
+    """ Worker following the protocol of split_parse_worker, without
+    loading the model.
+    """
+    nb_documents = 0
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        i, text = task
+        if text == 'BOOM':
+            result_queue.put(('error', i, 'Traceback: BOOM'))
+            continue
+        # Finish out of order
+        time.sleep(0.01 * (i % 3))
+        result_queue.put(('result', i, split_parse(text)))
+        nb_documents += 1
+    result_queue.put(('summary', os.getpid(), (nb_documents, 0, 1.0)))
+
+
+def exiting_worker(task_queue, result_queue):
+    """ Worker dying as soon as it starts, e.g. on failing to load the
+    model. """
+
+
+def crashing_worker(task_queue, result_queue):
+    os._exit(3)
+
+
+@pytest.fixture
+def poll_interval(monkeypatch):
+    monkeypatch.setattr(settings, 'SPLIT_PARSE_WORKER_POLL_INTERVAL', 0.1)
+
+
+def test_results_in_order(monkeypatch, poll_interval):
+    monkeypatch.setattr(refparse_module, 'split_parse_worker', echo_worker)
+    texts = ['a%d|b%d' % (i, i) for i in range(50)]
+    results = list(yield_split_parsed_texts(iter(texts), 3, logger))
+    assert results == [split_parse(text) for text in texts]
+
+def test_workers_reused(monkeypatch, poll_interval, caplog):
+    monkeypatch.setattr(refparse_module, 'split_parse_worker', echo_worker)
+    caplog.set_level(logging.INFO)
+    texts = ['a%d|b%d' % (i, i) for i in range(10)]
+    with SplitParseWorkers(2, logger) as workers:
+        results = list(workers.yield_split_parsed(iter(texts[:4])))
+        results += list(workers.yield_split_parsed(iter([])))
+        results += list(workers.yield_split_parsed(iter(texts[4:])))
+    assert results == [split_parse(text) for text in texts]
+
+    summaries = [r for r in caplog.records if 'split and parsed' in r.message]
+    assert len(summaries) == 2
+    assert sum(r.args[1] for r in summaries) == 10
+
+def test_worker_error(monkeypatch, poll_interval):
+    monkeypatch.setattr(refparse_module, 'split_parse_worker', echo_worker)
+    with pytest.raises(RuntimeError, match='BOOM'):
+        list(yield_split_parsed_texts(iter(['a', 'BOOM', 'b']), 2, logger))
+
+@pytest.mark.parametrize('worker', [exiting_worker, crashing_worker])
+def test_dead_workers(monkeypatch, poll_interval, worker):
+    monkeypatch.setattr(refparse_module, 'split_parse_worker', worker)
+    # More texts than fit in the task queue, so that sending them would
+    # block forever if dead workers went unnoticed.
+    texts = iter(['a|b'] * 20)
+    with pytest.raises(RuntimeError, match='exited'):
+        list(yield_split_parsed_texts(texts, 2, logger))
+
+def test_dead_workers_without_texts(monkeypatch, poll_interval):
+    monkeypatch.setattr(refparse_module, 'split_parse_worker', crashing_worker)
+    with pytest.raises(RuntimeError, match='exited'):
+        list(yield_split_parsed_texts(iter([]), 2, logger))
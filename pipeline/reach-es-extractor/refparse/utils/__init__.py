@@ -1,14 +1,28 @@
 from .parse import structure_reference
 from .fuzzy_match import FuzzyMatcher
+from .sharded_fuzzy_match import ShardedFuzzyMatcher
+from .minhash_match import MinHashMatcher
 from .file_manager import FileManager
 from .serialiser import serialise_matched_reference, serialise_reference
 from .exact_match import ExactMatcher
+from .batch_split_parse import BatchSplitParser
+from .split_parse_cache import SplitParseCache, get_model_version
+from .section_windows import split_windows, merge_window_predictions
+from .split_parse_client import SplitParseClient
 
 __all__ = [
     structure_reference,
     FuzzyMatcher,
+    ShardedFuzzyMatcher,
+    MinHashMatcher,
     FileManager,
     serialise_matched_reference,
     serialise_reference,
-    ExactMatcher
+    ExactMatcher,
+    BatchSplitParser,
+    SplitParseCache,
+    get_model_version,
+    split_windows,
+    merge_window_predictions,
+    SplitParseClient
 ]
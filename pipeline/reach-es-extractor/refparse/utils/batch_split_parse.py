@@ -0,0 +1,148 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class _TokensRecorded(Exception):
+    def __init__(self, tokens, args, kwargs):
+        self.tokens = tokens
+        self.args = args
+        self.kwargs = kwargs
+
+
+class BatchSplitParser:
+    """
+    Runs the model of a deep_reference_parser SplitParser over the sections
+    of several documents at once, up to token_budget tokens, rather than
+    once per section, then scatters the predictions back to each section.
+
+    The SplitParser still tokenises each section and turns its predictions
+    into references, so results keep the format of split_parse. This relies
+    on split_parse making a single splitter_parser.drp.predict(tokens)
+    call, returning a list of label lists aligned with tokens, and on the
+    model predicting independent rows of drp.max_len tokens. The tokens of
+    each section are padded to whole rows, so that no row mixes sections.
+    If a batch can't be predicted this way, its sections are split and
+    parsed one by one.
+
+    Args:
+        splitter_parser: deep_reference_parser SplitParser
+        token_budget: maximum number of tokens to predict at once
+    """
+
+    # Pads the tokens of a section to whole model rows
+    PADDING_TOKEN = '\n'
+
+    def __init__(self, splitter_parser, token_budget):
+        self.splitter_parser = splitter_parser
+        self.token_budget = token_budget
+        self.model = getattr(splitter_parser, 'drp', None)
+        self.max_len = getattr(self.model, 'max_len', None)
+        self.batching = bool(self.max_len)
+        if not self.batching:
+            logger.warning(
+                'BatchSplitParser: model or its row length not found,'
+                ' splitting and parsing sections one by one'
+            )
+
+    def split_parse_with(self, text, predict):
+        """ Call split_parse on text with predict in place of the model's
+        predict method, which is put back afterwards.
+        """
+        model_predict = self.model.predict
+        self.model.predict = predict
+        try:
+            return self.splitter_parser.split_parse(text)
+        finally:
+            self.model.predict = model_predict
+
+    def tokenize(self, text):
+        """
+        Return the tokens split_parse predicts for text, with the extra
+        arguments it passes to predict, or the result of split_parse if it
+        returns without predicting.
+        """
+        def record_tokens(tokens, *args, **kwargs):
+            raise _TokensRecorded(tokens, args, kwargs)
+
+        try:
+            return None, self.split_parse_with(text, record_tokens)
+        except _TokensRecorded as recorded:
+            return recorded, None
+
+    def predict_batch(self, batch):
+        """
+        Split and parse a batch of (text, recorded tokens) with a single
+        model call.
+        """
+        all_tokens = []
+        bounds = []
+        for _, recorded in batch:
+            start = len(all_tokens)
+            all_tokens.extend(recorded.tokens)
+            bounds.append((start, len(all_tokens)))
+            padding = -len(all_tokens) % self.max_len
+            all_tokens.extend([self.PADDING_TOKEN] * padding)
+
+        recorded = batch[0][1]
+        predictions = self.model.predict(
+            all_tokens, *recorded.args, **recorded.kwargs)
+        if not all(len(labels) == len(all_tokens) for labels in predictions):
+            raise ValueError('Predictions not aligned with tokens')
+
+        results = []
+        for (text, recorded), (start, stop) in zip(batch, bounds):
+            section_predictions = [labels[start:stop] for labels in predictions]
+
+            def predict(tokens, *args, **kwargs):
+                if list(tokens) != list(recorded.tokens):
+                    raise ValueError('Tokens differ from the recorded ones')
+                return section_predictions
+
+            results.append(self.split_parse_with(text, predict))
+        return results
+
+    def split_parse_batch(self, batch):
+        if len(batch) > 1:
+            try:
+                return self.predict_batch(batch)
+            except Exception:
+                logger.exception(
+                    'BatchSplitParser: failed to predict a batch of %d'
+                    ' sections, splitting and parsing them one by one',
+                    len(batch)
+                )
+
+        return [self.splitter_parser.split_parse(text) for text, _ in batch]
+
+    def yield_split_parsed(self, texts):
+        """
+        Split and parse an iterable of texts, yielding back the result of
+        split_parse for each text in the same order.
+        """
+        if not self.batching:
+            for text in texts:
+                yield self.splitter_parser.split_parse(text)
+            return
+
+        batch = []
+        nb_tokens = 0
+        for text in texts:
+            recorded, result = self.tokenize(text)
+            if recorded is None:
+                # Nothing to predict, e.g. for an empty section
+                yield from self.split_parse_batch(batch)
+                batch = []
+                nb_tokens = 0
+                yield result
+                continue
+
+            nb_rows = -(-len(recorded.tokens) // self.max_len)
+            if batch and nb_tokens + nb_rows * self.max_len > self.token_budget:
+                yield from self.split_parse_batch(batch)
+                batch = []
+                nb_tokens = 0
+            batch.append((text, recorded))
+            nb_tokens += nb_rows * self.max_len
+
+        yield from self.split_parse_batch(batch)
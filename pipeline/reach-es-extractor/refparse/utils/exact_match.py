@@ -1,11 +1,95 @@
+import array
+import mmap
+import multiprocessing
 import re
+import tempfile
+
+import ahocorasick
+
+# State of ExactMatcher.match_all, sent once to each of its worker
+# processes
+_shared_state = None
+
+
+def _init_worker(shared_state):
+  global _shared_state
+  _shared_state = shared_state
+
+
+def _match_documents(document_range):
+  exact_matcher, automaton, empty_title_ids = _shared_state
+  return list(exact_matcher.match_documents(
+    automaton, empty_title_ids, *document_range
+  ))
+
+
+class TextStore:
+  """
+  Read-only sequence of (document id, text) pairs. The texts are written
+  one after the other to a temporary file, which is memory-mapped, so
+  that they only take memory while they are being read. Unpickling a
+  TextStore, e.g. in another process, maps the same file.
+  """
+  def __init__(self, texts):
+    self.ids = []
+    self.offsets = array.array('q', [0])
+    self.file = tempfile.NamedTemporaryFile()
+    for doc_id, text in texts:
+      encoded = text.encode('utf-8')
+      self.file.write(encoded)
+      self.ids.append(doc_id)
+      self.offsets.append(self.offsets[-1] + len(encoded))
+    self.file.flush()
+    self.map_file()
+
+  def __getstate__(self):
+    return {'ids': self.ids, 'offsets': self.offsets, 'path': self.file.name}
+
+  def __setstate__(self, state):
+    self.ids = state['ids']
+    self.offsets = state['offsets']
+    self.file = open(state['path'], 'rb')
+    self.map_file()
+
+  def map_file(self):
+    if self.offsets[-1]:
+      self.buffer = mmap.mmap(
+        self.file.fileno(), 0, access=mmap.ACCESS_READ
+      )
+    else:
+      # Empty files can't be memory-mapped
+      self.buffer = b''
+
+  def __len__(self):
+    return len(self.ids)
+
+  def __getitem__(self, i):
+    start, stop = self.offsets[i], self.offsets[i + 1]
+    return self.ids[i], self.buffer[start:stop].decode('utf-8')
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self[i]
+
+  def contains(self, i, string):
+    """
+    Whether text i contains string, searching the buffer in place.
+    """
+    start, stop = self.offsets[i], self.offsets[i + 1]
+    return self.buffer.find(string.encode('utf-8'), start, stop) != -1
+
+  def close(self):
+    if isinstance(self.buffer, mmap.mmap):
+      self.buffer.close()
+    self.file.close()
+
 
 class ExactMatcher:
   def __init__(self, sectioned_documents, title_length_threshold):
-    self.texts = [
+    self.texts = TextStore(
       (doc.id, self.clean_text(doc.section))
       for doc in sectioned_documents
-    ]
+    )
     self.title_length_threshold = title_length_threshold
 
   def clean_text(self, string):
@@ -37,9 +121,9 @@ class ExactMatcher:
     if len(publication_title) < self.title_length_threshold:
       return
 
-    for doc_id, text in self.texts:
+    for i, doc_id in enumerate(self.texts.ids):
 
-      if publication_title in text:
+      if self.texts.contains(i, publication_title):
         yield {
           'Document id': doc_id,
           'Matched title': publication_title,
@@ -48,3 +132,113 @@ class ExactMatcher:
         }
 
     return
+
+  def build_automaton(self, publications):
+    """
+    Input:
+      publications: iterable of dicts that contain title and uber_id of
+        academic publications
+    Output:
+      automaton: Aho-Corasick automaton of the cleaned publication titles
+        long enough to be matched, with the ids of their publications
+      empty_title_ids: ids of publications with an empty cleaned title,
+        which is in every text
+    """
+    automaton = ahocorasick.Automaton()
+    empty_title_ids = []
+    for publication in publications:
+      publication_title = self.clean_text(publication['title'])
+      if len(publication_title) < self.title_length_threshold:
+        continue
+      if not publication_title:
+        empty_title_ids.append(publication['uber_id'])
+        continue
+
+      if publication_title in automaton:
+        automaton.get(publication_title)[1].append(publication['uber_id'])
+      else:
+        automaton.add_word(
+          publication_title,
+          (publication_title, [publication['uber_id']])
+        )
+
+    if len(automaton):
+      automaton.make_automaton()
+
+    return automaton, empty_title_ids
+
+  def match_documents(self, automaton, empty_title_ids, start, stop):
+    """
+    Input:
+      automaton, empty_title_ids: as returned by build_automaton
+      start, stop: range of the documents to match
+    Output:
+      matched_references: dicts that link academic publications with the
+        policy documents in the range
+    """
+    for i in range(start, stop):
+      doc_id, text = self.texts[i]
+      matched_titles = set()
+      if len(automaton):
+        for _, (publication_title, publication_ids) in automaton.iter(text):
+          if publication_title in matched_titles:
+            continue
+          matched_titles.add(publication_title)
+
+          for publication_id in publication_ids:
+            yield {
+              'Document id': doc_id,
+              'Matched title': publication_title,
+              'Matched publication id': publication_id,
+              'Match algorithm': 'Exact match'
+            }
+
+      for publication_id in empty_title_ids:
+        yield {
+          'Document id': doc_id,
+          'Matched title': '',
+          'Matched publication id': publication_id,
+          'Match algorithm': 'Exact match'
+        }
+
+  def match_all(self, publications, num_workers=1):
+    """
+    Input:
+      publications: iterable of dicts that contain title and uber_id of
+        academic publications
+      num_workers: number of processes to split the documents across
+    Output:
+      matched_references: the dicts yielded by match for all publications,
+        found by streaming each document text once through an Aho-Corasick
+        automaton of all publication titles
+    """
+    automaton, empty_title_ids = self.build_automaton(publications)
+    nb_texts = len(self.texts)
+    if num_workers <= 1 or nb_texts <= 1:
+      yield from self.match_documents(
+        automaton, empty_title_ids, 0, nb_texts
+      )
+      return
+
+    # A few ranges of documents per worker, to balance their load
+    range_size = max(1, -(-nb_texts // (num_workers * 4)))
+    ranges = [
+      (start, min(start + range_size, nb_texts))
+      for start in range(0, nb_texts, range_size)
+    ]
+
+    # Workers are spawned rather than forked, as the split/parse model may
+    # already be loaded in this process, and tensorflow doesn't support
+    # being used from forked processes. Each gets a copy of the automaton,
+    # and maps the same texts file.
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(
+        num_workers,
+        initializer=_init_worker,
+        initargs=((self, automaton, empty_title_ids),)
+    ) as pool:
+      for matched_references in pool.imap(_match_documents, ranges):
+        yield from matched_references
+
+  def close(self):
+    self.texts.close()
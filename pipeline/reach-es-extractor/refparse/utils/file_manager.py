@@ -36,47 +36,48 @@ class FileManager():
                 lineno, e, line)
             raise
 
-    def get_scraping_results(
+    def yield_scraping_results(
             self, file_name, file_prefix,
             scraping_columns=('title', 'file_hash', 'sections', 'uri', 'metadata')
             ):
-        """Takes a scraping result-json to return it cleared of its unused
-        parts, as a pandas DataFrame. This function is used instead of the
-        others because of the size of the scraper result files, which requires
-        a tempfile and some field filtering.
+        """Takes a scraping result-json and yields its json lines one at a
+        time, as dicts of their scraping_columns, so that memory use doesn't
+        grow with the number of documents. Files are streamed, from S3 too,
+        and those ending in .gz are decompressed as they are read.
 
             In: file_name: the name of the json file
                 file_prefix: the path to the file (excluding the file name)
-
-            Out: A pandas.DataFrame containing the json's interesting items
         """
         if self.mode == 'S3':
-            with tempfile.TemporaryFile() as tf:
-                # If we don't have the filename, take the last file
-                if not file_name:
-                    file_path = self.s3._get_last_modified_file_key(
-                        file_prefix
-                    )
-                else:
-                    file_path = os.path.join(file_prefix, file_name)
-                self.s3.get(file_path, tf)
-                tf.seek(0)
-                if file_name.endswith('.gz'):
-                    with gzip.GzipFile(fileobj=tf, mode='r') as text_tf:
-                        rows = (
-                            self.to_row(line, lineno, scraping_columns)
-                            for lineno, line in enumerate(text_tf)
-                        )
-                        return pd.DataFrame(rows)
+            # If we don't have the filename, take the last file
+            if not file_name:
+                file_path = self.s3._get_last_modified_file_key(
+                    file_prefix
+                )
+            else:
+                file_path = os.path.join(file_prefix, file_name)
+            body = self.s3.open(file_path)
+            try:
+                if file_path.endswith('.gz'):
+                    lines = gzip.GzipFile(fileobj=body, mode='r')
                 else:
-                    rows = (
-                        self.to_row(
-                            line, lineno, scraping_columns
-                            ) for lineno, line in enumerate(tf)
-                    )
-                    return pd.DataFrame(rows)
-
-        return self._get_from_local(file_prefix, file_name, 'json')
+                    lines = body.iter_lines()
+                yield from self._yield_rows(lines, scraping_columns)
+            finally:
+                body.close()
+        else:
+            file_path = os.path.join(file_prefix, file_name)
+            with open(file_path, 'rb') as f:
+                self.logger.info(
+                    'Using %s file from local storage', file_path)
+                if file_path.endswith('.gz'):
+                    f = gzip.GzipFile(fileobj=f, mode='r')
+                yield from self._yield_rows(f, scraping_columns)
+
+    def _yield_rows(self, lines, scraping_columns):
+        for lineno, line in enumerate(lines):
+            if line.strip():
+                yield self.to_row(line, lineno, scraping_columns)
 
     def get_file(self, file_name, file_prefix, file_type):
         if self.mode == 'S3':
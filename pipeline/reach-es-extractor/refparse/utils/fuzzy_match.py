@@ -3,15 +3,30 @@ import logging
 import numpy as np
 
 import pandas as pd
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+
+from .publication_store import PublicationStore
+from .tfidf_index import TfidfIndex
 
 logger = logging.getLogger(__name__)
 
 
+def get_reference_key(reference, key, legacy_key):
+    """
+    Return the value of key in a structured reference, as produced by
+    refparse, falling back to legacy_key, as used by the evaluation
+    scripts, or None.
+    """
+    if key in reference:
+        return reference[key]
+    return reference.get(legacy_key)
+
+
 class FuzzyMatcher:
+    MATCH_ALGORITHM = "Fuzzy match"
+
     def __init__(
-        self, publications, similarity_threshold=0.8, title_length_threshold=0
+        self, publications, similarity_threshold=0.8, title_length_threshold=0,
+        index_path=None
     ):
         """
         Takes information about publications in the format:
@@ -43,6 +58,10 @@ class FuzzyMatcher:
                 higher than this, then nothing is returned.
             title_length_threhold(int): Minimum allowed length of title.
                 Less than this threshold will return no results.
+            index_path(str): Directory to keep the tfidf index of the
+                publications in. The index is built there the first time,
+                and when the publications change, and loaded memory-mapped
+                otherwise. If None, the index is built in memory.
         """
         # Filter out any publications that don't have titles assuming that the
         # input is a jsonl.
@@ -54,53 +73,51 @@ class FuzzyMatcher:
 
         titles = [i["title"] for i in publications]
 
-        # Index the remaining publications for faster searching
+        # Keep the remaining publications in a compact store, indexed by row
 
-        self.publications = {i:pub for i, pub in enumerate(publications)}
-        self.vectorizer = TfidfVectorizer(lowercase=True, ngram_range=(1, 1))
-        self.tfidf_matrix = self.vectorizer.fit_transform(titles)
+        self.publications = PublicationStore(publications)
+        if index_path:
+            self.index = TfidfIndex.load_or_build(titles, index_path)
+        else:
+            self.index = TfidfIndex.fit(titles)
+        self.tfidf_matrix = self.index.tfidf_matrix
         self.similarity_threshold = similarity_threshold
         self.title_length_threshold = title_length_threshold
 
+    def search_publications_many(self, titles, nb_results=10,
+                                 min_similarity=None):
+        """
+        Args:
+            titles(list): Titles to search publications for.
+            nb_results(int): Number of results to return for each title.
+                This will be the top n results, ordered by similarity score.
+            min_similarity(float): If set, only results more similar than
+                this are guaranteed to be the top ones, which lets the
+                search skip most publications.
+
+        Returns:
+            A list with, for each title, an array of the indices of its
+            most similar publications and an array of their similarities,
+            ordered by decreasing similarity.
+        """
+        return self.index.search(titles, nb_results, min_similarity)
+
     def search_publications(self, reference, nb_results=10):
         """
         Args:
             reference(dict): A structured reference in a dict, that minimally
-                contains the key: 'Title', but preferably 'Document id', and
-                'Reference id'.
+                contains the key: 'Title', but preferably 'document_id', and
+                'reference_id'.
             nb_results(int): Number of results to return. This will be the top
                 n results, ordered by similarity score.
         """
-        title_vector = self.vectorizer.transform([reference.get("Title")])[0]
-        title_similarities = cosine_similarity(title_vector, self.tfidf_matrix)[0]
-
-        # Create a dict of similarities indexed by the order of the publications
-
-        similarity_vector = {i:vector for i, vector in enumerate(title_similarities)}
-
-        # Order the similarity vector by similarities (and subset the top nb_results)
-
-        sorted_similarities = sorted(similarity_vector.items(), key=lambda item: item[1], reverse=True)
-        sorted_similarities = sorted_similarities[0:nb_results]
-        similar_doc_indices = [k for k, v in sorted_similarities]
-
-        # Cycle through just the similar docs, not the entire list of
-        # publications.
+        indices, similarities = self.search_publications_many(
+            [reference.get("Title")], nb_results)[0]
 
-        retrieved_publications = {i:self.publications[i] for i in similar_doc_indices}
-
-        # Finally append the similarity to the similar docs based on its index
-
-        for key, doc in retrieved_publications.items():
-            doc.update({"similarity": similarity_vector[key]})
-
-        # Convert to a list, again checking that sorting is correct
-
-        retrieved_publications = [value for key, value in retrieved_publications.items()]
-
-        retrieved_publications = sorted(retrieved_publications, key=lambda x: x['similarity'], reverse=True)
-
-        return retrieved_publications
+        return [
+            dict(self.publications[i], similarity=similarity)
+            for i, similarity in zip(indices.tolist(), similarities.tolist())
+        ]
 
     def match(self, reference):
 
@@ -109,28 +126,60 @@ class FuzzyMatcher:
             reference(dict): A structure reference in a dict, that minimally
                 contains the key: 'Title'.
         """
-        if not reference:
-            return None
-
-        if len(reference["Title"]) < self.title_length_threshold:
-            return None
-
-        retrieved_publications = self.search_publications(reference)
-
-        best_match = retrieved_publications[0]
-        best_similarity = best_match["similarity"]
-
-        if best_similarity > self.similarity_threshold:
-            return {
-                "Document id": reference["Document id"],
-                "Reference id": reference["Reference id"],
-                "Extracted title": reference["Title"],
-                "Matched title": best_match["title"],
-                "Matched publication id": best_match.get("uber_id"),
-                "Matched publication pmcid": best_match.get("pmcid"),
-                "Matched publication pmid": best_match.get("pmid"),
-                "Matched publication doi": best_match.get("doi"),
-                "Similarity": best_similarity,
-                "Match algorithm": "Fuzzy match",
-            }
+        return self.match_many([reference])[0]
 
+    def match_many(self, references):
+        """
+        Match many references at once, searching for all their titles in a
+        single sparse matrix product. Callers should pass references in
+        chunks of a few thousands, to bound the size of that product.
+
+        Args:
+            references(list): Structured references, as passed to match().
+
+        Returns:
+            A list with, for each reference, what match() returns for it.
+        """
+        searched = [
+            i for i, reference in enumerate(references)
+            if reference and
+            len(reference["Title"]) >= self.title_length_threshold
+        ]
+        results = [None] * len(references)
+        if not searched:
+            return results
+
+        best_matches = self.search_publications_many(
+            [references[i]["Title"] for i in searched],
+            nb_results=1,
+            min_similarity=self.similarity_threshold
+        )
+
+        for i, (indices, similarities) in zip(searched, best_matches):
+            if not len(indices):
+                continue
+            reference = references[i]
+            best_match = self.publications[int(indices[0])]
+            best_similarity = float(similarities[0])
+
+            if best_similarity > self.similarity_threshold:
+                results[i] = {
+                    "Document id": get_reference_key(
+                        reference, "document_id", "Document id"),
+                    "Reference id": get_reference_key(
+                        reference, "reference_id", "Reference id"),
+                    "Extracted title": reference["Title"],
+                    "Matched title": best_match["title"],
+                    "Matched publication id": best_match.get("uber_id"),
+                    "Matched publication pmcid": best_match.get("pmcid"),
+                    "Matched publication pmid": best_match.get("pmid"),
+                    "Matched publication doi": best_match.get("doi"),
+                    "Similarity": best_similarity,
+                    "Match algorithm": self.MATCH_ALGORITHM,
+                }
+
+        return results
+
+    def close(self):
+        """ Release the resources held by the matcher. """
+        pass
@@ -0,0 +1,251 @@
+import json
+import logging
+import os
+import re
+
+import numpy as np
+
+from .fuzzy_match import FuzzyMatcher
+from .publication_store import PublicationStore
+from .tfidf_index import StringTable, get_fingerprint, replace_dir, select_top
+
+logger = logging.getLogger(__name__)
+
+NON_ALPHANUMERIC_RE = re.compile(r'[\W_]+')
+
+
+def get_shingles(title, shingle_length=4):
+    """
+    Return the sorted distinct shingles of a title, i.e. its substrings of
+    shingle_length bytes, each packed in an integer. Case, punctuation and
+    whitespace are ignored, as OCR and reference parsing often break words
+    and hyphenation.
+    """
+    data = np.frombuffer(
+        NON_ALPHANUMERIC_RE.sub('', title.lower()).encode('utf-8'),
+        dtype=np.uint8
+    ).astype(np.uint32)
+    if len(data) == 0:
+        return data
+
+    shingle_length = min(shingle_length, len(data))
+    nb_shingles = len(data) - shingle_length + 1
+    shingles = np.zeros(nb_shingles, dtype=np.uint32)
+    for i in range(shingle_length):
+        shingles = (shingles << 8) | data[i:i + nb_shingles]
+    return np.unique(shingles)
+
+
+def jaccard_similarity(shingles, other_shingles):
+    intersection = len(np.intersect1d(
+        shingles, other_shingles, assume_unique=True))
+    return intersection / (len(shingles) + len(other_shingles) - intersection)
+
+
+class MinHashIndex:
+    """
+    Locality sensitive hashing index of publication titles, by the MinHash
+    signatures of their shingles. Signatures are split in NB_BANDS bands of
+    BAND_SIZE hashes, and titles sharing a band with a query title are its
+    candidates, so that titles with a Jaccard similarity above about
+    (1 / NB_BANDS) ** (1 / BAND_SIZE) are likely to be found.
+
+    The titles, and for each band the keys of the titles' bands in sorted
+    order with the matching rows, are saved with save() and loaded back
+    memory-mapped.
+
+    Args:
+        titles: StringTable of the publication titles
+        band_keys: array of shape (NB_BANDS, number of titles with shingles)
+            of the sorted keys of each band
+        band_rows: array of the same shape of the rows of the titles with
+            these keys
+        fingerprint: fingerprint of the titles the index was built from
+    """
+
+    VERSION = 1
+    NB_BANDS = 32
+    BAND_SIZE = 4
+    # Titles are verified against at most this many candidates, sharing the
+    # most bands with them.
+    MAX_CANDIDATES = 1000
+
+    # Hash functions of the signatures, (a * x + b) % PRIME
+    PRIME = np.uint64(4294967311)
+    _random_state = np.random.RandomState(1)
+    A = _random_state.randint(
+        1, 2 ** 32, size=NB_BANDS * BAND_SIZE).astype(np.uint64)
+    B = _random_state.randint(
+        0, 2 ** 32, size=NB_BANDS * BAND_SIZE).astype(np.uint64)
+
+    def __init__(self, titles, band_keys, band_rows, fingerprint=None):
+        self.titles = titles
+        self.band_keys = band_keys
+        self.band_rows = band_rows
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def get_keys(cls, shingles):
+        """ Return the key of each band of the signature of shingles. """
+        hashes = (
+            cls.A[:, None] * shingles[None, :].astype(np.uint64) +
+            cls.B[:, None]
+        ) % cls.PRIME
+        signature = hashes.min(axis=1).reshape(cls.NB_BANDS, cls.BAND_SIZE)
+
+        keys = np.zeros(cls.NB_BANDS, dtype=np.uint64)
+        for i in range(cls.BAND_SIZE):
+            keys = keys * np.uint64(1000003) ^ signature[:, i]
+        return keys
+
+    @classmethod
+    def fit(cls, titles):
+        rows = []
+        keys = []
+        for row, title in enumerate(titles):
+            shingles = get_shingles(title)
+            if len(shingles):
+                rows.append(row)
+                keys.append(cls.get_keys(shingles))
+
+        rows = np.array(rows, dtype=np.int32)
+        keys = np.array(keys, dtype=np.uint64).reshape(len(rows), cls.NB_BANDS)
+        band_keys = np.empty((cls.NB_BANDS, len(rows)), dtype=np.uint64)
+        band_rows = np.empty((cls.NB_BANDS, len(rows)), dtype=np.int32)
+        for band in range(cls.NB_BANDS):
+            order = np.argsort(keys[:, band], kind='stable')
+            band_keys[band] = keys[order, band]
+            band_rows[band] = rows[order]
+
+        return cls(
+            StringTable.from_strings(titles),
+            band_keys,
+            band_rows,
+            get_fingerprint(titles, cls.VERSION),
+        )
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        StringTable.write(
+            path, 'titles',
+            (self.titles[i] for i in range(len(self.titles)))
+        )
+        np.save(os.path.join(path, 'band_keys.npy'), self.band_keys)
+        np.save(os.path.join(path, 'band_rows.npy'), self.band_rows)
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({
+                'version': self.VERSION,
+                'fingerprint': self.fingerprint,
+            }, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != cls.VERSION:
+            raise ValueError(
+                'Unsupported minhash index version: %s' % meta['version'])
+
+        return cls(
+            StringTable.load(path, 'titles'),
+            np.load(os.path.join(path, 'band_keys.npy'), mmap_mode='r'),
+            np.load(os.path.join(path, 'band_rows.npy'), mmap_mode='r'),
+            meta['fingerprint'],
+        )
+
+    @classmethod
+    def load_or_build(cls, titles, path):
+        """
+        Load the index saved at path, first building it from titles if
+        there is none or if it was built from different titles.
+        """
+        try:
+            with open(os.path.join(path, 'meta.json')) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            meta = {}
+
+        fingerprint = get_fingerprint(titles, cls.VERSION)
+        if meta.get('version') != cls.VERSION or \
+                meta.get('fingerprint') != fingerprint:
+            logger.info("[+] Building minhash index in %s", path)
+            replace_dir(path, cls.fit(titles).save)
+
+        return cls.load(path)
+
+    def get_candidates(self, keys):
+        """ Return the rows of the titles sharing a band with keys. """
+        candidates = []
+        for band, key in enumerate(keys):
+            band_keys = self.band_keys[band]
+            start = np.searchsorted(band_keys, key, side='left')
+            stop = np.searchsorted(band_keys, key, side='right')
+            candidates.append(self.band_rows[band][start:stop])
+
+        candidates, counts = np.unique(
+            np.concatenate(candidates), return_counts=True)
+        if len(candidates) > self.MAX_CANDIDATES:
+            top = np.argpartition(-counts, self.MAX_CANDIDATES - 1)
+            candidates = candidates[top[:self.MAX_CANDIDATES]]
+        return candidates
+
+    def search(self, title, nb_results=10):
+        """
+        Return the indices of the nb_results candidates most similar to
+        title, by the Jaccard similarity of their shingles, and their
+        similarities, ordered by decreasing similarity.
+        """
+        shingles = get_shingles(title)
+        if not len(shingles):
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+        candidates = self.get_candidates(self.get_keys(shingles))
+        similarities = np.array([
+            jaccard_similarity(shingles, get_shingles(self.titles[row]))
+            for row in candidates
+        ])
+        return select_top(
+            candidates.astype(np.int64), similarities, nb_results)
+
+
+class MinHashMatcher(FuzzyMatcher):
+    MATCH_ALGORITHM = "MinHash match"
+
+    def __init__(
+        self, publications, similarity_threshold=0.8, title_length_threshold=0,
+        index_path=None
+    ):
+        """
+        A FuzzyMatcher finding publications by the Jaccard similarity of the
+        character shingles of their titles, which is robust to the broken
+        words of OCR-noisy titles. Candidates are found through a
+        MinHashIndex, so that searching takes about constant time.
+
+        Args:
+            publications(list): See FuzzyMatcher.
+            similarity_threshold(float): Minimum allowable Jaccard
+                similarity.
+            title_length_threhold(int): See FuzzyMatcher.
+            index_path(str): Directory to keep the minhash index of the
+                publications in. The index is built there the first time,
+                and when the publications change, and loaded memory-mapped
+                otherwise. If None, the index is built in memory.
+        """
+        publications = [i for i in publications if i.get("title")]
+        titles = [i["title"] for i in publications]
+
+        self.publications = PublicationStore(publications)
+        if index_path:
+            self.index = MinHashIndex.load_or_build(titles, index_path)
+        else:
+            self.index = MinHashIndex.fit(titles)
+        self.similarity_threshold = similarity_threshold
+        self.title_length_threshold = title_length_threshold
+
+    def search_publications_many(self, titles, nb_results=10,
+                                 min_similarity=None):
+        """
+        See FuzzyMatcher.search_publications_many. Only candidates from the
+        index are returned, so there may be fewer than nb_results results.
+        """
+        return [self.index.search(title, nb_results) for title in titles]
@@ -0,0 +1,47 @@
+import json
+
+import numpy as np
+
+from .tfidf_index import StringTable
+
+
+def encode_value(value):
+    # Publications read with pandas may hold numpy scalars
+    if isinstance(value, np.generic):
+        value = value.item()
+    return json.dumps(value)
+
+
+class PublicationStore:
+    """
+    Read-only sequence of publications, keeping only the fields used to
+    describe matches. Each field is stored as a column of json encoded
+    values in a StringTable, so that a publication takes a few dozen bytes,
+    and a dict is only built for the publications that are looked up.
+
+    Args:
+        publications(list): List of dicts containing publication info.
+    """
+
+    FIELDS = ('title', 'uber_id', 'pmid', 'pmcid', 'doi')
+
+    def __init__(self, publications):
+        self.columns = {
+            field: StringTable.from_strings(
+                encode_value(publication.get(field))
+                for publication in publications
+            )
+            for field in self.FIELDS
+        }
+
+    def __len__(self):
+        return len(self.columns['title'])
+
+    def __getitem__(self, i):
+        """ Return publication i as a dict of its fields which are set. """
+        publication = {}
+        for field, column in self.columns.items():
+            value = json.loads(column[i])
+            if value is not None:
+                publication[field] = value
+        return publication
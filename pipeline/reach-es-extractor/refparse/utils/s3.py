@@ -38,3 +38,13 @@ class S3():
         self.logger.info('[+] Fetching s3://%s/%s', self.bucket_name, key)
         object = self.s3.Object(self.bucket_name, key)
         object.download_fileobj(temp_file)
+
+    def open(self, key):
+        """Return the body of the object at key, streamed as it is read."""
+        self.logger.info('[+] Streaming s3://%s/%s', self.bucket_name, key)
+        return self.s3.Object(self.bucket_name, key).get()['Body']
+
+    def put(self, key, temp_file):
+        self.logger.info('[+] Uploading s3://%s/%s', self.bucket_name, key)
+        object = self.s3.Object(self.bucket_name, key)
+        object.upload_fileobj(temp_file)
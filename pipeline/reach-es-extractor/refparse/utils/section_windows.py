@@ -0,0 +1,83 @@
+# Maximum number of characters between the tokens of a reference, or
+# between references, when locating them in the text they were predicted
+# from
+MAX_TOKEN_GAP = 200
+
+
+def split_windows(text, window_size, overlap):
+    """
+    Split text in windows of at most window_size characters, each
+    overlapping the previous one by at least overlap characters, so that
+    references cut at the end of a window are whole in the next one.
+    Windows start and end on line boundaries where there is one within
+    overlap characters of where they would otherwise.
+
+    Returns:
+        A list of the (start, stop) offsets of the windows in text.
+    """
+    if window_size <= 2 * overlap:
+        raise ValueError('window_size must be greater than twice overlap')
+
+    windows = []
+    start = 0
+    while len(text) - start > window_size:
+        stop = start + window_size
+        line_end = text.rfind('\n', stop - overlap, stop)
+        if line_end != -1:
+            stop = line_end + 1
+        windows.append((start, stop))
+
+        line_start = text.rfind(
+            '\n', max(start, stop - 2 * overlap), stop - overlap)
+        if line_start != -1:
+            start = line_start + 1
+        else:
+            start = stop - overlap
+
+    windows.append((start, len(text)))
+    return windows
+
+
+def locate_references(text, predictions):
+    """
+    Return the offset in text where each reference of the split_parse
+    predictions of text starts, by finding its tokens in turn, each within
+    MAX_TOKEN_GAP characters of the previous one. References whose tokens
+    can't be found start where the previous reference ended.
+    """
+    offsets = []
+    cursor = 0
+    for reference in predictions:
+        offset = None
+        for token in reference['Reference'].split():
+            position = text.find(
+                token, cursor, cursor + MAX_TOKEN_GAP + len(token))
+            if position != -1:
+                if offset is None:
+                    offset = position
+                cursor = position + len(token)
+        offsets.append(cursor if offset is None else offset)
+    return offsets
+
+
+def merge_window_predictions(text, windows, window_predictions):
+    """
+    Merge the split_parse predictions of the windows of text into those of
+    text. Each window keeps the references starting between the middles of
+    its overlaps with the previous and next windows, so that references in
+    an overlap are kept once, from the window holding them whole.
+    """
+    if len(windows) == 1:
+        return window_predictions[0]
+
+    merged = []
+    for i, ((start, stop), predictions) in enumerate(
+            zip(windows, window_predictions)):
+        low = 0 if i == 0 else (windows[i - 1][1] + start) // 2
+        high = len(text) + 1 if i == len(windows) - 1 else \
+            (stop + windows[i + 1][0]) // 2
+        offsets = locate_references(text[start:stop], predictions)
+        for offset, reference in zip(offsets, predictions):
+            if low <= start + offset < high:
+                merged.append(reference)
+    return merged
@@ -0,0 +1,107 @@
+import logging
+import multiprocessing
+import tempfile
+
+import numpy as np
+
+from .fuzzy_match import FuzzyMatcher
+from .publication_store import PublicationStore
+from .tfidf_index import TfidfIndex, select_top
+
+logger = logging.getLogger(__name__)
+
+# Shard indexes loaded by a worker process, by path
+_shard_indexes = {}
+
+
+def search_shard(shard, titles, nb_results, min_similarity):
+    """
+    Search one shard of the publications, from a worker process.
+
+    Args:
+        shard(tuple): Offset of the first publication of the shard and
+            path of its index.
+
+    Returns:
+        The results of TfidfIndex.search, with indices of publications
+        among all publications.
+    """
+    offset, path = shard
+    index = _shard_indexes.get(path)
+    if index is None:
+        # Loading is cheap, as the index is memory-mapped and its pages
+        # shared with other workers.
+        index = _shard_indexes[path] = TfidfIndex.load(path)
+
+    return [
+        (indices + offset, similarities)
+        for indices, similarities
+        in index.search(titles, nb_results, min_similarity)
+    ]
+
+
+class ShardedFuzzyMatcher(FuzzyMatcher):
+    def __init__(
+        self, publications, similarity_threshold=0.8, title_length_threshold=0,
+        index_path=None, nb_shards=None
+    ):
+        """
+        A FuzzyMatcher splitting the publications in nb_shards shards,
+        searched in parallel by as many worker processes. The tfidf index of
+        each shard is kept in a subdirectory of index_path, and memory-mapped
+        by the workers, so that they share a single copy of it.
+
+        Args:
+            publications(list): See FuzzyMatcher.
+            similarity_threshold(float): See FuzzyMatcher.
+            title_length_threhold(int): See FuzzyMatcher.
+            index_path(str): Directory to keep the shard indexes in. If None,
+                they are built in a temporary directory.
+            nb_shards(int): Number of shards and worker processes. Defaults
+                to the number of CPUs.
+        """
+        publications = [i for i in publications if i.get("title")]
+        titles = [i["title"] for i in publications]
+
+        self.publications = PublicationStore(publications)
+        self.similarity_threshold = similarity_threshold
+        self.title_length_threshold = title_length_threshold
+
+        self.tmp_dir = None
+        if not index_path:
+            self.tmp_dir = tempfile.TemporaryDirectory()
+            index_path = self.tmp_dir.name
+
+        nb_shards = nb_shards or multiprocessing.cpu_count()
+        self.shards = TfidfIndex.build_shards(titles, index_path, nb_shards)
+        self.nb_publications = len(titles)
+        self.pool = multiprocessing.Pool(nb_shards)
+
+    def search_publications_many(self, titles, nb_results=10,
+                                 min_similarity=None):
+        """
+        See FuzzyMatcher.search_publications_many. Each shard is searched
+        for the top results, which are then merged.
+        """
+        shard_results = self.pool.starmap(
+            search_shard,
+            [
+                (shard, titles, nb_results, min_similarity)
+                for shard in self.shards
+            ]
+        )
+
+        nb_results = min(nb_results, self.nb_publications)
+        results = []
+        for title_results in zip(*shard_results):
+            indices = np.concatenate([indices for indices, _ in title_results])
+            values = np.concatenate([values for _, values in title_results])
+            results.append(select_top(indices, values, nb_results))
+
+        return results
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        if self.tmp_dir is not None:
+            self.tmp_dir.cleanup()
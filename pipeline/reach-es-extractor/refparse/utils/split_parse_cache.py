@@ -0,0 +1,240 @@
+import collections
+import configparser
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import tempfile
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+
+def get_model_version(config_file):
+    """
+    Return a version of the split/parse model, as the hash of its config
+    file and of the files in the model directory it points to (its
+    build.output_path, holding the weights and indices), so that
+    retraining or replacing the weights under the same config changes it.
+
+    Like deep_reference_parser, the model directory is relative to the
+    working directory. Model files that have not been downloaded yet
+    are left out.
+    """
+    digest = hashlib.sha256()
+    with open(config_file, 'rb') as f:
+        digest.update(f.read())
+
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    model_dir = config.get('build', 'output_path', fallback=None)
+    if model_dir and os.path.isdir(model_dir):
+        for name in sorted(os.listdir(model_dir)):
+            path = os.path.join(model_dir, name)
+            if not os.path.isfile(path):
+                continue
+            digest.update(b'\0' + name.encode('utf-8') + b'\0')
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+    return digest.hexdigest()
+
+
+class SplitParseCache:
+    """
+    Cache of split_parse predictions, keyed by the hash of the section text
+    and of the model version, so that a section is only run through the
+    model again when it or the model changed.
+
+    The cache is a gzipped file of json lines, in a local directory or
+    under an S3 prefix. It is loaded with load(), decompressing its
+    predictions to a local temporary file and only keeping their offsets
+    in memory, about 200 bytes per entry, and written back with save(),
+    keeping only the sections looked up during the run, so that it doesn't
+    grow with sections no longer in the input. New predictions are
+    appended to the same temporary file.
+
+    Args:
+        path: local directory or S3 URL prefix to keep the cache in
+        model_version: version of the model, see get_model_version
+    """
+
+    FILENAME = 'split_parse_cache.jsonl.gz'
+
+    def __init__(self, path, model_version):
+        self.path = path
+        self.model_version = model_version
+        self.entries_file = tempfile.TemporaryFile()
+        # Offset and length of the predictions of each key in entries_file
+        self.entries = {}
+        self.used_keys = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_key(self, text):
+        digest = hashlib.sha256()
+        digest.update(self.model_version.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(text.encode('utf-8'))
+        return digest.hexdigest()
+
+    def add_entry(self, key, entry):
+        """ Append the predictions of key, as json bytes, to entries_file.
+        """
+        offset = self.entries_file.seek(0, io.SEEK_END)
+        self.entries_file.write(entry)
+        self.entries[key] = (offset, len(entry))
+
+    def read_entry(self, key):
+        offset, length = self.entries[key]
+        self.entries_file.seek(offset)
+        return self.entries_file.read(length)
+
+    def get(self, key):
+        """ Return the cached predictions for key, or None. """
+        if key not in self.entries:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.used_keys[key] = None
+        return json.loads(self.read_entry(key).decode('utf-8'))
+
+    def put(self, key, predictions):
+        self.add_entry(key, json.dumps(predictions).encode('utf-8'))
+        self.used_keys[key] = None
+
+    def yield_split_parsed(self, texts, split_parse_texts, max_pending=1000):
+        """
+        Yield the predictions of each text, in order, from the cache or, for
+        texts missing from it, from split_parse_texts, a function yielding
+        the predictions of an iterable of texts in order.
+
+        split_parse_texts may read ahead several missing texts before
+        yielding the predictions of the first, holding the texts read in
+        between in memory. To bound them to max_pending texts, the texts
+        given to split_parse_texts end once as many are pending, and it is
+        called again for the next missing texts, so it should be cheap to
+        call more than once.
+        """
+        texts = iter(texts)
+        # Keys and cached predictions of the texts read, not yet yielded
+        pending = collections.deque()
+        missing_texts = collections.deque()
+
+        def read_next():
+            text = next(texts, None)
+            if text is None:
+                return False
+            key = self.get_key(text)
+            predictions = self.get(key)
+            pending.append((key, predictions))
+            if predictions is None:
+                missing_texts.append(text)
+            return True
+
+        def yield_missing_texts():
+            while True:
+                while not missing_texts:
+                    if len(pending) >= max_pending or not read_next():
+                        return
+                yield missing_texts.popleft()
+
+        def finish(missing_predictions):
+            # Let split_parse_texts run to its end, e.g. to shut down workers
+            for _ in missing_predictions:
+                raise RuntimeError('More predictions than missing texts')
+
+        missing_predictions = None
+        try:
+            while pending or read_next():
+                key, predictions = pending.popleft()
+                if predictions is None:
+                    if missing_predictions is not None:
+                        predictions = next(missing_predictions, None)
+                    if predictions is None:
+                        # Either the first missing text, or the texts given
+                        # to split_parse_texts ended, see above
+                        missing_predictions = split_parse_texts(
+                            yield_missing_texts())
+                        predictions = next(missing_predictions)
+                    self.put(key, predictions)
+                yield predictions
+            if missing_predictions is not None:
+                finish(missing_predictions)
+        finally:
+            if missing_predictions is not None:
+                missing_predictions.close()
+
+    def log_stats(self, logger):
+        lookups = self.hits + self.misses
+        logger.info(
+            '[+] Split/parse cache: %d hits, %d misses (%.1f%% hit rate)',
+            self.hits,
+            self.misses,
+            100 * self.hits / lookups if lookups else 0
+        )
+
+    def read(self, f):
+        with gzip.GzipFile(fileobj=f, mode='rb') as gzip_f:
+            for line in gzip_f:
+                entry = json.loads(line)
+                self.add_entry(
+                    entry['key'],
+                    json.dumps(entry['predictions']).encode('utf-8')
+                )
+
+    def write(self, f):
+        with gzip.GzipFile(fileobj=f, mode='wb') as gzip_f:
+            for key in self.used_keys:
+                gzip_f.write(b'{"key": %s, "predictions": %s}\n' % (
+                    json.dumps(key).encode('utf-8'), self.read_entry(key)))
+
+    def get_s3(self):
+        from .s3 import S3
+
+        u = urlparse(self.path)
+        key = os.path.join(u.path[1:], self.FILENAME)  # strip /
+        return S3(u.netloc), key
+
+    def load(self):
+        if self.path.startswith('s3://'):
+            from botocore.exceptions import ClientError
+
+            s3, key = self.get_s3()
+            with tempfile.TemporaryFile() as tf:
+                try:
+                    s3.get(key, tf)
+                except ClientError as e:
+                    if e.response['Error']['Code'] not in (
+                            '404', 'NoSuchKey'):
+                        raise
+                    logger.info('No split/parse cache in %s', self.path)
+                    return
+                tf.seek(0)
+                self.read(tf)
+        else:
+            try:
+                with open(os.path.join(self.path, self.FILENAME), 'rb') as f:
+                    self.read(f)
+            except FileNotFoundError:
+                logger.info('No split/parse cache in %s', self.path)
+
+    def save(self):
+        if self.path.startswith('s3://'):
+            s3, key = self.get_s3()
+            with tempfile.TemporaryFile() as tf:
+                self.write(tf)
+                tf.seek(0)
+                s3.put(key, tf)
+        else:
+            os.makedirs(self.path, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                    dir=self.path, delete=False) as tf:
+                self.write(tf)
+            os.replace(tf.name, os.path.join(self.path, self.FILENAME))
+
+    def close(self):
+        self.entries_file.close()
@@ -0,0 +1,91 @@
+import json
+import socket
+import struct
+from itertools import islice
+
+# Messages are json, prefixed by their length as a 4 bytes unsigned int
+LENGTH = struct.Struct('>I')
+
+
+def send_message(sock, message):
+    data = json.dumps(message).encode('utf-8')
+    sock.sendall(LENGTH.pack(len(data)) + data)
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise EOFError('Connection closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def recv_message(sock):
+    """ Return the next message from sock, or None once it is closed. """
+    try:
+        header = _recv_exactly(sock, LENGTH.size)
+    except EOFError:
+        return None
+    size, = LENGTH.unpack(header)
+    return json.loads(_recv_exactly(sock, size).decode('utf-8'))
+
+
+class SplitParseClient:
+    """
+    Client of a split/parse model server, see refparse.split_parse_server,
+    which keeps the model loaded across runs.
+
+    Args:
+        socket_path: path of the Unix socket the server listens on
+        batch_size: number of texts to send the server per request
+    """
+
+    def __init__(self, socket_path, batch_size=16):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        self.batch_size = batch_size
+
+    def request(self, message):
+        send_message(self.sock, message)
+        response = recv_message(self.sock)
+        if response is None:
+            raise RuntimeError('Split/parse server closed the connection')
+        if 'error' in response:
+            raise RuntimeError(
+                'Split/parse server error:\n%s' % response['error'])
+        return response
+
+    def get_model_version(self):
+        """ Return the version of the server's model, see
+        get_model_version.
+        """
+        return self.request({'command': 'model_version'})['model_version']
+
+    def split_parse_many(self, texts):
+        return self.request({
+            'command': 'split_parse',
+            'texts': list(texts)
+        })['predictions']
+
+    def split_parse(self, text):
+        """ Same as SplitParser.split_parse, from the server. """
+        return self.split_parse_many([text])[0]
+
+    def yield_split_parsed(self, texts):
+        """
+        Split and parse an iterable of texts on the server, batch_size
+        texts at a time, yielding back the result of split_parse for each
+        text in the same order.
+        """
+        texts = iter(texts)
+        while True:
+            batch = list(islice(texts, self.batch_size))
+            if not batch:
+                return
+            yield from self.split_parse_many(batch)
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,389 @@
+import bisect
+import hashlib
+import json
+import logging
+import os
+import shutil
+from collections import Counter
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.preprocessing import normalize
+
+from string_table import StringTable
+
+logger = logging.getLogger(__name__)
+
+
+def select_top(indices, values, nb_results):
+    """
+    Return the nb_results (index, value) pairs with the highest values, as
+    an array of indices and an array of values, ordered by decreasing
+    value, then by index.
+    """
+    # Select the top nb_results before sorting just these
+
+    if len(values) > nb_results:
+        top = np.argpartition(-values, nb_results - 1)[:nb_results]
+        indices, values = indices[top], values[top]
+    order = np.lexsort((indices, -values))
+    return indices[order], values[order]
+
+
+def get_fingerprint(titles, version):
+    """ Return a fingerprint identifying a list of titles and the version
+    of an index built from them.
+    """
+    digest = hashlib.sha1(str(version).encode('utf-8'))
+    for title in titles:
+        digest.update(title.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def replace_dir(path, write):
+    """
+    Call write with a directory next to path, then swap it in for path, so
+    that a crash while writing doesn't leave half an index behind.
+    """
+    tmp_path = '%s.%d.tmp' % (path.rstrip(os.sep), os.getpid())
+    write(tmp_path)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+
+
+class TfidfIndex:
+    """
+    TF-IDF vectors of publication titles, as computed by a
+    TfidfVectorizer(lowercase=True, ngram_range=(1, 1)) fit on them.
+
+    The vectors are kept term-major, as the CSR matrix of the transposed
+    tfidf matrix, so that the similarities of many titles to all
+    publications are a single sparse product. An index saved with save()
+    is loaded back memory-mapped, so that loading it is immediate and
+    processes using the same index share its pages.
+
+    Args:
+        terms: sorted sequence of the terms of the vocabulary
+        idf: array of the idf weight of each term
+        postings: CSR matrix of shape (number of terms, number of
+            publications)
+        fingerprint: fingerprint of the titles the index was built from
+    """
+
+    VERSION = 1
+    # Scan all publications rather than prune candidates for titles whose
+    # candidates may be more than this share of the publications.
+    MAX_CANDIDATES_RATIO = 0.1
+
+    def __init__(self, terms, idf, postings, fingerprint=None):
+        self.terms = terms
+        self.idf = idf
+        self.postings = postings
+        self.fingerprint = fingerprint
+        self.analyzer = TfidfVectorizer(lowercase=True).build_analyzer()
+
+    @property
+    def tfidf_matrix(self):
+        """ The tfidf matrix of shape (number of publications, number of
+        terms), without copying the postings.
+        """
+        return self.postings.T
+
+    @classmethod
+    def get_fingerprint(cls, titles):
+        return get_fingerprint(titles, cls.VERSION)
+
+    @classmethod
+    def fit(cls, titles):
+        vectorizer = TfidfVectorizer(lowercase=True, ngram_range=(1, 1))
+        tfidf_matrix = vectorizer.fit_transform(titles)
+        # The vocabulary of a TfidfVectorizer is numbered in sorted order.
+        terms = sorted(vectorizer.vocabulary_, key=vectorizer.vocabulary_.get)
+        postings = tfidf_matrix.T.tocsr()
+        postings.sort_indices()
+        return cls(
+            terms,
+            vectorizer.idf_,
+            postings,
+            cls.get_fingerprint(titles),
+        )
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        StringTable.write(path, 'terms', self.terms)
+        np.save(os.path.join(path, 'idf.npy'), self.idf)
+        np.save(os.path.join(path, 'data.npy'), self.postings.data)
+        np.save(os.path.join(path, 'indices.npy'), self.postings.indices)
+        np.save(os.path.join(path, 'indptr.npy'), self.postings.indptr)
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({
+                'version': self.VERSION,
+                'fingerprint': self.fingerprint,
+                'shape': self.postings.shape,
+            }, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != cls.VERSION:
+            raise ValueError(
+                'Unsupported tfidf index version: %s' % meta['version'])
+
+        def load_array(name):
+            return np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+
+        postings = csr_matrix(
+            (load_array('data'), load_array('indices'), load_array('indptr')),
+            shape=tuple(meta['shape']),
+            copy=False
+        )
+        return cls(
+            StringTable.load(path, 'terms'),
+            load_array('idf'),
+            postings,
+            meta['fingerprint'],
+        )
+
+    @classmethod
+    def is_built(cls, path, fingerprint, **meta):
+        """
+        Whether the index at path is of this version, was built from the
+        titles with the given fingerprint, and has the given metadata.
+        """
+        try:
+            with open(os.path.join(path, 'meta.json')) as f:
+                saved_meta = json.load(f)
+        except FileNotFoundError:
+            return False
+
+        return saved_meta['version'] == cls.VERSION and \
+            saved_meta['fingerprint'] == fingerprint and \
+            all(saved_meta.get(key) == value for key, value in meta.items())
+
+    @classmethod
+    def load_or_build(cls, titles, path):
+        """
+        Load the index saved at path, first building it from titles if
+        there is none or if it was built from different titles.
+        """
+        if not cls.is_built(path, cls.get_fingerprint(titles)):
+            logger.info("[+] Building tfidf index in %s", path)
+            replace_dir(path, cls.fit(titles).save)
+
+        return cls.load(path)
+
+    def shard(self, start, stop):
+        """ Return the index of publications start to stop only. """
+        return type(self)(
+            self.terms,
+            self.idf,
+            self.postings[:, start:stop].tocsr(),
+            self.fingerprint,
+        )
+
+    @classmethod
+    def build_shards(cls, titles, path, nb_shards):
+        """
+        Build nb_shards indexes, each over a contiguous range of the
+        titles, in subdirectories of path, unless they are already built.
+        The tfidf weights are those of an index over all titles.
+
+        Returns:
+            A list of the offset of the first publication of each shard
+            and the path of its index.
+        """
+        fingerprint = cls.get_fingerprint(titles)
+        bounds = np.linspace(0, len(titles), nb_shards + 1).astype(int)
+        shards = [
+            (int(start), os.path.join(path, 'shard-%d' % i))
+            for i, start in enumerate(bounds[:-1])
+        ]
+
+        if not cls.is_built(path, fingerprint, nb_shards=nb_shards):
+            logger.info("[+] Building %d tfidf index shards in %s",
+                        nb_shards, path)
+            index = cls.fit(titles)
+
+            def write(tmp_path):
+                for i in range(nb_shards):
+                    index.shard(bounds[i], bounds[i + 1]).save(
+                        os.path.join(tmp_path, 'shard-%d' % i))
+                with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+                    json.dump({
+                        'version': cls.VERSION,
+                        'fingerprint': fingerprint,
+                        'nb_shards': nb_shards,
+                    }, f)
+
+            replace_dir(path, write)
+
+        return shards
+
+    def term_id(self, term):
+        i = bisect.bisect_left(self.terms, term)
+        if i < len(self.terms) and self.terms[i] == term:
+            return i
+
+    def transform(self, titles):
+        """
+        Return the l2 normalised tfidf vectors of titles, as a CSR matrix of
+        shape (number of titles, number of terms).
+        """
+        rows = []
+        cols = []
+        counts = []
+        for i, title in enumerate(titles):
+            for term, count in Counter(self.analyzer(title)).items():
+                term_id = self.term_id(term)
+                if term_id is not None:
+                    rows.append(i)
+                    cols.append(term_id)
+                    counts.append(count)
+
+        cols = np.array(cols, dtype=np.int64)
+        values = np.array(counts, dtype=np.float64) * self.idf[cols]
+        vectors = csr_matrix(
+            (values, (rows, cols)),
+            shape=(len(titles), len(self.terms))
+        )
+        return normalize(vectors, copy=False)
+
+    def similarities(self, titles, min_similarity=None):
+        """
+        Return the cosine similarities of titles to publications, as a CSR
+        matrix of shape (number of titles, number of publications).
+
+        Without min_similarity, all publications sharing a term with a
+        title are scored. With it, only those which may be more similar
+        than min_similarity to a title are, so that the similarities above
+        min_similarity are the same but others may be missing.
+        """
+        vectors = self.transform(titles)
+        if min_similarity is None or min_similarity <= 0:
+            return vectors.dot(self.postings).tocsr()
+
+        nb_publications = self.postings.shape[1]
+        max_candidates = self.MAX_CANDIDATES_RATIO * nb_publications
+        rows = []
+        full_scan = []
+        for i in range(len(titles)):
+            start, stop = vectors.indptr[i], vectors.indptr[i + 1]
+            row = self.search_candidates(
+                vectors.indices[start:stop],
+                vectors.data[start:stop],
+                min_similarity,
+                max_candidates
+            )
+            if row is None:
+                full_scan.append(i)
+            rows.append(row)
+
+        if full_scan:
+            scanned = vectors[full_scan].dot(self.postings).tocsr()
+            for j, i in enumerate(full_scan):
+                start, stop = scanned.indptr[j], scanned.indptr[j + 1]
+                rows[i] = (scanned.indices[start:stop], scanned.data[start:stop])
+
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum([len(indices) for indices, _ in rows], out=indptr[1:])
+        return csr_matrix(
+            (
+                np.concatenate([data for _, data in rows] + [np.zeros(0)]),
+                np.concatenate(
+                    [indices for indices, _ in rows] +
+                    [np.zeros(0, dtype=np.int64)]
+                ),
+                indptr,
+            ),
+            shape=(len(rows), nb_publications)
+        )
+
+    def search(self, titles, nb_results=10, min_similarity=None):
+        """
+        Return, for each title, an array of the indices of its nb_results
+        most similar publications and an array of their similarities,
+        ordered by decreasing similarity. See similarities() for
+        min_similarity.
+        """
+        # Only publications sharing a term with a title get a non zero
+        # entry in its row.
+
+        similarities = self.similarities(titles, min_similarity)
+
+        nb_results = min(nb_results, self.postings.shape[1])
+        results = []
+        for i in range(len(titles)):
+            start, stop = similarities.indptr[i], similarities.indptr[i + 1]
+            indices, values = select_top(
+                similarities.indices[start:stop],
+                similarities.data[start:stop],
+                nb_results
+            )
+
+            # Fill up with publications sharing no term with the title, in
+            # the order a full sort of the similarities would give them.
+
+            if len(indices) < nb_results:
+                padding = np.setdiff1d(np.arange(nb_results), indices)
+                padding = padding[:nb_results - len(indices)]
+                indices = np.concatenate([indices, padding])
+                values = np.concatenate([values, np.zeros(len(padding))])
+
+            results.append((indices, values))
+
+        return results
+
+    def search_candidates(self, term_ids, weights, min_similarity,
+                          max_candidates):
+        """
+        Score the publications which may be more similar than
+        min_similarity to a title, given the terms and weights of its
+        vector.
+
+        The similarity contributed by a set of the title's terms is at most
+        the norm of their weights, as publication vectors are normalised.
+        So a publication only sharing the title's most common terms, whose
+        weights have a norm of at most min_similarity, can't be more
+        similar than min_similarity, and candidates are the publications
+        sharing one of its rarer terms.
+
+        Returns:
+            The indices of the candidates and their similarities, or None if
+            there may be more than max_candidates of them.
+        """
+        indptr = self.postings.indptr
+        doc_freqs = indptr[term_ids + 1] - indptr[term_ids]
+        order = np.argsort(doc_freqs, kind='stable')
+        term_ids, weights, doc_freqs = \
+            term_ids[order], weights[order], doc_freqs[order]
+
+        # Norm of the weights of each term and all the more common ones
+        suffix_norms = np.sqrt(np.cumsum(weights[::-1] ** 2))[::-1]
+        probes = int(np.count_nonzero(suffix_norms > min_similarity))
+        if doc_freqs[:probes].sum() > max_candidates:
+            return
+
+        if probes == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        candidates = np.unique(np.concatenate([
+            self.postings.indices[indptr[term_id]:indptr[term_id + 1]]
+            for term_id in term_ids[:probes]
+        ]))
+
+        scores = np.zeros(len(candidates))
+        for term_id, weight in zip(term_ids, weights):
+            start, stop = indptr[term_id], indptr[term_id + 1]
+            if start == stop:
+                continue
+            docs = self.postings.indices[start:stop]
+            positions = np.minimum(
+                np.searchsorted(docs, candidates), len(docs) - 1)
+            found = docs[positions] == candidates
+            scores[found] += \
+                weight * self.postings.data[start:stop][positions[found]]
+
+        return candidates, scores
@@ -4,7 +4,6 @@ Operator to run to index files from a given S3 location to a running
 Elasticsearch instance.
 """
 import os
-import tempfile
 import argparse
 import logging
 
@@ -69,12 +68,9 @@ class ESIndex(object):
                 self.src_s3_key,
             )
 
-        s3_object = s3.get_s3_object(self.src_s3_key)
-        with tempfile.NamedTemporaryFile() as tf:
-            s3_object.download_fileobj(tf)
-            tf.seek(0)
+        with s3.open_stream(self.src_s3_key) as f:
             count = index_method.insert_file(
-                tf,
+                f,
                 es,
                 self.es_index,
                 self.organisation,
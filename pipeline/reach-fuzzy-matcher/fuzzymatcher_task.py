@@ -5,11 +5,24 @@ Operator for matching references to publications in database
 import tempfile
 import logging
 import gzip
+import heapq
+import io
 import json
 import os
 import argparse
+import collections
+import shutil
+import concurrent.futures
+import itertools
+import sqlite3
+import threading
+import time
+
+from botocore.exceptions import ClientError
+from elasticsearch.exceptions import TransportError
 
 import elastic.common
+import title_index
 from hooks import s3hook
 from hooks.sentry import report_exception
 
@@ -18,15 +31,276 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 def yield_structured_references(s3, structured_references_path):
-    with tempfile.TemporaryFile(mode='rb+') as tf:
-        key = s3.get_s3_object(structured_references_path)
-        key.download_fileobj(tf)
-        tf.seek(0)
-        with gzip.GzipFile(mode='rb', fileobj=tf) as f:
+    with s3.open_stream(structured_references_path) as raw_f:
+        with gzip.GzipFile(mode='rb', fileobj=raw_f) as f:
             for line in f:
                 yield json.loads(line)
 
 
+def yield_batches(iterable, batch_size):
+    """ Yield lists of up to batch_size consecutive items from iterable. """
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def yield_matches(match_many, refs, batch_size, max_in_flight=1):
+    """ Match references in batches, keeping up to max_in_flight batches
+    being matched concurrently.
+
+    Results are yielded back in the same order as refs, and no more than
+    max_in_flight batches are read ahead of the consumer, so that memory
+    stays flat however large refs is.
+
+    Args:
+        match_many: function matching a list of references, returning
+            a list of matched references (or None)
+        refs: iterable of structured references
+        batch_size: number of references per call to match_many
+        max_in_flight: maximum number of concurrent calls to match_many
+
+    Yields:
+        matched reference or None, for each reference in refs
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_in_flight) as executor:
+        in_flight = collections.deque()
+        for batch in yield_batches(refs, batch_size):
+            if len(in_flight) >= max_in_flight:
+                yield from in_flight.popleft().result()
+            in_flight.append(executor.submit(match_many, batch))
+        while in_flight:
+            yield from in_flight.popleft().result()
+
+
+def get_index_generation(es, es_index):
+    """ Return a string identifying the current generation of an ES
+    index (or of the indices behind an alias), which changes every time
+    the index is recreated.
+    """
+    res = es.indices.get_settings(index=es_index)
+    return ','.join(sorted(
+        settings['settings']['index']['uuid'] for settings in res.values()
+    ))
+
+
+class TitleMatchCache:
+    """ Two-tier cache of the best ES hit for a given title: an in-memory
+    LRU in front of an sqlite database on local disk.
+
+    Entries are keyed by normalised title, ES index, should match
+    threshold and index generation, so that rebuilding the EPMC index
+    invalidates them. Entries from previous generations of the same
+    index are deleted when the cache is opened.
+
+    Args:
+        path: path to the sqlite database
+        es_index: name of the ES index matched against
+        should_match_threshold: minimum_should_match used for matching
+        index_generation: see get_index_generation()
+        max_size: maximum number of entries kept in memory
+    """
+
+    def __init__(self, path, es_index, should_match_threshold,
+                 index_generation, max_size=100000):
+        self.path = path
+        self.key_prefix = (
+            es_index, str(should_match_threshold), index_generation)
+        self.max_size = max_size
+        self.lru = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # Entries can always be recomputed from ES, so trade durability
+        # for speed.
+        self.db.execute('PRAGMA synchronous = OFF')
+        with self.db:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS title_matches ('
+                'title TEXT, es_index TEXT, should_match_threshold TEXT, '
+                'index_generation TEXT, best_match TEXT, '
+                'PRIMARY KEY (title, es_index, should_match_threshold, '
+                'index_generation))'
+            )
+            self.db.execute(
+                'DELETE FROM title_matches '
+                'WHERE es_index = ? AND index_generation != ?',
+                (es_index, index_generation)
+            )
+
+    @staticmethod
+    def normalise(title):
+        return ' '.join(title.lower().split())
+
+    def get(self, title):
+        """ Return a (cached, best_match) tuple for a given title. """
+        title = self.normalise(title)
+        with self.lock:
+            if title in self.lru:
+                self.lru.move_to_end(title)
+                self.memory_hits += 1
+                return True, self.lru[title]
+
+            row = self.db.execute(
+                'SELECT best_match FROM title_matches '
+                'WHERE title = ? AND es_index = ? '
+                'AND should_match_threshold = ? AND index_generation = ?',
+                (title,) + self.key_prefix
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return False, None
+
+            self.disk_hits += 1
+            best_match = json.loads(row[0])
+            self._set_lru(title, best_match)
+            return True, best_match
+
+    def set(self, title, best_match):
+        self.set_many([(title, best_match)])
+
+    def set_many(self, items):
+        """ Cache a list of (title, best_match) tuples. """
+        rows = []
+        with self.lock:
+            for title, best_match in items:
+                title = self.normalise(title)
+                self._set_lru(title, best_match)
+                rows.append(
+                    (title,) + self.key_prefix + (json.dumps(best_match),))
+            with self.db:
+                self.db.executemany(
+                    'INSERT OR REPLACE INTO title_matches '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    rows
+                )
+
+    def _set_lru(self, title, best_match):
+        self.lru[title] = best_match
+        self.lru.move_to_end(title)
+        if len(self.lru) > self.max_size:
+            self.lru.popitem(last=False)
+
+    def close(self):
+        self.db.close()
+
+    def log_stats(self):
+        total = self.memory_hits + self.disk_hits + self.misses
+        logger.info(
+            'TitleMatchCache: lookups=%d memory_hits=%d disk_hits=%d '
+            'misses=%d hit_rate=%.2f',
+            total, self.memory_hits, self.disk_hits, self.misses,
+            (self.memory_hits + self.disk_hits) / total if total else 0.0
+        )
+
+
+class MatchAggregator:
+    """ Aggregates fuzzy matched references by match_id, spilling partial
+    aggregates to sorted run files on local disk whenever more than
+    max_in_memory policies are held in memory.
+
+    Args:
+        max_in_memory: maximum number of policies to hold in memory
+        tmp_dir: directory to write run files to
+    """
+
+    def __init__(self, max_in_memory=200000, tmp_dir=None):
+        self.max_in_memory = max_in_memory
+        self.tmp_dir = tmp_dir
+        self.references = {}
+        self.in_memory = 0
+        self.runs = []
+
+    def add(self, matched_reference):
+        ref_id = matched_reference['match_id']
+        if ref_id in self.references:
+            self.merge_into(self.references[ref_id], matched_reference)
+        else:
+            self.references[ref_id] = matched_reference
+        self.in_memory += len(matched_reference['policies'])
+
+        if self.in_memory >= self.max_in_memory:
+            self.spill()
+
+    @staticmethod
+    def merge_into(reference, other):
+        reference['associated_policies_count'] += \
+            other['associated_policies_count']
+        reference['policies'].extend(other['policies'])
+
+    def spill(self):
+        """ Write the in-memory aggregates to a new run file, sorted by
+        match_id.
+        """
+        run = tempfile.TemporaryFile(mode='w+', dir=self.tmp_dir)
+        for ref_id in sorted(self.references):
+            run.write(json.dumps(self.references[ref_id]))
+            run.write('\n')
+        run.seek(0)
+        self.runs.append(run)
+        logger.info(
+            'MatchAggregator: spilled references=%d policies=%d runs=%d',
+            len(self.references), self.in_memory, len(self.runs)
+        )
+        self.references = {}
+        self.in_memory = 0
+
+    def __iter__(self):
+        """ Yield back aggregated references, sorted by match_id, k-way
+        merging the run files with what is left in memory.
+        """
+        runs = [(json.loads(line) for line in run) for run in self.runs]
+        runs.append(
+            self.references[ref_id] for ref_id in sorted(self.references)
+        )
+
+        current = None
+        for reference in heapq.merge(*runs, key=lambda r: r['match_id']):
+            if current is None:
+                current = reference
+            elif current['match_id'] == reference['match_id']:
+                self.merge_into(current, reference)
+            else:
+                yield current
+                current = reference
+        if current is not None:
+            yield current
+
+    def close(self):
+        for run in self.runs:
+            run.close()
+        self.runs = []
+        self.references = {}
+        self.in_memory = 0
+
+    def compact(self):
+        """ Merge the run files and what is left in memory into a single
+        run file, and return it, positioned at its start.
+        """
+        merged = tempfile.TemporaryFile(mode='w+', dir=self.tmp_dir)
+        for reference in self:
+            merged.write(json.dumps(reference))
+            merged.write('\n')
+        merged.seek(0)
+        self.close()
+        self.runs = [merged]
+        return merged
+
+    def load(self, f):
+        """ Add aggregated references from a text file in the format of the
+        run files, e.g. as returned by compact().
+        """
+        run = tempfile.TemporaryFile(mode='w+', dir=self.tmp_dir)
+        shutil.copyfileobj(f, run)
+        run.seek(0)
+        self.runs.append(run)
+
+
 def map_author(author):
     return "%s %s" % (
         author.get(
@@ -35,19 +309,25 @@ def map_author(author):
         ), author.get("Initials", "?"),)
 
 
-class ElasticsearchFuzzyMatcher:
+class BaseFuzzyMatcher:
+    """ Matches structured references to EPMC publications by title.
+
+    Subclasses implement match(), searching for the best hit for a title
+    and returning it in the format of an ES hit.
+    """
     MAX_TITLE_LENGTH = 512
 
-    def __init__(self, es, score_threshold, should_match_threshold,
-                 es_index, organisation, min_title_length=0):
-        self.es = es
-        self.es_index = es_index
+    def __init__(self, score_threshold, should_match_threshold,
+                 organisation, min_title_length=0):
         self.score_threshold = score_threshold
         self.min_title_length = min_title_length
         self.should_match_threshold = should_match_threshold
         self.organisation = organisation
 
-    def match(self, reference):
+    def _get_title(self, reference):
+        """ Return the title to search for a given reference, or None if
+        the reference should not be matched at all.
+        """
         if not reference.get('Title'):
             return
 
@@ -68,34 +348,28 @@ class ElasticsearchFuzzyMatcher:
                 title[:self.MAX_TITLE_LENGTH].split()[:-1]
             )
             logger.info(
-                'ElasticsearchFuzzyMatcher.match: '
+                '%s.match: '
                 'orig-length=%d doc-id=%s truncated-title=%r',
-                title_len, reference.get('document_id', "Unkown ID"), title
+                type(self).__name__, title_len,
+                reference.get('document_id', "Unkown ID"), title
             )
+        return title
 
-        body = {
-            "query": {
-                "match": {
-                    "doc.title": {
-                        "query": title,
-                        "minimum_should_match": f"{self.should_match_threshold}%"
-                    }
-                }
-            }
-        }
-        res = self.es.search(
-            index=self.es_index,
-            body=body,
-            size=1
-        )
+    def _to_matched_reference(self, reference, best_match,
+                              match_algo='Fuzzy match'):
+        """ Turn the best hit for a reference, in the format of an ES hit,
+        into a matched reference, or None if it is not good enough. Hits
+        without a score, from exact matches, are always good enough.
 
-        matches_count = res['hits']['total']['value']
-        if matches_count == 0:
+        The similarity of a matched reference is the score of its hit, on
+        the scale of the engine that found it, or None for exact matches,
+        which have no score to speak of (see match_algo).
+        """
+        if best_match is None:
             return
 
-        best_match = res['hits']['hits'][0]
         best_score = best_match['_score']
-        if best_score > self.score_threshold:
+        if best_score is None or best_score > self.score_threshold:
             matched_reference = best_match['_source']
             # logger.info(
             #     'ElasticsearchFuzzyMatcher.match: '
@@ -109,9 +383,13 @@ class ElasticsearchFuzzyMatcher:
                 'similarity': best_score,
 
                 # Matched reference information
-                'match_id': best_match.get('_id'),
+                # Identify publications by their metadata rather than by
+                # the _id of the hit, which differs between engines. See
+                # title_index.get_publication_id.
+                'match_id': title_index.get_publication_id(
+                    matched_reference.get('doc', {})),
                 'match_title': matched_reference.get('doc', {}).get('title', 'Unknown'),
-                'match_algo': 'Fuzzy match',
+                'match_algo': match_algo,
                 'match_pub_year': matched_reference.get('doc', {}).get('pubYear', None),
                 'match_authors': ", ".join(list(map(map_author, matched_reference.get('doc', {}).get('authors', [])))),
                 'match_publication': matched_reference.get('doc', {}).get('journalTitle', 'Unknown'),
@@ -134,6 +412,252 @@ class ElasticsearchFuzzyMatcher:
                 }]
             }
 
+    def match(self, reference):
+        raise NotImplementedError
+
+    def match_many(self, references):
+        """ Match a list of references, returning a list of the same
+        length holding the matched reference (or None) for each of them.
+        """
+        return [self.match(reference) for reference in references]
+
+
+class ElasticsearchFuzzyMatcher(BaseFuzzyMatcher):
+    # Searches of an _msearch request rejected by an overloaded cluster
+    # are retried up to MSEARCH_RETRIES times, waiting MSEARCH_BACKOFF
+    # seconds before the first retry and twice as long before each next.
+    MSEARCH_RETRIES = 5
+    MSEARCH_BACKOFF = 1.0
+    RETRY_STATUSES = (429, 503)
+
+    def __init__(self, es, score_threshold, should_match_threshold,
+                 es_index, organisation, min_title_length=0, cache=None):
+        super().__init__(
+            score_threshold,
+            should_match_threshold,
+            organisation,
+            min_title_length,
+        )
+        self.es = es
+        self.cache = cache
+        self.es_index = es_index
+
+    def _get_query(self, title):
+        return {
+            "query": {
+                "match": {
+                    "doc.title": {
+                        "query": title,
+                        "minimum_should_match": f"{self.should_match_threshold}%"
+                    }
+                }
+            }
+        }
+
+    def _get_best_match(self, res):
+        """ Return the best hit of an ES search response, or None. """
+        matches_count = res['hits']['total']['value']
+        if matches_count == 0:
+            return
+
+        return res['hits']['hits'][0]
+
+    def match(self, reference):
+        title = self._get_title(reference)
+        if title is None:
+            return
+
+        if self.cache is not None:
+            cached, best_match = self.cache.get(title)
+            if cached:
+                return self._to_matched_reference(reference, best_match)
+
+        res = self.es.search(
+            index=self.es_index,
+            body=self._get_query(title),
+            size=1
+        )
+        best_match = self._get_best_match(res)
+        if self.cache is not None:
+            self.cache.set(title, best_match)
+        return self._to_matched_reference(reference, best_match)
+
+    def match_many(self, references):
+        """ Match a list of references using a single _msearch request.
+
+        Searches rejected by the cluster are retried with exponential
+        backoff, and any other failed search raises, as es.search would.
+
+        Args:
+            references: list of structured references
+
+        Returns:
+            A list of the same length as references, holding the matched
+            reference (or None) for each of them.
+
+        Raises:
+            elasticsearch.exceptions.TransportError: if a search failed
+                other than by being rejected, or was still rejected after
+                MSEARCH_RETRIES retries.
+        """
+        results = [None] * len(references)
+
+        searched = []
+        for i, reference in enumerate(references):
+            title = self._get_title(reference)
+            if title is None:
+                continue
+            if self.cache is not None:
+                cached, best_match = self.cache.get(title)
+                if cached:
+                    results[i] = self._to_matched_reference(
+                        reference, best_match)
+                    continue
+            searched.append((i, title))
+
+        for retry in range(self.MSEARCH_RETRIES + 1):
+            if not searched:
+                break
+            if retry:
+                time.sleep(self.MSEARCH_BACKOFF * 2 ** (retry - 1))
+
+            searches = []
+            for i, title in searched:
+                searches.append({'index': self.es_index})
+                searches.append(dict(self._get_query(title), size=1))
+            res = self.es.msearch(body=searches)
+
+            to_cache = []
+            rejected = []
+            for (i, title), response in zip(searched, res['responses']):
+                if 'error' not in response:
+                    best_match = self._get_best_match(response)
+                    to_cache.append((title, best_match))
+                    results[i] = self._to_matched_reference(
+                        references[i], best_match)
+                    continue
+
+                logger.warning(
+                    'ElasticsearchFuzzyMatcher.match_many: '
+                    'doc-id=%s retry=%d status=%s error=%r',
+                    references[i].get('document_id', "Unkown ID"),
+                    retry, response.get('status'), response['error']
+                )
+                if response.get('status') not in self.RETRY_STATUSES or \
+                        retry == self.MSEARCH_RETRIES:
+                    raise TransportError(
+                        response.get('status', 'N/A'),
+                        str(response['error']),
+                        response['error']
+                    )
+                rejected.append((i, title))
+
+            if self.cache is not None:
+                self.cache.set_many(to_cache)
+            searched = rejected
+
+        return results
+
+
+class BM25FuzzyMatcher(BaseFuzzyMatcher):
+    """ Matches references against a local title_index.BM25TitleIndex,
+    with the same semantics as ElasticsearchFuzzyMatcher but without any
+    round-trip to Elasticsearch.
+    """
+
+    def __init__(self, index, score_threshold, should_match_threshold,
+                 organisation, min_title_length=0):
+        super().__init__(
+            score_threshold,
+            should_match_threshold,
+            organisation,
+            min_title_length,
+        )
+        self.index = index
+
+    def match(self, reference):
+        title = self._get_title(reference)
+        if title is None:
+            return
+
+        best_match = self.index.search(title, self.should_match_threshold)
+        return self._to_matched_reference(reference, best_match)
+
+
+class CascadeFuzzyMatcher(BaseFuzzyMatcher):
+    """ Looks references up in a title_index.ExactTitleIndex first, only
+    falling back to a fuzzy matcher for the ones it does not find.
+
+    References matched by the exact index have 'Exact match' as their
+    match_algo and a null similarity. Both stages identify publications
+    the same way, so their matches aggregate together.
+
+    Args:
+        exact_index: title_index.ExactTitleIndex
+        fuzzy_matcher: matcher to use for references missing from
+            exact_index
+    """
+
+    def __init__(self, exact_index, fuzzy_matcher):
+        super().__init__(
+            fuzzy_matcher.score_threshold,
+            fuzzy_matcher.should_match_threshold,
+            fuzzy_matcher.organisation,
+            fuzzy_matcher.min_title_length,
+        )
+        self.exact_index = exact_index
+        self.fuzzy_matcher = fuzzy_matcher
+        self.lock = threading.Lock()
+        self.exact_hits = 0
+        self.fuzzy_hits = 0
+        self.misses = 0
+
+    def match(self, reference):
+        return self.match_many([reference])[0]
+
+    def match_many(self, references):
+        results = [None] * len(references)
+
+        exact_hits = 0
+        fuzzy_references = []
+        fuzzy_indices = []
+        for i, reference in enumerate(references):
+            title = self._get_title(reference)
+            if title is None:
+                continue
+            best_match = self.exact_index.lookup(title)
+            if best_match is None:
+                fuzzy_references.append(reference)
+                fuzzy_indices.append(i)
+                continue
+            results[i] = self._to_matched_reference(
+                reference, best_match, 'Exact match')
+            exact_hits += 1
+
+        fuzzy_hits = 0
+        if fuzzy_references:
+            fuzzy_results = self.fuzzy_matcher.match_many(fuzzy_references)
+            for i, result in zip(fuzzy_indices, fuzzy_results):
+                results[i] = result
+                fuzzy_hits += result is not None
+
+        with self.lock:
+            self.exact_hits += exact_hits
+            self.fuzzy_hits += fuzzy_hits
+            self.misses += len(fuzzy_references) - fuzzy_hits
+        return results
+
+    def log_stats(self):
+        logger.info(
+            'CascadeFuzzyMatcher: exact_hits=%d fuzzy_hits=%d misses=%d',
+            self.exact_hits, self.fuzzy_hits, self.misses
+        )
+
+
+ENGINES = ('elasticsearch', 'bm25')
+
+CHECKPOINT_VERSION = 1
+
 
 class FuzzyMatchRefsOperator(object):
     """
@@ -151,7 +675,17 @@ class FuzzyMatchRefsOperator(object):
     def __init__(self, es_hosts, src_s3_key, dst_s3_key, es_index,
                  score_threshold=50,
                  organisation=None,
-                 should_match_threshold=80):
+                 should_match_threshold=80,
+                 batch_size=100,
+                 concurrency=1,
+                 cache_path=None,
+                 max_in_memory_matches=200000,
+                 engine='elasticsearch',
+                 title_index_path=None,
+                 exact_title_index_path=None,
+                 checkpoint_path=None,
+                 checkpoint_every=100000,
+                 resume=False):
 
         self.src_s3_key = src_s3_key
         self.dst_s3_key = dst_s3_key
@@ -159,44 +693,218 @@ class FuzzyMatchRefsOperator(object):
         self.should_match_threshold = should_match_threshold
         self.es_index = es_index
         self.organisation = organisation
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.cache_path = cache_path
+        self.max_in_memory_matches = max_in_memory_matches
+        self.engine = engine
+        self.title_index_path = title_index_path
+        self.exact_title_index_path = exact_title_index_path
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        self.resume = resume
 
-        self.es = elastic.common.connect(es_hosts)
+        if engine not in ENGINES:
+            raise ValueError('Unknown matching engine: %s' % engine)
+        if engine == 'bm25' and not title_index_path:
+            raise ValueError('The bm25 engine requires a title_index_path')
+        if resume and not checkpoint_path:
+            raise ValueError('Resuming requires a checkpoint_path')
 
-    @report_exception
-    def execute(self):
-        s3 = s3hook.S3Hook()
+        if engine == 'elasticsearch':
+            self.es = elastic.common.connect(
+                es_hosts,
+                maxsize=max(10, concurrency),
+            )
+        else:
+            self.es = None
 
-        fuzzy_matcher = ElasticsearchFuzzyMatcher(
-            self.es,
-            self.score_threshold,
-            self.should_match_threshold,
-            self.es_index,
-            self.organisation,
-        )
-        refs = yield_structured_references(s3, self.src_s3_key)
-        match_count = 0
-        count = 0
-        references = {}
-        for count, structured_reference in enumerate(refs, 1):
-            if count % 500 == 0:
+    def open_cache(self, s3):
+        """ Open the title match cache at self.cache_path, fetching it
+        to a local temporary file first if it is stored in S3.
+        """
+        if not self.cache_path.startswith('s3://'):
+            local_path = self.cache_path
+        else:
+            fd, local_path = tempfile.mkstemp(suffix='.db')
+            os.close(fd)
+            try:
+                s3.get_s3_object(self.cache_path).download_file(local_path)
+            except ClientError as e:
+                if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                    raise
                 logger.info(
-                    'FuzzyMatchRefsOperator: references=%d', count
+                    'FuzzyMatchRefsOperator: no cache found at %s',
+                    self.cache_path
                 )
-            fuzzy_matched_reference = fuzzy_matcher.match(
-                structured_reference
-            )
-            if fuzzy_matched_reference:
-                ref_id = fuzzy_matched_reference['match_id']
-                if ref_id in references.keys():
 
-                    references[ref_id][
-                        'associated_policies_count'] += 1
+        return TitleMatchCache(
+            local_path,
+            self.es_index,
+            self.should_match_threshold,
+            get_index_generation(self.es, self.es_index),
+        )
+
+    def close_cache(self, s3, cache):
+        cache.log_stats()
+        cache.close()
+        if self.cache_path.startswith('s3://'):
+            s3.load_file(cache.path, self.cache_path)
+            os.remove(cache.path)
+
+    def load_title_index(self, s3, index_class, path, tmp_dir):
+        """ Load a local title index, fetching it to tmp_dir first if it
+        is stored in S3.
+        """
+        if path.startswith('s3://'):
+            title_index.fetch_index(s3, path, tmp_dir)
+            path = tmp_dir
+        return index_class(path)
+
+    def save_checkpoint(self, s3, references, count, match_count):
+        """ Write the number of references processed so far and their
+        aggregated matches to self.checkpoint_path.
+        """
+        run = references.compact()
+        if self.checkpoint_path.startswith('s3://'):
+            dirname = None
+        else:
+            dirname = os.path.dirname(os.path.abspath(self.checkpoint_path))
+        with tempfile.NamedTemporaryFile(
+                mode='wb', dir=dirname, delete=False) as raw_f:
+            with gzip.GzipFile(mode='wb', fileobj=raw_f) as gzip_f:
+                f = io.TextIOWrapper(gzip_f, encoding='utf-8')
+                f.write(json.dumps({
+                    'version': CHECKPOINT_VERSION,
+                    'src_s3_key': self.src_s3_key,
+                    'count': count,
+                    'match_count': match_count,
+                }))
+                f.write('\n')
+                shutil.copyfileobj(run, f)
+                f.flush()
+                f.detach()
+        run.seek(0)
+
+        if dirname is None:
+            s3.load_file(raw_f.name, self.checkpoint_path)
+            os.remove(raw_f.name)
+        else:
+            # Replace the previous checkpoint atomically, so that a crash
+            # while writing leaves it intact.
+            os.replace(raw_f.name, self.checkpoint_path)
+        logger.info(
+            'FuzzyMatchRefsOperator: checkpoint references=%d matches=%d',
+            count, match_count
+        )
 
-                    references[ref_id]['policies'].append(
-                        fuzzy_matched_reference['policies'][0]
+    def load_checkpoint(self, s3, references):
+        """ Load the aggregated matches saved at self.checkpoint_path into
+        references.
+
+        Returns:
+            The number of references processed and matched at the time of
+            the checkpoint, (0, 0) if there is none.
+        """
+        try:
+            if self.checkpoint_path.startswith('s3://'):
+                raw_f = s3.open_stream(self.checkpoint_path)
+            else:
+                raw_f = open(self.checkpoint_path, 'rb')
+        except (ClientError, FileNotFoundError) as e:
+            if isinstance(e, ClientError) and \
+                    e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                raise
+            logger.info(
+                'FuzzyMatchRefsOperator: no checkpoint found at %s',
+                self.checkpoint_path
+            )
+            return 0, 0
+
+        with raw_f, gzip.GzipFile(mode='rb', fileobj=raw_f) as gzip_f:
+            f = io.TextIOWrapper(gzip_f, encoding='utf-8')
+            header = json.loads(f.readline())
+            if header['version'] != CHECKPOINT_VERSION:
+                raise ValueError(
+                    'Unsupported checkpoint version: %s' % header['version'])
+            if header['src_s3_key'] != self.src_s3_key:
+                raise ValueError(
+                    'Checkpoint at %s is for %s, not %s' % (
+                        self.checkpoint_path,
+                        header['src_s3_key'],
+                        self.src_s3_key,
                     )
-                else:
-                    references[ref_id] = fuzzy_matched_reference
+                )
+            references.load(f)
+
+        logger.info(
+            'FuzzyMatchRefsOperator: resuming from references=%d matches=%d',
+            header['count'], header['match_count']
+        )
+        return header['count'], header['match_count']
+
+    def remove_checkpoint(self, s3):
+        if self.checkpoint_path.startswith('s3://'):
+            s3.get_s3_object(self.checkpoint_path).delete()
+        elif os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+    @report_exception
+    def execute(self):
+        s3 = s3hook.S3Hook()
+
+        cache = None
+        tmp_dir = tempfile.TemporaryDirectory()
+        if self.engine == 'bm25':
+            fuzzy_matcher = BM25FuzzyMatcher(
+                self.load_title_index(
+                    s3,
+                    title_index.BM25TitleIndex,
+                    self.title_index_path,
+                    os.path.join(tmp_dir.name, 'bm25'),
+                ),
+                self.score_threshold,
+                self.should_match_threshold,
+                self.organisation,
+            )
+        else:
+            if self.cache_path:
+                cache = self.open_cache(s3)
+            fuzzy_matcher = ElasticsearchFuzzyMatcher(
+                self.es,
+                self.score_threshold,
+                self.should_match_threshold,
+                self.es_index,
+                self.organisation,
+                cache=cache,
+            )
+        if self.exact_title_index_path:
+            fuzzy_matcher = CascadeFuzzyMatcher(
+                self.load_title_index(
+                    s3,
+                    title_index.ExactTitleIndex,
+                    self.exact_title_index_path,
+                    os.path.join(tmp_dir.name, 'exact'),
+                ),
+                fuzzy_matcher,
+            )
+        references = MatchAggregator(self.max_in_memory_matches)
+        count = 0
+        match_count = 0
+        if self.resume:
+            count, match_count = self.load_checkpoint(s3, references)
+
+        refs = itertools.islice(
+            yield_structured_references(s3, self.src_s3_key), count, None)
+        fuzzy_matched_references = yield_matches(
+            fuzzy_matcher.match_many,
+            refs,
+            self.batch_size,
+            self.concurrency,
+        )
+        for fuzzy_matched_reference in fuzzy_matched_references:
+            if fuzzy_matched_reference:
+                references.add(fuzzy_matched_reference)
 
                 match_count += 1
                 if match_count % 100 == 0:
@@ -205,33 +913,39 @@ class FuzzyMatchRefsOperator(object):
                         match_count
                     )
 
-        with tempfile.NamedTemporaryFile(mode='wb') as output_raw_f:
-            with gzip.GzipFile(mode='wb', fileobj=output_raw_f) as output_f:
-                # This probably looks really odd, but we're basically ensuring that if there are no citations,
-                # that we still at least write a blank string to the start of the file so that
-                # the pipeline doesn't freak out on openining an empty GZip file
-                output_f.write(b' ')
-                for reference in references.values():
-                    output_f.write(json.dumps(reference).encode('utf-8'))
-                    output_f.write(b'\n')
-
-            output_raw_f.flush()
-            s3.load_file(
-                output_raw_f.name,
-                self.dst_s3_key,
+            count += 1
+            if count % 500 == 0:
+                logger.info(
+                    'FuzzyMatchRefsOperator: references=%d', count
+                )
+            if self.checkpoint_path and count % self.checkpoint_every == 0:
+                self.save_checkpoint(s3, references, count, match_count)
+
+        if cache is not None:
+            self.close_cache(s3, cache)
+        if self.exact_title_index_path:
+            fuzzy_matcher.log_stats()
+        tmp_dir.cleanup()
+
+        with s3.open_json_gz_writer(self.dst_s3_key) as output_writer:
+            # This probably looks really odd, but we're basically ensuring that if there are no citations,
+            # that we still at least write a blank string to the start of the file so that
+            # the pipeline doesn't freak out on openining an empty GZip file
+            output_writer.write_bytes(b' ')
+            for reference in references:
+                output_writer.write(reference)
+        references.close()
+
+        logger.info(
+                'FuzzyMatchRefsOperator: Matches saved to %s',
+                s3.get_s3_object(self.dst_s3_key)
             )
 
-            logger.info(
-                    'FuzzyMatchRefsOperator: Matches saved to %s',
-                    s3.get_s3_object(self.dst_s3_key)
-                )
+        if self.checkpoint_path:
+            self.remove_checkpoint(s3)
 
 
 if __name__ == '__main__':
-    es_host = os.environ['ES_HOST']
-    es_port = os.environ.get('ES_PORT', 9200)
-
-    es_hosts = [(es_host, es_port)]
     arg_parser = argparse.ArgumentParser(
         description='Run a web scraper for a given organisation and writes the'
                     ' results to the given S3 path.'
@@ -259,14 +973,81 @@ if __name__ == '__main__':
         default=50,
         help="The maximum number of items to index."
     )
+    arg_parser.add_argument(
+        '--concurrency',
+        default=1,
+        type=int,
+        help="The maximum number of ES requests to keep in flight."
+    )
     arg_parser.add_argument(
         '--should_match_threshold',
         default=80,
         help="The maximum number of items to index."
     )
+    arg_parser.add_argument(
+        '--cache_path',
+        default=None,
+        help="Local path or S3 URL of a title match cache to use and update."
+    )
+    arg_parser.add_argument(
+        '--engine',
+        default='elasticsearch',
+        choices=ENGINES,
+        help="The engine to match references with."
+    )
+    arg_parser.add_argument(
+        '--title_index_path',
+        default=None,
+        help="Local path or S3 URL of the title index used by the bm25"
+             " engine, as built by title_index.py."
+    )
+    arg_parser.add_argument(
+        '--exact_title_index_path',
+        default=None,
+        help="Local path or S3 URL of an exact title index, as built by"
+             " title_index.py, to look references up in before fuzzy"
+             " matching them."
+    )
+    arg_parser.add_argument(
+        '--max_in_memory_matches',
+        default=200000,
+        type=int,
+        help="The number of matched policies to aggregate in memory before"
+             " spilling them to local disk."
+    )
+    arg_parser.add_argument(
+        '--batch_size',
+        default=100,
+        type=int,
+        help="The number of references to match per ES _msearch request."
+    )
+    arg_parser.add_argument(
+        '--checkpoint_path',
+        default=None,
+        help="Local path or S3 URL to periodically save the progress of the"
+             " run to."
+    )
+    arg_parser.add_argument(
+        '--checkpoint_every',
+        default=100000,
+        type=int,
+        help="The number of references to match between checkpoints."
+    )
+    arg_parser.add_argument(
+        '--resume',
+        action='store_true',
+        help="Continue from the checkpoint at --checkpoint_path, if any."
+    )
 
     args = arg_parser.parse_args()
 
+    if args.engine == 'elasticsearch':
+        es_host = os.environ['ES_HOST']
+        es_port = os.environ.get('ES_PORT', 9200)
+        es_hosts = [(es_host, es_port)]
+    else:
+        es_hosts = None
+
     fuzzy_matcher = FuzzyMatchRefsOperator(
         es_hosts,
         args.src_s3_key,
@@ -274,6 +1055,16 @@ if __name__ == '__main__':
         args.epmc_es_index,
         score_threshold=args.score_threshold,
         organisation=args.organisation,
-        should_match_threshold=args.should_match_threshold
+        should_match_threshold=args.should_match_threshold,
+        batch_size=args.batch_size,
+        concurrency=args.concurrency,
+        cache_path=args.cache_path,
+        max_in_memory_matches=args.max_in_memory_matches,
+        engine=args.engine,
+        title_index_path=args.title_index_path,
+        exact_title_index_path=args.exact_title_index_path,
+        checkpoint_path=args.checkpoint_path,
+        checkpoint_every=args.checkpoint_every,
+        resume=args.resume,
     )
     fuzzy_matcher.execute()
@@ -0,0 +1,489 @@
+import gzip
+import io
+import json
+import os
+import threading
+import time
+
+import pytest
+from elasticsearch.exceptions import TransportError
+
+import elastic.common
+import fuzzymatcher_task
+from fuzzymatcher_task import (BaseFuzzyMatcher, BM25FuzzyMatcher,
+                               CascadeFuzzyMatcher, ElasticsearchFuzzyMatcher,
+                               FuzzyMatchRefsOperator, MatchAggregator,
+                               TitleMatchCache, yield_matches)
+from hooks.s3hook import GzipJsonWriter
+from title_index import BM25TitleIndex
+
+BEST_MATCH = {'_id': 'a', '_score': 60.0, '_source': {'doc': {'title': 'A'}}}
+
+
+@pytest.fixture
+def cache_path(tmpdir):
+    return str(tmpdir.join('cache.db'))
+
+
+def open_cache(path, index_generation='uuid1', max_size=100):
+    return TitleMatchCache(path, 'epmc', 80, index_generation, max_size)
+
+
+def test_cache_miss(cache_path):
+    cache = open_cache(cache_path)
+    assert cache.get('Malaria') == (False, None)
+    assert cache.misses == 1
+
+def test_cache_hit(cache_path):
+    cache = open_cache(cache_path)
+    cache.set('Malaria', BEST_MATCH)
+    cache.set('Zika', None)
+    assert cache.get(' malaria ') == (True, BEST_MATCH)
+    assert cache.get('ZIKA') == (True, None)
+    assert (cache.memory_hits, cache.disk_hits) == (2, 0)
+
+def test_cache_hit_on_disk(cache_path):
+    cache = open_cache(cache_path, max_size=1)
+    cache.set_many([('Malaria', BEST_MATCH), ('Zika', None)])
+    assert cache.get('Malaria') == (True, BEST_MATCH)
+    assert cache.disk_hits == 1
+    cache.close()
+
+    cache = open_cache(cache_path)
+    assert cache.get('Zika') == (True, None)
+    assert (cache.memory_hits, cache.disk_hits) == (0, 1)
+
+def test_cache_index_generation_change(cache_path):
+    cache = open_cache(cache_path)
+    cache.set('Malaria', BEST_MATCH)
+    cache.close()
+
+    cache = open_cache(cache_path, index_generation='uuid2')
+    assert cache.get('Malaria') == (False, None)
+    cache.close()
+
+    # Entries of the previous generation were deleted
+    cache = open_cache(cache_path)
+    assert cache.get('Malaria') == (False, None)
+
+
+class SlowMatcher:
+    """ match_many returning each reference doubled, with earlier batches
+    of every max_in_flight finishing last.
+    """
+    def __init__(self, max_in_flight):
+        self.max_in_flight = max_in_flight
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_seen = 0
+        self.finished = []
+
+    def match_many(self, batch):
+        with self.lock:
+            self.in_flight += 1
+            self.max_seen = max(self.max_seen, self.in_flight)
+        position = batch[0] // len(batch) % self.max_in_flight
+        time.sleep(0.05 * (self.max_in_flight - position))
+        with self.lock:
+            self.in_flight -= 1
+            self.finished.append(batch[0])
+        return [ref * 2 for ref in batch]
+
+def test_yield_matches_in_order():
+    matcher = SlowMatcher(3)
+    read = []
+    def refs():
+        for ref in range(40):
+            read.append(ref)
+            yield ref
+
+    results = []
+    for result in yield_matches(
+            matcher.match_many, refs(), 4, max_in_flight=3):
+        # At most max_in_flight batches are read ahead of the consumer
+        assert len(read) <= (len(results) // 4 + 1 + 3) * 4
+        results.append(result)
+
+    assert results == [ref * 2 for ref in range(40)]
+    assert matcher.max_seen == 3
+    assert matcher.finished != sorted(matcher.finished)
+    assert sorted(matcher.finished) == list(range(0, 40, 4))
+
+def matched_reference(match_id, doc_id):
+    return {
+        'match_id': match_id,
+        'associated_policies_count': 1,
+        'policies': [{'doc_id': doc_id}],
+    }
+
+
+def aggregate(matched_references, max_in_memory):
+    aggregator = MatchAggregator(max_in_memory)
+    for reference in matched_references:
+        aggregator.add(reference)
+    runs = len(aggregator.runs)
+    aggregated = list(aggregator)
+    aggregator.close()
+    return runs, aggregated
+
+
+@pytest.fixture
+def matched_references():
+    return [
+        matched_reference(match_id, doc_id)
+        for doc_id in range(10)
+        for match_id in ('c', 'a', 'b', str(doc_id))
+    ]
+
+def test_aggregator_in_memory(matched_references):
+    runs, aggregated = aggregate(matched_references, 1000)
+    assert runs == 0
+    assert [r['match_id'] for r in aggregated] == sorted(
+        {r['match_id'] for r in matched_references})
+    a = aggregated[-3]
+    assert a['match_id'] == 'a'
+    assert a['associated_policies_count'] == 10
+    assert [p['doc_id'] for p in a['policies']] == list(range(10))
+
+def test_aggregator_spills(matched_references):
+    _, expected = aggregate(
+        [dict(r, policies=list(r['policies'])) for r in matched_references],
+        1000
+    )
+    runs, aggregated = aggregate(matched_references, 3)
+    assert runs == 13
+    assert aggregated == expected
+
+def test_aggregator_compact_and_load(matched_references):
+    _, expected = aggregate(
+        [dict(r, policies=list(r['policies'])) for r in matched_references],
+        1000
+    )
+    aggregator = MatchAggregator(5)
+    for reference in matched_references[:20]:
+        aggregator.add(reference)
+    run = aggregator.compact()
+
+    resumed = MatchAggregator(5)
+    resumed.load(run)
+    for reference in matched_references[20:]:
+        resumed.add(reference)
+    assert list(resumed) == expected
+    aggregator.close()
+    resumed.close()
+
+
+def test_bm25_engine_does_not_connect(monkeypatch):
+    def connect(*args, **kwargs):
+        raise AssertionError('Connected to Elasticsearch')
+    monkeypatch.setattr(elastic.common, 'connect', connect)
+
+    operator = FuzzyMatchRefsOperator(
+        None, 's3://bucket/src.json.gz', 's3://bucket/dst.json.gz', 'epmc',
+        engine='bm25', title_index_path='s3://bucket/bm25/')
+    assert operator.es is None
+
+def test_match_id_same_across_engines(tmpdir):
+    publication = {'title': 'Malaria vaccines: a review', 'doi': '10.1/3'}
+    path = str(tmpdir.join('bm25'))
+    BM25TitleIndex.build([publication], path)
+    bm25_matcher = BM25FuzzyMatcher(BM25TitleIndex(path), 0, 80, 'acme')
+
+    es_hit = {
+        '_id': 'AXb3kz9aYz', '_score': 60.0, '_source': {'doc': publication}}
+    reference = {'Title': 'Malaria vaccines: a review'}
+    es_matched = bm25_matcher._to_matched_reference(reference, es_hit)
+    bm25_matched = bm25_matcher.match(reference)
+    assert es_matched['match_id'] == bm25_matched['match_id'] == '10.1/3'
+
+
+
+def es_hit(publication, score=60.0):
+    return {'_id': 'es-generated', '_score': score,
+            '_source': {'doc': publication}}
+
+
+def es_response(*hits):
+    return {'hits': {'total': {'value': len(hits)}, 'hits': list(hits)}}
+
+
+REJECTED = {'status': 429, 'error': {'type': 'es_rejected_execution_exception'}}
+
+
+class FakeES:
+    """ Answers each _msearch request with the next list of responses,
+    keeping the searches it was sent.
+    """
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def msearch(self, body):
+        self.requests.append(body)
+        return {'responses': self.responses.pop(0)}
+
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(fuzzymatcher_task.time, 'sleep', sleeps.append)
+    return sleeps
+
+def es_matcher(es, cache=None):
+    return ElasticsearchFuzzyMatcher(
+        es, 50, 80, 'epmc', 'acme', min_title_length=3, cache=cache)
+
+def test_es_match_many(cache_path):
+    malaria = {'title': 'Malaria', 'pmid': '1'}
+    es = FakeES([es_response(es_hit(malaria)), es_response(),
+                 es_response(es_hit(malaria, 10.0))])
+    cache = open_cache(cache_path)
+    cache.set('Zika', None)
+    long_title = 'word ' * 200
+    references = [
+        {'Title': 'Malaria', 'reference_id': 'r0'},
+        {'Title': 'Zika'},
+        {'Title': 'ab'},
+        {},
+        {'Title': long_title},
+        {'Title': 'Malaria in Africa'},
+    ]
+    results = es_matcher(es, cache).match_many(references)
+
+    assert [r and r['reference_id'] for r in results] == \
+        ['r0', None, None, None, None, None]
+    assert results[0]['match_id'] == '1'
+    assert results[0]['similarity'] == 60.0
+
+    truncated_title = ' '.join(long_title[:512].split()[:-1])
+    query = {'match': {'doc.title': {
+        'query': None, 'minimum_should_match': '80%'}}}
+    expected = []
+    for title in ['Malaria', truncated_title, 'Malaria in Africa']:
+        query['match']['doc.title']['query'] = title
+        expected.append({'index': 'epmc'})
+        expected.append({'query': json.loads(json.dumps(query)), 'size': 1})
+    assert es.requests == [expected]
+
+    # Searched titles were cached, whether they were matched or not
+    assert cache.get('Malaria') == (True, es_hit(malaria))
+    assert cache.get(truncated_title) == (True, None)
+
+def test_es_match_many_retries_rejected(cache_path, no_backoff):
+    malaria = {'title': 'Malaria', 'pmid': '1'}
+    zika = {'title': 'Zika', 'pmid': '2'}
+    es = FakeES(
+        [es_response(es_hit(malaria)), REJECTED],
+        [REJECTED],
+        [es_response(es_hit(zika))],
+    )
+    cache = open_cache(cache_path)
+    results = es_matcher(es, cache).match_many(
+        [{'Title': 'Malaria'}, {'Title': 'Zika'}])
+
+    assert [r['match_id'] for r in results] == ['1', '2']
+    assert [len(request) for request in es.requests] == [4, 2, 2]
+    assert es.requests[1][1]['query']['match']['doc.title']['query'] == \
+        'Zika'
+    assert no_backoff == [1.0, 2.0]
+    assert cache.get('Zika') == (True, es_hit(zika))
+
+def test_es_match_many_gives_up(no_backoff):
+    retries = ElasticsearchFuzzyMatcher.MSEARCH_RETRIES
+    es = FakeES(*[[REJECTED]] * (retries + 1))
+    with pytest.raises(TransportError):
+        es_matcher(es).match_many([{'Title': 'Malaria'}])
+    assert len(es.requests) == retries + 1
+
+def test_es_match_many_error(cache_path, no_backoff):
+    malaria = {'title': 'Malaria', 'pmid': '1'}
+    es = FakeES([
+        es_response(es_hit(malaria)),
+        {'status': 400, 'error': {'type': 'search_phase_execution_exception'}},
+    ])
+    cache = open_cache(cache_path)
+    with pytest.raises(TransportError) as e:
+        es_matcher(es, cache).match_many(
+            [{'Title': 'Malaria'}, {'Title': 'Zika'}])
+    assert e.value.status_code == 400
+    assert len(es.requests) == 1
+    assert no_backoff == []
+    assert cache.get('Zika') == (False, None)
+
+class FakeExactIndex:
+    def __init__(self, publications):
+        self.publications = {
+            publication['title'].lower(): publication
+            for publication in publications
+        }
+
+    def lookup(self, title):
+        publication = self.publications.get(title.lower())
+        if publication is not None:
+            return {'_id': 'exact', '_score': None,
+                    '_source': {'doc': publication}}
+
+
+class FakeFuzzyMatcher(BaseFuzzyMatcher):
+    def __init__(self, publications):
+        super().__init__(50, 80, 'acme')
+        self.publications = publications
+        self.titles = []
+
+    def match(self, reference):
+        self.titles.append(reference['Title'])
+        for publication in self.publications:
+            if publication['title'].lower() in reference['Title'].lower():
+                hit = {'_id': 'es-generated', '_score': 60.0,
+                       '_source': {'doc': publication}}
+                return self._to_matched_reference(reference, hit)
+
+
+@pytest.fixture
+def cascade():
+    malaria = {'title': 'Malaria', 'pmid': '1'}
+    zika = {'title': 'Zika', 'pmid': '2'}
+    fuzzy_matcher = FakeFuzzyMatcher([malaria, zika])
+    return CascadeFuzzyMatcher(FakeExactIndex([malaria]), fuzzy_matcher)
+
+def test_cascade(cascade):
+    references = [
+        {'Title': 'malaria', 'metadata': {'file_hash': 'a'}},
+        {'Title': 'Zika outbreaks'},
+        {'Title': 'Ebola'},
+        {},
+        {'Title': 'Malaria in Africa', 'metadata': {'file_hash': 'b'}},
+    ]
+    results = cascade.match_many(references)
+
+    assert [r and r['match_id'] for r in results] == \
+        ['1', '2', None, None, '1']
+    assert [r and r['match_algo'] for r in results] == \
+        ['Exact match', 'Fuzzy match', None, None, 'Fuzzy match']
+    assert [r and r['similarity'] for r in results] == \
+        [None, 60.0, None, None, 60.0]
+    # Only references missing from the exact index are fuzzy matched
+    assert cascade.fuzzy_matcher.titles == \
+        ['Zika outbreaks', 'Ebola', 'Malaria in Africa']
+    assert (cascade.exact_hits, cascade.fuzzy_hits, cascade.misses) == \
+        (1, 2, 1)
+
+def test_cascade_matches_aggregate_together(cascade):
+    aggregator = MatchAggregator()
+    for result in cascade.match_many([
+            {'Title': 'Malaria', 'metadata': {'file_hash': 'a'}},
+            {'Title': 'Malaria in Africa', 'metadata': {'file_hash': 'b'}}]):
+        aggregator.add(result)
+    aggregated = list(aggregator)
+    assert len(aggregated) == 1
+    assert aggregated[0]['associated_policies_count'] == 2
+    assert [p['doc_id'] for p in aggregated[0]['policies']] == ['a', 'b']
+
+
+class FakeUploadStream(io.BytesIO):
+    def __init__(self, objects, key):
+        super().__init__()
+        self.objects = objects
+        self.key = key
+
+    def close(self):
+        if not self.closed:
+            self.objects[self.key] = self.getvalue()
+        super().close()
+
+    def abort(self):
+        super().close()
+
+
+class FakeS3Hook:
+    def __init__(self, objects):
+        self.objects = objects
+
+    def open_stream(self, key):
+        return io.BytesIO(self.objects[key])
+
+    def open_json_gz_writer(self, key):
+        return GzipJsonWriter(FakeUploadStream(self.objects, key))
+
+    def get_s3_object(self, key):
+        return key
+
+
+def read_output(data):
+    return [
+        json.loads(line)
+        for line in gzip.decompress(data).split(b'\n')
+        if line.strip()
+    ]
+
+
+@pytest.fixture
+def checkpoint_run(tmpdir, monkeypatch):
+    publications = [
+        {'title': 'Publication about topic %d' % i, 'pmid': str(i)}
+        for i in range(4)
+    ]
+    index_path = str(tmpdir.join('bm25'))
+    BM25TitleIndex.build(publications, index_path)
+
+    titles = [publication['title'] for publication in publications]
+    references = [
+        {'Title': (titles + ['Ebola outbreak'])[i % 5],
+         'metadata': {'file_hash': 'doc-%d' % i}}
+        for i in range(20)
+    ]
+    objects = {'s3://bucket/src.json.gz': gzip.compress(b''.join(
+        json.dumps(reference).encode('utf-8') + b'\n'
+        for reference in references))}
+    monkeypatch.setattr(
+        fuzzymatcher_task.s3hook, 'S3Hook', lambda: FakeS3Hook(objects))
+
+    searched = []
+    search = BM25TitleIndex.search
+
+    def run(checkpoint_path=None, resume=False, crash_at=None):
+        def recording_search(index, title, should_match_threshold):
+            if len(searched) == crash_at:
+                raise RuntimeError('Crashed')
+            searched.append(title)
+            return search(index, title, should_match_threshold)
+        monkeypatch.setattr(BM25TitleIndex, 'search', recording_search)
+        del searched[:]
+
+        operator = FuzzyMatchRefsOperator(
+            None, 's3://bucket/src.json.gz', 's3://bucket/dst.json.gz',
+            'epmc', score_threshold=0, organisation='acme',
+            batch_size=1, engine='bm25', title_index_path=index_path,
+            checkpoint_path=checkpoint_path, checkpoint_every=3,
+            resume=resume)
+        operator.execute()
+        return read_output(objects.pop('s3://bucket/dst.json.gz'))
+
+    run.references = references
+    run.searched = searched
+    return run
+
+def test_resume_from_checkpoint(tmpdir, checkpoint_run):
+    expected = checkpoint_run()
+    assert len(expected) == 4
+    assert sum(r['associated_policies_count'] for r in expected) == 16
+
+    checkpoint_path = str(tmpdir.join('checkpoint.json.gz'))
+    with pytest.raises(RuntimeError):
+        checkpoint_run(checkpoint_path, crash_at=13)
+    assert os.path.exists(checkpoint_path)
+
+    output = checkpoint_run(checkpoint_path, resume=True)
+    # The last checkpoint was after 12 references, only those after it
+    # are matched again
+    assert checkpoint_run.searched == [
+        reference['Title'] for reference in checkpoint_run.references[12:]]
+    assert output == expected
+    assert not os.path.exists(checkpoint_path)
+
+def test_resume_without_checkpoint(tmpdir, checkpoint_run):
+    expected = checkpoint_run()
+    output = checkpoint_run(
+        str(tmpdir.join('checkpoint.json.gz')), resume=True)
+    assert len(checkpoint_run.searched) == 20
+    assert output == expected
@@ -0,0 +1,91 @@
+import pytest
+
+import title_index
+from title_index import BM25TitleIndex, ExactTitleIndex
+
+
+@pytest.fixture
+def publications():
+    return [
+        {'title': 'Malaria in sub-Saharan Africa', 'pmid': '1',
+         'authors': [{'LastName': 'Smith'}], 'abstract': 'Not kept'},
+        {'title': 'Zika virus transmission', 'pmcid': 'PMC2'},
+        {'title': 'Malaria vaccines: a review', 'doi': '10.1/3'},
+        {'title': 'Tuberculosis treatment outcomes'},
+        {'pmid': '5'},
+        {'title': 'zika virus  transmission!', 'pmid': '6'},
+    ]
+
+
+def test_get_publication_id(publications):
+    ids = [title_index.get_publication_id(p) for p in publications]
+    assert ids[:3] == ['1', 'PMC2', '10.1/3']
+    assert ids[3].startswith('meta-')
+    assert ids[3] == title_index.get_publication_id(
+        {'title': 'tuberculosis Treatment outcomes.'})
+
+def test_get_publication_id_same_title():
+    publication = {
+        'title': 'Annual report', 'pubYear': '2018',
+        'journalTitle': 'Lancet', 'authors': [{'LastName': 'Smith'}]}
+    publication_id = title_index.get_publication_id(publication)
+    assert publication_id == title_index.get_publication_id(
+        dict(publication, title='ANNUAL REPORT.'))
+    for key, value in [
+            ('pubYear', '2019'),
+            ('journalTitle', 'BMJ'),
+            ('authors', [{'LastName': 'Jones'}])]:
+        assert publication_id != title_index.get_publication_id(
+            dict(publication, **{key: value}))
+
+def test_bm25_round_trip(tmpdir, publications):
+    path = str(tmpdir.join('bm25'))
+    assert BM25TitleIndex.build(iter(publications), path) == 5
+
+    index = BM25TitleIndex(path)
+    hit = index.search('Malaria vaccines review', 60)
+    assert hit['_id'] == '10.1/3'
+    assert hit['_score'] > 0
+    assert hit['_source'] == {
+        'doc': {'title': 'Malaria vaccines: a review', 'doi': '10.1/3'}}
+
+    hit = index.search('Malaria in Africa', 80)
+    assert hit['_id'] == '1'
+    assert hit['_source']['doc']['authors'] == [{'LastName': 'Smith'}]
+    assert 'abstract' not in hit['_source']['doc']
+
+    assert index.search('Ebola outbreak', 50) is None
+    assert index.search('Malaria ebola outbreak', 80) is None
+    assert index.search('', 80) is None
+
+def test_bm25_ranking(tmpdir, publications):
+    path = str(tmpdir.join('bm25'))
+    BM25TitleIndex.build(iter(publications), path)
+    index = BM25TitleIndex(path)
+    # Shorter titles score higher, and ties go to the first publication
+    assert index.search('Malaria', 100)['_id'] == '10.1/3'
+    assert index.search('Zika virus transmission', 100)['_id'] == 'PMC2'
+
+def test_exact_round_trip(tmpdir, publications):
+    path = str(tmpdir.join('exact'))
+    # The duplicate Zika title is only indexed once
+    assert ExactTitleIndex.build(iter(publications), path) == 4
+
+    index = ExactTitleIndex(path)
+    hit = index.lookup('ZIKA virus transmission.')
+    assert hit == {
+        '_id': 'PMC2',
+        '_score': None,
+        '_source': {'doc': {'title': 'Zika virus transmission',
+                            'pmcid': 'PMC2'}},
+    }
+    hit = index.lookup('Tuberculosis treatment outcomes')
+    assert hit['_id'] == title_index.get_publication_id(publications[3])
+
+    assert index.lookup('Malaria') is None
+    assert index.lookup('') is None
+
+def test_exact_empty(tmpdir):
+    path = str(tmpdir.join('exact'))
+    assert ExactTitleIndex.build(iter([]), path) == 0
+    assert ExactTitleIndex(path).lookup('Malaria') is None
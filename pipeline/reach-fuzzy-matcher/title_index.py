@@ -0,0 +1,508 @@
+#!/usr/bin/env python3
+"""
+Local indexes over EPMC publication titles, stored as memory-mapped
+arrays, so that the fuzzy matcher can match references without querying
+Elasticsearch.
+
+To build an index from the EPMC metadata ingested into Elasticsearch by
+elastic.epmc_metadata:
+
+    ./title_index.py \
+        s3://datalabs-staging/airflow/output/open-research/epmc-metadata/epmc-metadata.json.gz \
+        s3://datalabs-staging/reach/epmc-title-index/
+
+Pass --index_type exact to build the exact title index instead.
+"""
+import argparse
+import array
+import bisect
+import gzip
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import tempfile
+
+import numpy as np
+
+from hooks import s3hook
+from string_table import StringTable
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Approximates the tokenisation of Elasticsearch's standard analyzer.
+TOKEN_RE = re.compile(r'\w+')
+
+# Fields of the EPMC metadata kept in the index, as used by the fuzzy
+# matcher to describe a matched publication.
+SOURCE_FIELDS = (
+    'title',
+    'pubYear',
+    'authors',
+    'journalTitle',
+    'pmcid',
+    'pmid',
+    'doi',
+    'journalISSN',
+)
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower())
+
+
+def normalise_title(title):
+    """ Lowercase a title and strip its punctuation and extra whitespace.
+    """
+    return ' '.join(tokenize(title))
+
+
+def hash_title(normalised_title):
+    """ Return a stable, non-zero 64 bit hash of a normalised title. """
+    digest = hashlib.blake2b(
+        normalised_title.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') or 1
+
+
+def get_publication_id(publication):
+    """ Return a stable identifier for an EPMC publication, from its
+    metadata only, so that it is the same whichever index or engine it
+    was matched with.
+
+    Publications without a pmid, pmcid or doi are identified by a hash of
+    their title, year, journal and authors, so that distinct publications
+    sharing a title are not taken for one another.
+    """
+    for key in ('pmid', 'pmcid', 'doi'):
+        if publication.get(key):
+            return str(publication[key])
+    authors = ';'.join(
+        '%s %s' % (author.get('LastName', ''), author.get('Initials', ''))
+        for author in publication.get('authors') or []
+    )
+    metadata = '\t'.join([
+        normalise_title(publication.get('title') or ''),
+        str(publication.get('pubYear') or ''),
+        normalise_title(publication.get('journalTitle') or ''),
+        normalise_title(authors),
+    ])
+    return 'meta-%016x' % hash_title(metadata)
+
+
+def get_source(publication):
+    """ Return the part of an EPMC publication kept in an index. """
+    return dict(
+        (key, publication[key]) for key in SOURCE_FIELDS
+        if key in publication
+    )
+
+
+def write_publications(path, publications):
+    """ Write the ids and sources string tables of an index from an
+    iterable of (row, publication) pairs.
+
+    Returns:
+        The list of files written.
+    """
+    files = []
+    with tempfile.TemporaryFile(mode='w+') as ids_f:
+        # Write sources first, keeping ids aside, so that neither has to be
+        # held in memory.
+        def yield_sources():
+            for row, publication in publications:
+                ids_f.write(get_publication_id(publication) + '\n')
+                yield json.dumps(get_source(publication))
+        files += StringTable.write(path, 'sources', yield_sources())
+        ids_f.seek(0)
+        files += StringTable.write(
+            path, 'ids', (line[:-1] for line in ids_f))
+    return files
+
+
+class BM25TitleIndex:
+    """
+    Inverted index over EPMC publication titles, scored like an
+    Elasticsearch match query on doc.title: BM25 with Elasticsearch's
+    default parameters, and a minimum_should_match percentage of query
+    terms that a title must contain.
+
+    All arrays are memory-mapped, so that loading an index is immediate
+    and several processes on a node share its pages.
+
+    Args:
+        path: directory the index was built into, see build()
+    """
+
+    VERSION = 1
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != self.VERSION:
+            raise ValueError(
+                'Unsupported title index version: %s' % meta['version'])
+
+        self.num_docs = meta['num_docs']
+        self.avg_doc_length = meta['avg_doc_length']
+        self.terms = StringTable.load(path, 'terms')
+        self.ids = StringTable.load(path, 'ids')
+        self.sources = StringTable.load(path, 'sources')
+        self.postings_offsets = np.load(
+            os.path.join(path, 'postings_offsets.npy'), mmap_mode='r')
+        self.postings_docs = np.load(
+            os.path.join(path, 'postings_docs.npy'), mmap_mode='r')
+        self.postings_tfs = np.load(
+            os.path.join(path, 'postings_tfs.npy'), mmap_mode='r')
+        self.doc_lengths = np.load(
+            os.path.join(path, 'doc_lengths.npy'), mmap_mode='r')
+
+    @classmethod
+    def build(cls, publications, path):
+        """ Build an index over an iterable of EPMC publication dicts into
+        the directory at path.
+
+        Returns:
+            The number of publications indexed.
+        """
+        vocabulary = {}
+        term_ids = array.array('q')
+        doc_ids = array.array('q')
+        tfs = array.array('q')
+        doc_lengths = array.array('q')
+
+        def yield_publications():
+            for publication in publications:
+                if not publication.get('title'):
+                    continue
+                row = len(doc_lengths)
+                tokens = tokenize(publication['title'])
+                counts = {}
+                for token in tokens:
+                    counts[token] = counts.get(token, 0) + 1
+                for token, count in counts.items():
+                    term_ids.append(vocabulary.setdefault(
+                        token, len(vocabulary)))
+                    doc_ids.append(row)
+                    tfs.append(count)
+                doc_lengths.append(len(tokens))
+
+                if row % 100000 == 0:
+                    logger.info('BM25TitleIndex.build: publications=%d', row)
+                yield row, publication
+
+        os.makedirs(path, exist_ok=True)
+        files = write_publications(path, yield_publications())
+
+        # Number terms in sorted order so that they can be looked up by
+        # bisection, then group postings by term. Postings of a term stay
+        # sorted by document.
+        sorted_terms = sorted(vocabulary)
+        ranks = np.empty(len(vocabulary), dtype=np.int64)
+        for rank, term in enumerate(sorted_terms):
+            ranks[vocabulary[term]] = rank
+        del vocabulary
+        files += StringTable.write(path, 'terms', sorted_terms)
+
+        term_ranks = ranks[np.frombuffer(term_ids, dtype=np.int64)]
+        order = np.argsort(term_ranks, kind='stable')
+        postings_offsets = np.zeros(len(sorted_terms) + 1, dtype=np.int64)
+        np.cumsum(
+            np.bincount(term_ranks, minlength=len(sorted_terms)),
+            out=postings_offsets[1:]
+        )
+        arrays = {
+            'postings_offsets': postings_offsets,
+            'postings_docs': np.frombuffer(
+                doc_ids, dtype=np.int64)[order].astype(np.int32),
+            'postings_tfs': np.frombuffer(
+                tfs, dtype=np.int64)[order].astype(np.uint16),
+            'doc_lengths': np.frombuffer(
+                doc_lengths, dtype=np.int64).astype(np.uint16),
+        }
+        for name, values in arrays.items():
+            np.save(os.path.join(path, name + '.npy'), values)
+            files.append(name + '.npy')
+
+        num_docs = len(doc_lengths)
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({
+                'version': cls.VERSION,
+                'num_docs': num_docs,
+                'avg_doc_length': (
+                    sum(doc_lengths) / num_docs if num_docs else 0.0),
+                'files': files + ['meta.json'],
+            }, f)
+        logger.info('BM25TitleIndex.build: done publications=%d', num_docs)
+        return num_docs
+
+    def term_id(self, term):
+        i = bisect.bisect_left(self.terms, term)
+        if i < len(self.terms) and self.terms[i] == term:
+            return i
+
+    def search(self, title, should_match_threshold):
+        """ Return the best matching publication for a title as an
+        Elasticsearch-like hit, or None.
+
+        Args:
+            title: title to search for
+            should_match_threshold: percentage of the title's terms that
+                a publication title must contain
+        """
+        terms = set(tokenize(title))
+        if not terms:
+            return
+
+        required = max(1, int(len(terms) * should_match_threshold / 100))
+        postings = []
+        for term in terms:
+            term_id = self.term_id(term)
+            if term_id is not None:
+                start = self.postings_offsets[term_id]
+                stop = self.postings_offsets[term_id + 1]
+                postings.append((stop - start, start, stop))
+        if len(postings) < required:
+            return
+
+        # A title containing at least `required` of the query terms has
+        # to contain one of its len(terms) - required + 1 rarest terms
+        # (terms missing from the index being the rarest), so only
+        # titles from these postings need to be scored.
+        postings.sort()
+        probes = len(postings) - required + 1
+        candidates = np.unique(np.concatenate([
+            self.postings_docs[start:stop]
+            for _, start, stop in postings[:probes]
+        ]))
+
+        scores = np.zeros(len(candidates))
+        matched = np.zeros(len(candidates), dtype=np.int32)
+        lengths = self.doc_lengths[candidates] / self.avg_doc_length
+        for doc_freq, start, stop in postings:
+            docs = self.postings_docs[start:stop]
+            positions = np.minimum(
+                np.searchsorted(docs, candidates), len(docs) - 1)
+            found = docs[positions] == candidates
+            tfs = self.postings_tfs[start:stop][positions[found]]
+            idf = math.log(
+                1 + (self.num_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+            scores[found] += idf * tfs / (
+                tfs + self.K1 * (1 - self.B + self.B * lengths[found]))
+            matched[found] += 1
+
+        scores[matched < required] = -1
+        best = int(np.argmax(scores))
+        if scores[best] < 0:
+            return
+
+        row = int(candidates[best])
+        return {
+            '_id': self.ids[row],
+            '_score': float(scores[best]),
+            '_source': {'doc': json.loads(self.sources[row])},
+        }
+
+
+class ExactTitleIndex:
+    """
+    Hash table of normalised EPMC publication titles, to find publications
+    whose title is exactly that of a reference, case, punctuation and
+    whitespace aside.
+
+    The table uses open addressing with linear probing over two
+    memory-mapped arrays, the 64 bit hash of the title in each slot and the
+    row of its publication, so lookups cost a few array reads. When several
+    publications share a title, the first one wins.
+
+    Args:
+        path: directory the index was built into, see build()
+    """
+
+    VERSION = 1
+    EMPTY = -1
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != self.VERSION:
+            raise ValueError(
+                'Unsupported title index version: %s' % meta['version'])
+
+        self.num_docs = meta['num_docs']
+        self.ids = StringTable.load(path, 'ids')
+        self.sources = StringTable.load(path, 'sources')
+        self.slot_hashes = np.load(
+            os.path.join(path, 'slot_hashes.npy'), mmap_mode='r')
+        self.slot_rows = np.load(
+            os.path.join(path, 'slot_rows.npy'), mmap_mode='r')
+        self.mask = len(self.slot_hashes) - 1
+
+    @classmethod
+    def build(cls, publications, path):
+        """ Build an index over an iterable of EPMC publication dicts into
+        the directory at path.
+
+        Returns:
+            The number of publications indexed.
+        """
+        hashes = array.array('Q')
+        seen = set()
+
+        def yield_publications():
+            for publication in publications:
+                if not publication.get('title'):
+                    continue
+                normalised_title = normalise_title(publication['title'])
+                if not normalised_title:
+                    continue
+                title_hash = hash_title(normalised_title)
+                if title_hash in seen:
+                    continue
+                seen.add(title_hash)
+
+                row = len(hashes)
+                hashes.append(title_hash)
+                if row % 100000 == 0:
+                    logger.info('ExactTitleIndex.build: publications=%d', row)
+                yield row, publication
+
+        os.makedirs(path, exist_ok=True)
+        files = write_publications(path, yield_publications())
+        del seen
+
+        # Keep the table at most half full so that probe sequences stay
+        # short.
+        num_docs = len(hashes)
+        size = 1
+        while size < 2 * num_docs:
+            size *= 2
+        mask = size - 1
+        slot_hashes = np.zeros(size, dtype=np.uint64)
+        slot_rows = np.full(size, cls.EMPTY, dtype=np.int32)
+        for row, title_hash in enumerate(hashes):
+            slot = title_hash & mask
+            while slot_rows[slot] != cls.EMPTY:
+                slot = (slot + 1) & mask
+            slot_hashes[slot] = title_hash
+            slot_rows[slot] = row
+
+        for name, values in (
+                ('slot_hashes', slot_hashes), ('slot_rows', slot_rows)):
+            np.save(os.path.join(path, name + '.npy'), values)
+            files.append(name + '.npy')
+
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({
+                'version': cls.VERSION,
+                'num_docs': num_docs,
+                'files': files + ['meta.json'],
+            }, f)
+        logger.info('ExactTitleIndex.build: done publications=%d', num_docs)
+        return num_docs
+
+    def lookup(self, title):
+        """ Return the publication whose normalised title is that of title
+        as an Elasticsearch-like hit without a score, or None.
+        """
+        normalised_title = normalise_title(title)
+        if not normalised_title or not self.num_docs:
+            return
+
+        title_hash = hash_title(normalised_title)
+        slot = title_hash & self.mask
+        while True:
+            row = int(self.slot_rows[slot])
+            if row == self.EMPTY:
+                return
+            if int(self.slot_hashes[slot]) == title_hash:
+                break
+            slot = (slot + 1) & self.mask
+
+        source = json.loads(self.sources[row])
+        # Guard against hash collisions.
+        if normalise_title(source['title']) != normalised_title:
+            return
+        return {
+            '_id': self.ids[row],
+            '_score': None,
+            '_source': {'doc': source},
+        }
+
+
+INDEX_TYPES = {
+    'bm25': BM25TitleIndex,
+    'exact': ExactTitleIndex,
+}
+
+
+def fetch_index(s3, src, path):
+    """ Download an index stored under an S3 prefix to a local directory.
+    """
+    os.makedirs(path, exist_ok=True)
+    src = src.rstrip('/') + '/'
+    meta_path = os.path.join(path, 'meta.json')
+    s3.get_s3_object(src + 'meta.json').download_file(meta_path)
+    with open(meta_path) as f:
+        files = json.load(f)['files']
+    for name in files:
+        if name != 'meta.json':
+            s3.get_s3_object(src + name).download_file(
+                os.path.join(path, name))
+
+
+def upload_index(s3, path, dst):
+    """ Upload a locally built index under an S3 prefix. """
+    dst = dst.rstrip('/') + '/'
+    with open(os.path.join(path, 'meta.json')) as f:
+        files = json.load(f)['files']
+    for name in files:
+        s3.load_file(os.path.join(path, name), dst + name)
+
+
+def yield_publications(s3, src):
+    """ Yield EPMC publication dicts from a local or S3 json.gz file. """
+    if src.startswith('s3://'):
+        raw_f = s3.open_stream(src)
+    else:
+        raw_f = open(src, 'rb')
+    with raw_f, gzip.GzipFile(mode='rb', fileobj=raw_f) as f:
+        for line in f:
+            yield json.loads(line)
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(
+        description='Build a local index over EPMC publication titles.'
+    )
+    arg_parser.add_argument(
+        'src',
+        help='Path or S3 URL to the EPMC metadata json.gz file.'
+    )
+    arg_parser.add_argument(
+        'dst',
+        help='Local directory or S3 prefix to write the index to.'
+    )
+    arg_parser.add_argument(
+        '--index_type',
+        choices=sorted(INDEX_TYPES),
+        default='bm25',
+        help='bm25 for the BM25 fuzzy matching engine, exact for exact'
+             ' title lookups.'
+    )
+    args = arg_parser.parse_args()
+
+    index_class = INDEX_TYPES[args.index_type]
+    s3 = s3hook.S3Hook()
+    publications = yield_publications(s3, args.src)
+    if args.dst.startswith('s3://'):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            index_class.build(publications, tmp_dir)
+            upload_index(s3, tmp_dir, args.dst)
+    else:
+        index_class.build(publications, args.dst)
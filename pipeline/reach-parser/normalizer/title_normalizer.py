@@ -4,7 +4,6 @@ Operator for normalizing the name coming from the PDF
 
 import json
 import logging
-import tempfile
 import gzip
 import os
 
@@ -81,19 +80,16 @@ class PolicyNameNormalizerOperator(object):
         logger.info("Deciding on policy title")
         s3 = S3Hook()
 
-        results = []
-
-        with tempfile.TemporaryFile(mode='rb+') as tf:
-            key = s3.get_s3_object(self.src_s3_key)
-            key.download_fileobj(tf)
-            tf.seek(0)
-            with gzip.GzipFile(mode='rb', fileobj=tf) as f:
+        # Results are compressed and uploaded to S3 as they are written
+        with s3.open_stream(self.src_s3_key) as raw_f, \
+                s3.open_json_gz_writer(self.dst_s3_key) as output_writer:
+            with gzip.GzipFile(mode='rb', fileobj=raw_f) as f:
                 for line in f:
                     data = json.loads(line)
                     source_meta = data.get("source_metadata", {})
                     pdf_meta = data.get("pdf_metadata", {})
                     p_name = PolicyNameCandidates(data)
-                    results.append(json.dumps({
+                    output_writer.write({
                         'file_hash': data.get("file_hash"),
                         'keywords': data.get('keywords', {}),
                         'text': data.get('text', ''),
@@ -106,20 +102,7 @@ class PolicyNameNormalizerOperator(object):
                         'subjects': source_meta.get("subjects", None),
                         'created': pdf_meta.get("created", None),
                         'types': source_meta.get("types", None)
-                    }))
-        # Write the results to S3
-        with tempfile.NamedTemporaryFile(mode='wb') as output_raw_f:
-            with gzip.GzipFile(mode='wb', fileobj=output_raw_f) as output_f:
-                for item in results:
-                    output_f.write(item.encode("utf-8"))
-                    output_f.write(b"\n")
-
-            output_raw_f.flush()
-            s3.load_file(
-                output_raw_f.name,
-                self.dst_s3_key,
-                replace=True
-            )
-            logger.info(
-                'PolicyNameNormalizerOperator: Done normalizing policy names'
-            )
+                    })
+        logger.info(
+            'PolicyNameNormalizerOperator: Done normalizing policy names'
+        )
@@ -13,8 +13,6 @@ Example:
 """
 from argparse import ArgumentParser
 from urllib.parse import urlparse, urljoin
-import gzip
-import json
 import logging
 import os
 import os.path
@@ -48,15 +46,9 @@ def write_to_file(output_url, items, organisation):
     fname = os.path.basename(parsed_url.path)
     s3_hook = S3Hook()
     if fname.endswith('.json.gz'):
-        with tempfile.TemporaryFile(mode='w+b') as raw_f:
-            with gzip.GzipFile(fileobj=raw_f, mode='w') as f:
-                # No text mode GzipFile until Python 3.7 :-(
-                for item in items:
-                    f.write(json.dumps(item).encode('utf-8'))
-                    f.write(b"\n")
-            raw_f.flush()
-            raw_f.seek(0)
-            s3_hook.save_fileobj(raw_f, output_url)
+        with s3_hook.open_json_gz_writer(output_url) as writer:
+            for item in items:
+                writer.write(item)
     else:
         raise ValueError(
             'Unsupported output_url: %s' % output_url)